@@ -0,0 +1,394 @@
+"""Leaderboard aggregation of the filtered /api/data views, shared by app.py and snapshots.py.
+
+calculate_leaderboard aggregates races streamed from SQLite or the memory-mapped archive in a
+single pass. The optional NumPy backend (VERST_AGGREGATION=numpy) produces exactly the same
+output, including row order, float sums and best-time attribution, from flat arrays with
+grouped reductions instead of a Python loop over every run; when the archive is current, its
+columns are sliced out of the archive instead of being read from SQLite. Nothing here imports
+the Flask app, so the scraper builds snapshots without it.
+"""
+import os
+from datetime import datetime
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+import archive
+import db_manager
+import metrics
+
+UNKNOWN_GENDER = 'Н/Д'
+# 'python' aggregates filtered views from race dicts, 'numpy' column-wise (needs numpy installed)
+BACKEND = os.environ.get('VERST_AGGREGATION', 'python')
+if BACKEND == 'numpy' and np is None:
+    print("Warning: VERST_AGGREGATION=numpy, but numpy is not installed; using the python backend")
+    BACKEND = 'python'
+
+
+SEASONS = {
+    'зима': [12, 1, 2],
+    'весна': [3, 4, 5],
+    'лето': [6, 7, 8],
+    'осень': [9, 10, 11]
+}
+
+def get_current_season(month):
+    for season, months in SEASONS.items():
+        if month in months:
+            return season
+    return None
+
+def race_filters(year_filter, season_filter, month_filter, race_number_filter, filter_mode):
+    """Translates the /api/data period filters into load_all_results arguments."""
+    if race_number_filter:
+        return {'race_number': race_number_filter}
+    if filter_mode == 'current_season':
+        now = datetime.now()
+        year_filter = now.year
+        season_filter = get_current_season(now.month)
+
+    filters = {'month': month_filter or None}
+    if season_filter == 'зима' and year_filter:
+        # Winter of a year is December of the year before plus January and February
+        filters.update(season_year=year_filter, months=SEASONS['зима'])
+    else:
+        filters['year'] = year_filter or None
+        if season_filter in SEASONS:
+            filters['months'] = SEASONS[season_filter]
+    return filters
+
+def race_url(location_slug, race_date):
+    return f"https://5verst.ru/{location_slug}/results/{race_date}/" if location_slug and race_date else None
+
+def set_best_time_race_url(stats):
+    stats['best_time_race_url'] = race_url(stats['best_time_location_slug'], stats['best_time_date'])
+
+class ParticipantTotals:
+    """Running totals of one participant while a leaderboard is aggregated."""
+    __slots__ = ('id', 'name', 'total_score', 'run_count', 'volunteer_count', 'total_time_seconds', 'gender',
+                 'best_time_seconds', 'best_time_race', 'age_group', 'gold_medals', 'silver_medals', 'bronze_medals')
+
+    def __init__(self, participant_id, name):
+        self.id = participant_id
+        self.name = name
+        self.total_score = 0.0
+        self.run_count = 0
+        self.volunteer_count = 0
+        self.total_time_seconds = 0
+        self.gender = 'Н/Д'
+        self.best_time_seconds = float('inf')
+        self.best_time_race = None
+        self.age_group = None
+        self.gold_medals = 0
+        self.silver_medals = 0
+        self.bronze_medals = 0
+
+    def as_row(self):
+        race_number, race_date, location_slug = self.best_time_race or (None, None, None)
+        return {
+            'name': self.name, 'total_score': self.total_score / 10, 'run_count': self.run_count,
+            'volunteer_count': self.volunteer_count, 'total_time_seconds': self.total_time_seconds,
+            'gender': self.gender,
+            'best_time_seconds': self.best_time_seconds if self.best_time_race else None,
+            'best_time_race_number': race_number, 'age_group': self.age_group,
+            'gold_medals': self.gold_medals, 'silver_medals': self.silver_medals, 'bronze_medals': self.bronze_medals,
+            'best_time_date': race_date, 'best_time_location_slug': location_slug, 'id': self.id,
+            'best_time_race_url': race_url(location_slug, race_date)
+        }
+
+def calculate_leaderboard(races, ag_filter=None):
+    """Aggregates the races streamed by db_manager.iter_race_rows in a single pass.
+
+    Returns (leaderboard, fastest run). An age group filter keeps the runs done in that age
+    group, while volunteering always counts. The leaderboard is sorted by best time for age
+    group views and by score otherwise. The fastest run is taken over all runners, whatever
+    the filter.
+    """
+    filter_age_group = ag_filter and ag_filter != 'all'
+    participants = {}
+    best_run_info, fastest_time = None, float('inf')
+
+    for race, runners, volunteers in races:
+        runner_ids_this_race = set()
+        for runner_id, name, score, time, gender, age_group, overall_rank, gender_rank in runners:
+            if time is not None and time < fastest_time:
+                fastest_time = time
+                best_run_info = {'name': name, 'time': time, 'race_number': race[0], 'date': race[1]}
+            if not runner_id or (filter_age_group and f"{gender}{age_group}" != ag_filter):
+                continue
+            runner_ids_this_race.add(runner_id)
+
+            stats = participants.get(runner_id)
+            if stats is None:
+                stats = participants[runner_id] = ParticipantTotals(runner_id, name)
+            stats.run_count += 1
+            stats.total_score += score
+            stats.total_time_seconds += time
+
+            if time < stats.best_time_seconds:
+                stats.best_time_seconds = time
+                stats.best_time_race = race
+
+            if age_group:
+                stats.age_group = age_group
+
+            if stats.gender == 'Н/Д' and gender != 'Н/Д':
+                stats.gender = gender
+
+            medal_rank = overall_rank if gender == 'М' else gender_rank if gender == 'Ж' else None
+            if medal_rank == 1: stats.gold_medals += 1
+            elif medal_rank == 2: stats.silver_medals += 1
+            elif medal_rank == 3: stats.bronze_medals += 1
+
+        for volunteer_id, name in volunteers:
+            if not volunteer_id:
+                continue
+            stats = participants.get(volunteer_id)
+            if stats is None:
+                stats = participants[volunteer_id] = ParticipantTotals(volunteer_id, name)
+            stats.volunteer_count += 1
+            # Volunteering at a race you also ran is worth 5 points, otherwise 55
+            stats.total_score += 5 if volunteer_id in runner_ids_this_race else 55
+
+    totals = list(participants.values())
+    with metrics.stage('sort'):
+        if ag_filter:
+            totals.sort(key=lambda stats: stats.best_time_seconds)
+        else:
+            totals.sort(key=lambda stats: stats.total_score / 10, reverse=True)
+
+    return [stats.as_row() for stats in totals], best_run_info
+
+def load_period(db_path, location_slug, filters, reusable=False):
+    """Races of a filtered view, in the form period_leaderboard of the configured backend takes.
+
+    The python backend streams races from the database; pass reusable=True to aggregate them more than once.
+    """
+    with metrics.stage('load'):
+        # Read from the memory-mapped archive when it is up to date, from SQLite otherwise
+        mapped = archive.current(db_path)
+        if BACKEND == 'numpy':
+            if mapped:
+                return archive_columns(mapped, location_slug, filters)
+            return load_columns(db_path, location_slug, filters)
+        if mapped:
+            races = mapped.iter_race_rows(location_slug, **filters)
+        else:
+            races = db_manager.iter_race_rows(db_path, location_slug=location_slug, **filters)
+        return list(races) if reusable else races
+
+def period_leaderboard(races, ag_filter):
+    """Leaderboard of the races from load_period plus the fastest run among them, as served for filtered views."""
+    with metrics.stage('aggregate'):
+        if BACKEND == 'numpy':
+            leaderboard_data, best_run_info = columns_leaderboard(races, ag_filter)
+            for stats in leaderboard_data:
+                set_best_time_race_url(stats)
+            return leaderboard_data, best_run_info
+        return calculate_leaderboard(races, ag_filter)
+
+
+class RunColumns:
+    """Runs and volunteer shifts of a set of races as parallel arrays, in load_all_results order."""
+
+    def __init__(self, races, runs, volunteers, names):
+        self.races = races
+        self.names = names
+        (run_race, runner_id, score, time, gender, age_group,
+         overall_rank, gender_rank) = zip(*runs) if runs else ((),) * 8
+        overall_rank = np.array(overall_rank, dtype=np.int64)
+        # Stable, so runners sharing a rank keep the order the index returned them in
+        order = np.lexsort((overall_rank, np.array(run_race, dtype=np.int64)))
+        self.run_race = np.array(run_race, dtype=np.int64)[order]
+        self.runner_id = np.array(runner_id, dtype=np.int64)[order]
+        self.score = np.array(score, dtype=np.float64)[order]
+        # Stored values are kept for the output; the float copy is for comparisons and sums
+        self.time_values = [time[i] for i in order.tolist()]
+        self.time = np.array(time, dtype=np.float64)[order]
+        self.gender = np.array(gender, dtype=object)[order]
+        self.age_group = np.array(age_group, dtype=object)[order]
+        # Spelled like the ?ag= filter: f"{gender}{age_group}"
+        self.age_group_key = np.array([f"{g}{a}" for g, a in zip(gender, age_group)], dtype=object)[order]
+        self.overall_rank = overall_rank[order]
+        self.gender_rank = np.array(gender_rank, dtype=np.int64)[order]
+
+        vol_race, volunteer_id = zip(*volunteers) if volunteers else ((),) * 2
+        self.vol_race = np.array(vol_race, dtype=np.int64)
+        self.volunteer_id = np.array(volunteer_id, dtype=np.int64)
+
+
+def load_columns(db_path, location_slug, filters):
+    races, runs, volunteers = db_manager.load_result_rows(db_path, location_slug=location_slug, **filters)
+    participant_ids = {run[1] for run in runs if run[1]} | {volunteer[1] for volunteer in volunteers if volunteer[1]}
+    return RunColumns(races, runs, volunteers, db_manager.load_participant_names(db_path, participant_ids))
+
+
+class _ArchiveNames:
+    """participant id -> name lookups in the archive, resolved only for the ids asked for."""
+
+    def __init__(self, source):
+        self.source = source
+        self.ids = np.frombuffer(source.participant_id, dtype=np.int64)
+
+    def get(self, participant_id):
+        i = int(np.searchsorted(self.ids, participant_id))
+        if i < len(self.ids) and self.ids[i] == participant_id:
+            return self.source.names[i]
+        return None
+
+
+def _race_rows(starts, ends):
+    """(position of the race, row) of every row in the [start, end) ranges of the selected races."""
+    lengths = ends - starts
+    race = np.repeat(np.arange(len(starts)), lengths)
+    rows = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths) + np.repeat(starts, lengths)
+    return race, rows
+
+
+def archive_columns(source, location_slug, filters):
+    """The RunColumns load_columns would build, taken from the memory-mapped archive without copying it whole."""
+    column = lambda name: np.frombuffer(getattr(source, name), dtype=getattr(source, name).format)
+    positions = np.array(source.select_races(location_slug, **filters), dtype=np.int64)
+    c = RunColumns.__new__(RunColumns)
+    c.races = [source.race(i) for i in positions.tolist()]
+    c.names = _ArchiveNames(source)
+
+    run_start = column('race_run_start')
+    race, rows = _race_rows(run_start[positions], run_start[positions + 1])
+    # Archive rows are already in (race, overall_rank) order
+    c.run_race = race
+    c.runner_id = column('run_runner')[rows]
+    c.score = column('run_score')[rows]
+    time = column('run_time')[rows]
+    missing_time = time == archive.NULL
+    c.time_values = [None if missing else value for value, missing in zip(time.tolist(), missing_time.tolist())]
+    c.time = np.where(missing_time, np.nan, time)
+    # Code -1 (NULL) picks the None appended to the value table
+    values = np.array(source.strings + [None], dtype=object)
+    gender_codes = column('run_gender')[rows].astype(np.int64) % len(values)
+    age_group_codes = column('run_age_group')[rows].astype(np.int64) % len(values)
+    c.gender = values[gender_codes]
+    c.age_group = values[age_group_codes]
+    keys = np.array([f"{gender}{age_group}" for gender in values for age_group in values], dtype=object)
+    c.age_group_key = keys[gender_codes * len(values) + age_group_codes]
+    overall_rank = column('run_overall_rank')[rows].astype(np.int64)
+    c.overall_rank = np.where(overall_rank == archive.NULL, 0, overall_rank)
+    gender_rank = column('run_gender_rank')[rows].astype(np.int64)
+    c.gender_rank = np.where(gender_rank == archive.NULL, 0, gender_rank)
+
+    volunteer_start = column('race_volunteer_start')
+    c.vol_race, rows = _race_rows(volunteer_start[positions], volunteer_start[positions + 1])
+    c.volunteer_id = column('volunteer_id')[rows]
+    return c
+
+
+def _fastest_run(c):
+    """The first run with the lowest time, over all runners regardless of the age group filter."""
+    timed = np.flatnonzero(~np.isnan(c.time))
+    if not len(timed):
+        return None
+    i = timed[np.argmin(c.time[timed])]
+    runner_id = int(c.runner_id[i])
+    race_number, race_date, _ = c.races[c.run_race[i]]
+    return {
+        'name': c.names.get(runner_id) if runner_id else db_manager.UNKNOWN_RUNNER_NAME,
+        'time': c.time_values[i], 'race_number': race_number, 'date': race_date
+    }
+
+
+def columns_leaderboard(c, ag_filter):
+    """(leaderboard, fastest run) of the races in `c`, as calculate_leaderboard returns them."""
+    run_rows = c.runner_id != 0
+    if ag_filter and ag_filter != 'all':
+        run_rows &= c.age_group_key == ag_filter
+    run_rows = np.flatnonzero(run_rows)
+    vol_rows = np.flatnonzero(c.volunteer_id != 0)
+
+    # One event per counted run or shift, race by race with runners before volunteers,
+    # which is the order the Python loop visits them in
+    kind = np.concatenate([np.zeros(len(run_rows), np.int64), np.ones(len(vol_rows), np.int64)])
+    source = np.concatenate([run_rows, vol_rows])
+    order = np.lexsort((source, kind, np.concatenate([c.run_race[run_rows], c.vol_race[vol_rows]])))
+    kind, source = kind[order], source[order]
+    event_pid = np.concatenate([c.runner_id[run_rows], c.volunteer_id[vol_rows]])[order]
+
+    # Participants are numbered by first appearance, like the insertion order of the Python dict
+    pids, first, inverse = np.unique(event_pid, return_index=True, return_inverse=True)
+    by_appearance = np.argsort(first, kind='stable')
+    slot = np.empty(len(pids), np.int64)
+    slot[by_appearance] = np.arange(len(pids))
+    p = slot[inverse]
+    pids = pids[by_appearance]
+    n = len(pids)
+
+    run_events = np.flatnonzero(kind == 0)
+    rp, rsrc = p[run_events], source[run_events]
+    vol_events = np.flatnonzero(kind == 1)
+    vp, vsrc = p[vol_events], source[vol_events]
+
+    # A volunteer who also ran that race (and passed the age group filter) gets 5 points instead of 55
+    key_base = int(max(c.runner_id.max(initial=0), c.volunteer_id.max(initial=0))) + 1
+    run_keys = np.sort(c.run_race[rsrc] * key_base + c.runner_id[rsrc])
+    vol_keys = c.vol_race[vsrc] * key_base + c.volunteer_id[vsrc]
+    found = np.searchsorted(run_keys, vol_keys)
+    ran = found < len(run_keys)
+    ran[ran] = run_keys[found[ran]] == vol_keys[ran]
+    points = np.empty(len(p))
+    points[run_events] = c.score[rsrc]
+    points[vol_events] = np.where(ran, 5.0, 55.0)
+    # bincount adds in event order, so the float sums match the sequential Python ones bit for bit
+    total_score = np.bincount(p, weights=points, minlength=n) / 10
+    run_count = np.bincount(rp, minlength=n)
+    volunteer_count = np.bincount(vp, minlength=n)
+    total_time = np.bincount(rp, weights=c.time[rsrc], minlength=n).astype(np.int64)
+
+    gender = c.gender[rsrc]
+    medal_rank = np.where(gender == 'М', c.overall_rank[rsrc], np.where(gender == 'Ж', c.gender_rank[rsrc], 0))
+    medals = [np.bincount(rp, weights=medal_rank == place, minlength=n).astype(np.int64) for place in (1, 2, 3)]
+
+    # Best time: within each participant's runs sorted by time, the earliest of the fastest
+    best_run = np.full(n, -1, np.int64)
+    best_time = np.full(n, np.inf)
+    timed = np.flatnonzero(~np.isnan(c.time[rsrc]))
+    if len(timed):
+        # lexsort is stable, so equal times stay in event order
+        ranked = timed[np.lexsort((c.time[rsrc][timed], rp[timed]))]
+        group_starts = np.flatnonzero(np.r_[True, rp[ranked][1:] != rp[ranked][:-1]])
+        firsts = ranked[group_starts]
+        best_run[rp[firsts]] = rsrc[firsts]
+        best_time[rp[firsts]] = np.minimum.reduceat(c.time[rsrc][ranked], group_starts)
+
+    # Latest non-empty age group and first gender other than 'Н/Д' ('Н/Д' is the default)
+    last_age_group = np.full(n, -1, np.int64)
+    with_age_group = np.array([bool(age_group) for age_group in c.age_group[rsrc]], dtype=bool)
+    np.maximum.at(last_age_group, rp[with_age_group], rsrc[with_age_group])
+    first_gender = np.full(n, len(c.runner_id), np.int64)
+    known_gender = gender != UNKNOWN_GENDER
+    np.minimum.at(first_gender, rp[known_gender], rsrc[known_gender])
+
+    ordering = np.argsort(best_time if ag_filter else -total_score, kind='stable')
+
+    # Everything is put in leaderboard order while still in arrays, then zipped into dicts
+    best_run, first_gender, last_age_group = best_run[ordering], first_gender[ordering], last_age_group[ordering]
+    races = c.races + [(None, None, None)]
+    best_races = [races[race] for race in np.append(c.run_race, len(c.races))[best_run].tolist()]
+    genders = np.append(c.gender, UNKNOWN_GENDER)[first_gender].tolist()
+    age_groups = np.append(c.age_group, None)[last_age_group].tolist()
+    time_values = c.time_values + [None]
+    best_times = [time_values[row] for row in best_run.tolist()]
+    pids = pids[ordering].tolist()
+    names = [c.names.get(pid) for pid in pids]
+    leaderboard = [{
+        'name': name, 'total_score': score, 'run_count': runs, 'volunteer_count': volunteers,
+        'total_time_seconds': seconds, 'gender': gender, 'best_time_seconds': best_seconds,
+        'best_time_race_number': race[0], 'age_group': age_group,
+        'gold_medals': gold, 'silver_medals': silver, 'bronze_medals': bronze,
+        'best_time_date': race[1], 'best_time_location_slug': race[2], 'id': pid
+    } for name, score, runs, volunteers, seconds, gender, best_seconds, race, age_group, gold, silver, bronze, pid in zip(
+        names, total_score[ordering].tolist(), run_count[ordering].tolist(), volunteer_count[ordering].tolist(),
+        total_time[ordering].tolist(), genders, best_times, best_races, age_groups,
+        medals[0][ordering].tolist(), medals[1][ordering].tolist(), medals[2][ordering].tolist(), pids
+    )]
+    return leaderboard, _fastest_run(c)
@@ -1,334 +1,386 @@
-from flask import Flask, jsonify, render_template, request
+from flask import Flask, Response, jsonify, render_template, request, stream_with_context
 import os
 import db_manager
-from datetime import datetime
+import aggregation
+import metrics
+from datetime import date, datetime
+import base64
+import binascii
+import gzip
+import hashlib
+import heapq
+import json
 import math
+import threading
+import zlib
+from collections import OrderedDict
 
-app = Flask(__name__)
-DB_PATH = os.path.join(os.path.dirname(__file__), db_manager.DB_NAME)
-
-SEASONS = {
-    'зима': [12, 1, 2],
-    'весна': [3, 4, 5],
-    'лето': [6, 7, 8],
-    'осень': [9, 10, 11]
-}
-
-def get_current_season(month):
-    for season, months in SEASONS.items():
-        if month in months:
-            return season
-    return None
-
-def calculate_leaderboard(races_data, ag_filter=None):
-    participants = {}
-    for race in races_data:
-        race_content = race.get('data', {})
-        runners = race_content.get('runners', [])
-        volunteers = race_content.get('volunteers', [])
-
-        if ag_filter and ag_filter != 'all':
-            runners = [r for r in runners if f"{r.get('gender')}{r.get('age_group')}" == ag_filter]
-
-        runner_ids_this_race = {r['id'] for r in runners if r.get('id')}
-
-        for runner in runners:
-            runner_id = runner.get('id')
-            if not runner_id:
-                continue
-
-            if runner_id not in participants:
-                participants[runner_id] = {
-                    'name': runner.get('name'), 'total_score': 0.0, 'run_count': 0, 'volunteer_count': 0,
-                    'total_time_seconds': 0, 'gender': 'Н/Д', 'best_time_seconds': float('inf'),
-                    'best_time_race_number': None, 'age_group': None,
-                    'gold_medals': 0, 'silver_medals': 0, 'bronze_medals': 0,
-                    'best_time_date': None, 'best_time_location_slug': None
-                }
-            
-            stats = participants[runner_id]
-            stats['name'] = runner.get('name')
-            stats['run_count'] += 1
-            stats['total_score'] += runner.get('score', 0.0)
-            stats['total_time_seconds'] += runner.get('time_in_seconds', 0)
-
-            if runner.get('time_in_seconds', float('inf')) < stats['best_time_seconds']:
-                stats['best_time_seconds'] = runner['time_in_seconds']
-                stats['best_time_race_number'] = race.get('race_number')
-                stats['best_time_date'] = race.get('race_date')
-                stats['best_time_location_slug'] = race.get('location_slug')
-            
-            if runner.get('age_group'):
-                stats['age_group'] = runner['age_group']
-            
-            if stats['gender'] == 'Н/Д' and runner.get('gender', 'Н/Д') != 'Н/Д':
-                stats['gender'] = runner['gender']
-
-            gender = runner.get('gender')
-            if gender == 'М':
-                if runner.get('overall_rank') == 1: stats['gold_medals'] += 1
-                elif runner.get('overall_rank') == 2: stats['silver_medals'] += 1
-                elif runner.get('overall_rank') == 3: stats['bronze_medals'] += 1
-            elif gender == 'Ж':
-                if runner.get('gender_rank') == 1: stats['gold_medals'] += 1
-                elif runner.get('gender_rank') == 2: stats['silver_medals'] += 1
-                elif runner.get('gender_rank') == 3: stats['bronze_medals'] += 1
-
-        for volunteer in volunteers:
-            volunteer_id = volunteer.get('id')
-            if not volunteer_id:
-                continue
-
-            if volunteer_id not in participants:
-                participants[volunteer_id] = {
-                    'name': volunteer.get('name'), 'total_score': 0.0, 'run_count': 0, 'volunteer_count': 0,
-                    'total_time_seconds': 0, 'gender': 'Н/Д', 'best_time_seconds': float('inf'),
-                    'best_time_race_number': None, 'age_group': None,
-                    'gold_medals': 0, 'silver_medals': 0, 'bronze_medals': 0,
-                    'best_time_date': None, 'best_time_location_slug': None
-                }
-
-            stats = participants[volunteer_id]
-            stats['name'] = volunteer.get('name')
-            stats['volunteer_count'] += 1
+try:
+    import brotli
+except ImportError:
+    brotli = None
 
-            if volunteer_id in runner_ids_this_race:
-                stats['total_score'] += 5
-            else:
-                stats['total_score'] += 55
-
-    leaderboard = []
-    for participant_id, stats in participants.items():
-        stats['id'] = participant_id
-        stats['total_score'] = stats['total_score'] / 10
-        if stats['best_time_location_slug'] and stats['best_time_date']:
-            stats['best_time_race_url'] = f"https://5verst.ru/{stats['best_time_location_slug']}/results/{stats['best_time_date']}/"
-        else:
-            stats['best_time_race_url'] = None
-        leaderboard.append(stats)
-
-    if ag_filter:
-        leaderboard.sort(key=lambda x: x['best_time_seconds'])
+app = Flask(__name__)
+# Overridable so that tools such as benchmark.py can serve another database
+DB_PATH = os.environ.get('VERST_DB_PATH') or os.path.join(os.path.dirname(__file__), db_manager.DB_NAME)
+
+
+class ResponseCache:
+    """Bounded LRU of computed API payloads.
+
+    Entries are keyed by endpoint and request parameters and are dropped as soon as the
+    data generation stored in the database changes, i.e. after the scraper saved anything.
+    Each gunicorn worker holds its own copy; the generation check keeps them all in step.
+    """
+
+    def __init__(self, max_entries=256):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.generation = None
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get_or_compute(self, key, compute):
+        generation = db_manager.get_generation(DB_PATH)
+        with self.lock:
+            if generation != self.generation:
+                self.entries.clear()
+                self.generation = generation
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                metrics.count('cache_hits')
+                return self.entries[key]
+            self.misses += 1
+        metrics.count('cache_misses')
+
+        value = compute()
+        with self.lock:
+            if generation == self.generation:
+                self.entries[key] = value
+                self.entries.move_to_end(key)
+                while len(self.entries) > self.max_entries:
+                    self.entries.popitem(last=False)
+        return value
+
+    def stats(self):
+        with self.lock:
+            return {'generation': self.generation, 'entries': len(self.entries), 'max_entries': self.max_entries,
+                    'hits': self.hits, 'misses': self.misses}
+
+
+response_cache = ResponseCache(max_entries=int(os.environ.get('VERST_CACHE_SIZE', 256)))
+
+if metrics.ENABLED:
+    @app.before_request
+    def start_request_metrics():
+        # Labelled by route rule, not path, so /api/runner/<id> stays one series
+        metrics.start_request(request.url_rule.rule if request.url_rule else 'unmatched')
+
+    @app.after_request
+    def finish_request_metrics(response):
+        metrics.finish_request(request.method, request.full_path.rstrip('?'), response.status_code,
+                               response.calculate_content_length())
+        return response
+
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
+# API responses may be reused by browsers for this long; after that they revalidate with the ETag
+API_MAX_AGE = int(os.environ.get('VERST_API_MAX_AGE', 60))
+MIN_COMPRESS_SIZE = 1024
+NDJSON_CHUNK_ROWS = 500
+
+
+def negotiate_encoding():
+    return request.accept_encodings.best_match(['br', 'gzip'] if brotli else ['gzip'])
+
+def compress(body, encoding):
+    if encoding == 'br':
+        return brotli.compress(body, quality=5)
+    # mtime=0 keeps the output identical for identical input, as a strong ETag requires
+    return gzip.compress(body, compresslevel=6, mtime=0)
+
+def make_etag(key, encoding):
+    """Strong ETag of a cached API response: changes with the data generation, the request and the encoding."""
+    digest = hashlib.sha1(repr(key).encode()).hexdigest()[:16]
+    return f"{db_manager.get_generation(DB_PATH)}-{digest}" + (f"-{encoding}" if encoding else '')
+
+def conditional_response(key, encoding, make_response):
+    """Answers If-None-Match with 304 before anything is computed; otherwise calls make_response()."""
+    etag = make_etag(key, encoding)
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
     else:
-        leaderboard.sort(key=lambda x: x['total_score'], reverse=True)
-        
-    return leaderboard
+        response = make_response()
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = f'public, max-age={API_MAX_AGE}'
+    response.vary.add('Accept-Encoding')
+    return response
+
+def encode_payload(key, compute, encoding):
+    payload = response_cache.get_or_compute(key, compute)
+    with metrics.stage('serialize'):
+        body = app.json.response(payload).get_data()
+    if encoding and len(body) >= MIN_COMPRESS_SIZE:
+        with metrics.stage('compress'):
+            return compress(body, encoding), encoding
+    return body, None
+
+def api_response(key, compute):
+    """JSON response for a cached API payload, compressed and revalidatable.
+
+    Serialized and compressed bodies are kept in response_cache next to the payload, so a
+    repeat request costs a generation lookup and, at most, a cache hit.
+    """
+    encoding = negotiate_encoding()
+
+    def make_response():
+        body, applied = response_cache.get_or_compute(key + ('body', encoding), lambda: encode_payload(key, compute, encoding))
+        response = Response(body, mimetype='application/json')
+        if applied:
+            response.headers['Content-Encoding'] = applied
+        return response
+
+    return conditional_response(key, encoding, make_response)
+
+def ndjson_response(key, compute):
+    """Streams a leaderboard payload as NDJSON: one line with everything but the rows, then one line per row."""
+    encoding = 'gzip' if request.accept_encodings.best_match(['gzip']) else None
+
+    def generate(payload):
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 31) if encoding else None
+        rows = payload['leaderboard']
+        head = {k: v for k, v in payload.items() if k != 'leaderboard'}
+        lines = [app.json.dumps(head)]
+        for start in range(0, len(rows), NDJSON_CHUNK_ROWS):
+            lines.extend(app.json.dumps(row) for row in rows[start:start + NDJSON_CHUNK_ROWS])
+            chunk = ('\n'.join(lines) + '\n').encode()
+            lines = []
+            yield compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH) if compressor else chunk
+        if lines:
+            chunk = ('\n'.join(lines) + '\n').encode()
+            yield compressor.compress(chunk) if compressor else chunk
+        if compressor:
+            yield compressor.flush()
+
+    def make_response():
+        payload = response_cache.get_or_compute(key, compute)
+        response = Response(stream_with_context(generate(payload)), mimetype='application/x-ndjson')
+        if encoding:
+            response.headers['Content-Encoding'] = encoding
+        return response
+
+    return conditional_response(key + ('ndjson',), encoding, make_response)
+
+def default_order(location_slug, ag_filter):
+    # Age-group views and the all-locations view rank by best time, the rest by score
+    return 'best_time' if ag_filter or location_slug == 'all' else 'score'
+
+def encode_cursor(order_by, key):
+    return base64.urlsafe_b64encode(json.dumps([order_by, *key]).encode()).decode().rstrip('=')
+
+def decode_cursor(cursor, order_by):
+    """Turns a cursor back into the sort key it was made from; raises ValueError if it is malformed or for another sort."""
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+    except (binascii.Error, UnicodeDecodeError, json.JSONDecodeError) as e:
+        raise ValueError('invalid cursor') from e
+    if (not isinstance(values, list) or len(values) != len(db_manager.LEADERBOARD_ORDERS[order_by]) + 2
+            or values[0] != order_by or not all(isinstance(v, (int, float)) for v in values[1:])):
+        raise ValueError('invalid cursor')
+    return tuple(values[1:])
+
+def next_page_cursor(rows, order_by, limit):
+    """Cuts one extra fetched row off `rows`; returns (page, cursor of the next page or None)."""
+    if len(rows) <= limit:
+        return rows, None
+    rows = rows[:limit]
+    return rows, encode_cursor(order_by, db_manager.leaderboard_sort_key(rows[-1], order_by))
+
+def select_page(leaderboard, order_by, after, limit):
+    """Keyset page of an in-memory leaderboard: top-N selection, so the rest is never sorted."""
+    key = lambda row: db_manager.leaderboard_sort_key(row, order_by)
+    if after is not None:
+        leaderboard = (row for row in leaderboard if key(row) > after)
+    return next_page_cursor(heapq.nsmallest(limit + 1, leaderboard, key=key), order_by, limit)
 
 def get_all_locations_data(page, ag_filter):
-    all_races = db_manager.load_all_results(DB_PATH, location_slug='all')
-    participants = {}
-    for race in all_races:
-        runners = race.get('data', {}).get('runners', [])
-        volunteers = race.get('data', {}).get('volunteers', [])
-        runner_ids_this_race = {r['id'] for r in runners if r.get('id')}
-
-        for runner in runners:
-            runner_id = runner.get('id')
-            if not runner_id:
-                continue
-
-            if runner_id not in participants:
-                participants[runner_id] = {
-                    'name': runner.get('name'), 'run_count': 0, 'volunteer_count': 0,
-                    'total_time_seconds': 0, 'best_time_seconds': float('inf'),
-                    'age_group': None, 'best_time_date': None, 'best_time_race_number': None,
-                    'best_time_location_slug': None, 'gold_medals': 0, 'silver_medals': 0, 'bronze_medals': 0,
-                    'gender': runner.get('gender'), 'total_score': 0.0
-                }
-
-            stats = participants[runner_id]
-            stats['name'] = runner.get('name')
-            stats['run_count'] += 1
-            stats['total_score'] += runner.get('score', 0.0)
-            stats['total_time_seconds'] += runner.get('time_in_seconds', 0)
-            if runner.get('time_in_seconds', float('inf')) < stats['best_time_seconds']:
-                stats['best_time_seconds'] = runner['time_in_seconds']
-                stats['best_time_date'] = race.get('race_date')
-                stats['best_time_race_number'] = race.get('race_number')
-                stats['best_time_location_slug'] = race.get('location_slug')
-            
-            if runner.get('age_group'):
-                stats['age_group'] = runner.get('age_group')
-
-            gender = runner.get('gender')
-            if gender == 'М':
-                if runner.get('overall_rank') == 1: stats['gold_medals'] += 1
-                elif runner.get('overall_rank') == 2: stats['silver_medals'] += 1
-                elif runner.get('overall_rank') == 3: stats['bronze_medals'] += 1
-            elif gender == 'Ж':
-                if runner.get('gender_rank') == 1: stats['gold_medals'] += 1
-                elif runner.get('gender_rank') == 2: stats['silver_medals'] += 1
-                elif runner.get('gender_rank') == 3: stats['bronze_medals'] += 1
-        
-        for volunteer in volunteers:
-            volunteer_id = volunteer.get('id')
-            if not volunteer_id:
-                continue
-            if volunteer_id not in participants:
-                participants[volunteer_id] = {
-                    'name': volunteer.get('name'), 'run_count': 0, 'volunteer_count': 0,
-                    'total_time_seconds': 0, 'best_time_seconds': float('inf'),
-                    'age_group': None, 'best_time_date': None, 'best_time_race_number': None,
-                    'best_time_location_slug': None, 'gold_medals': 0, 'silver_medals': 0, 'bronze_medals': 0,
-                    'gender': None, 'total_score': 0.0
-                }
-            
-            stats = participants[volunteer_id]
-            stats['name'] = volunteer.get('name')
-            stats['volunteer_count'] += 1
-            if volunteer_id in runner_ids_this_race:
-                stats['total_score'] += 5
-            else:
-                stats['total_score'] += 55
-
-    leaderboard = []
-    for participant_id, stats in participants.items():
-        stats['id'] = participant_id
-        stats['total_score'] = stats['total_score'] / 10
-        if stats['best_time_location_slug'] and stats['best_time_date']:
-            stats['best_time_race_url'] = f"https://5verst.ru/{stats['best_time_location_slug']}/results/{stats['best_time_date']}/"
-        else:
-            stats['best_time_race_url'] = None
-        leaderboard.append(stats)
-
-    if ag_filter and ag_filter != 'all':
-        leaderboard = [p for p in leaderboard if f"{p.get('gender')}{p.get('age_group')}" == ag_filter]
-
-    leaderboard.sort(key=lambda x: x['best_time_seconds'])
-
     page_size = 1000
-    start_index = (page - 1) * page_size
-    end_index = start_index + page_size
-    paginated_leaderboard = leaderboard[start_index:end_index]
-    total_pages = math.ceil(len(leaderboard) / page_size)
+    leaderboard, total_count = db_manager.load_leaderboard(
+        DB_PATH, 'all', ag_filter=ag_filter, order_by='best_time',
+        limit=page_size, offset=(page - 1) * page_size
+    )
+    for stats in leaderboard:
+        aggregation.set_best_time_race_url(stats)
+    total_pages = math.ceil(total_count / page_size)
 
-    return paginated_leaderboard, total_pages
+    return leaderboard, total_pages
 
 @app.route('/')
 def index():
     return render_template('leaderboard.html')
 
-@app.route('/api/data')
-def get_data():
-    try:
-        location_slug = request.args.get('location', default='korolev', type=str)
-        page = request.args.get('page', default=1, type=int)
-        ag_filter = request.args.get('ag', default=None, type=str)
-
-        if location_slug == 'all':
-            leaderboard_data, total_pages = get_all_locations_data(page, ag_filter)
-            
-            fastest_runner = None
-            if leaderboard_data:
-                fastest_runner = leaderboard_data[0]
-
-            record_age_days = None
-            if fastest_runner and fastest_runner.get('best_time_date'):
-                try:
-                    record_date_obj = datetime.strptime(fastest_runner['best_time_date'], '%d.%m.%Y')
-                    record_age_days = (datetime.now() - record_date_obj).days
-                except (ValueError, TypeError): pass
-
-            response_data = {
-                'leaderboard': leaderboard_data,
-                'pages': total_pages,
-                'metadata': {
-                    'top_male': None,
-                    'top_female': None,
-                    'overall_fastest': {
-                        'name': fastest_runner.get('name') if fastest_runner else None,
-                        'time': fastest_runner.get('best_time_seconds') if fastest_runner else None,
-                        'race_number': fastest_runner.get('best_time_race_number') if fastest_runner else None,
-                        'age_days': record_age_days,
-                        'location_slug': fastest_runner.get('best_time_location_slug') if fastest_runner else None,
-                        'date': fastest_runner.get('best_time_date') if fastest_runner else None
-                    }
-                }
-            }
-            return jsonify(response_data)
-
-        year_filter = request.args.get('year', default=None, type=int)
-        season_filter = request.args.get('season', default=None, type=str)
-        month_filter = request.args.get('month', default=None, type=int)
-        race_number_filter = request.args.get('race_number', default=None, type=int)
-        filter_mode = request.args.get('filter', default=None, type=str)
-
-        all_races_for_location = db_manager.load_all_results(DB_PATH, location_slug=location_slug)
-        races_to_process = all_races_for_location
-
-        if race_number_filter:
-            races_to_process = [r for r in all_races_for_location if r.get('race_number') == race_number_filter]
-        else:
-            if filter_mode == 'current_season':
-                now = datetime.now()
-                year_filter = now.year
-                season_filter = get_current_season(now.month)
-
-            if season_filter == 'зима' and year_filter:
-                previous_year = year_filter - 1
-                winter_races = []
-                for race in all_races_for_location:
-                    try:
-                        race_date = datetime.strptime(race['race_date'], '%d.%m.%Y')
-                        if (race_date.year == year_filter and race_date.month in [1, 2]) or \
-                           (race_date.year == previous_year and race_date.month == 12):
-                            winter_races.append(race)
-                    except (ValueError, KeyError):
-                        continue
-                races_to_process = winter_races
-                if month_filter:
-                    races_to_process = [r for r in races_to_process if datetime.strptime(r['race_date'], '%d.%m.%Y').month == month_filter]
+def build_data_response(location_slug, page, ag_filter, year_filter, season_filter, month_filter, race_number_filter, filter_mode,
+                        sort=None, limit=None, after=None):
+    """Leaderboard payload for /api/data.
+
+    Without sort, limit or cursor the whole leaderboard is returned as before (page-based
+    for location 'all'). With any of them the response is one keyset page of at most
+    `limit` rows in `sort` order, plus `next_cursor` and `total`.
+    """
+    paged = bool(sort or limit or after)
+    order_by = sort or default_order(location_slug, ag_filter)
+    if paged:
+        limit = max(1, min(limit or DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE))
+    next_cursor, total_count = None, None
+
+    if location_slug == 'all':
+        # Served from participant_stats: an age group picks participants by their current age
+        # group with all-time totals (see load_leaderboard), not the runs done in that group
+        if paged:
+            leaderboard_data, total_count = db_manager.load_leaderboard(
+                DB_PATH, 'all', ag_filter=ag_filter, order_by=order_by, limit=limit + 1, after=after
+            )
+            leaderboard_data, next_cursor = next_page_cursor(leaderboard_data, order_by, limit)
+            for stats in leaderboard_data:
+                aggregation.set_best_time_race_url(stats)
+            total_pages = max(1, math.ceil(total_count / limit))
+            if order_by == 'best_time' and after is None:
+                fastest_runner = leaderboard_data[0] if leaderboard_data else None
             else:
-                temp_races = races_to_process
-                if year_filter:
-                    temp_races = [r for r in temp_races if datetime.strptime(r['race_date'], '%d.%m.%Y').year == year_filter]
-                if season_filter and season_filter in SEASONS:
-                    season_months = SEASONS[season_filter]
-                    temp_races = [r for r in temp_races if datetime.strptime(r['race_date'], '%d.%m.%Y').month in season_months]
-                if month_filter:
-                    temp_races = [r for r in temp_races if datetime.strptime(r['race_date'], '%d.%m.%Y').month == month_filter]
-                races_to_process = temp_races
-
-        leaderboard_data = calculate_leaderboard(races_to_process, ag_filter)
-
-        for stats in leaderboard_data:
-            if stats['best_time_seconds'] == float('inf'):
-                stats['best_time_seconds'] = None
-        
-        top_male, top_female, best_run_info, fastest_time = (None, None, None, float('inf'))
-
-        for race in races_to_process:
-            for runner in race.get('data', {}).get('runners', []):
-                if (time := runner.get('time_in_seconds')) is not None and time < fastest_time:
-                    fastest_time = time
-                    best_run_info = {'name': runner.get('name'), 'time': time, 'race_number': race.get('race_number'), 'date': race.get('race_date')}
-
-        for runner in leaderboard_data:
-            if runner['gender'] == 'М' and top_male is None: top_male = runner['name']
-            if runner['gender'] == 'Ж' and top_female is None: top_female = runner['name']
+                fastest, _ = db_manager.load_leaderboard(DB_PATH, 'all', ag_filter=ag_filter, order_by='best_time', limit=1)
+                fastest_runner = fastest[0] if fastest else None
+        else:
+            leaderboard_data, total_pages = get_all_locations_data(page, ag_filter)
+            fastest_runner = leaderboard_data[0] if leaderboard_data else None
 
         record_age_days = None
-        if best_run_info and best_run_info.get('date'):
+        if fastest_runner and fastest_runner.get('best_time_date'):
             try:
-                record_date_obj = datetime.strptime(best_run_info['date'], '%d.%m.%Y')
+                record_date_obj = datetime.strptime(fastest_runner['best_time_date'], '%d.%m.%Y')
                 record_age_days = (datetime.now() - record_date_obj).days
-            except ValueError: pass
+            except (ValueError, TypeError): pass
 
         response_data = {
             'leaderboard': leaderboard_data,
-            'pages': 1,
+            'pages': total_pages,
             'metadata': {
-                'top_male': top_male,
-                'top_female': top_female,
+                'top_male': None,
+                'top_female': None,
                 'overall_fastest': {
-                    'name': best_run_info.get('name') if best_run_info else None,
-                    'time': best_run_info.get('time') if best_run_info else None,
-                    'race_number': best_run_info.get('race_number') if best_run_info else None,
-                    'age_days': record_age_days
+                    'name': fastest_runner.get('name') if fastest_runner else None,
+                    'time': fastest_runner.get('best_time_seconds') if fastest_runner else None,
+                    'race_number': fastest_runner.get('best_time_race_number') if fastest_runner else None,
+                    'age_days': record_age_days,
+                    'location_slug': fastest_runner.get('best_time_location_slug') if fastest_runner else None,
+                    'date': fastest_runner.get('best_time_date') if fastest_runner else None
                 }
             }
         }
-        return jsonify(response_data)
+        if paged:
+            response_data.update(sort=order_by, total=total_count, next_cursor=next_cursor)
+        return response_data
+
+    is_default_view = not (ag_filter or year_filter or season_filter or month_filter or race_number_filter or filter_mode)
+    if is_default_view and paged:
+        leaderboard_data, total_count = db_manager.load_leaderboard(
+            DB_PATH, location_slug, order_by=order_by, limit=limit + 1, after=after
+        )
+        leaderboard_data, next_cursor = next_page_cursor(leaderboard_data, order_by, limit)
+        for stats in leaderboard_data:
+            stats['gender'] = stats['gender'] or 'Н/Д'
+            aggregation.set_best_time_race_url(stats)
+        best_run_info = db_manager.load_fastest_run(DB_PATH, location_slug)
+        # The page may not contain them, so the leaders are looked up on their own
+        top_male, top_female = [
+            leaders[0]['name'] if leaders else None
+            for leaders in (db_manager.load_leaderboard(DB_PATH, location_slug, limit=1, gender=gender)[0] for gender in ('М', 'Ж'))
+        ]
+    elif is_default_view:
+        # Unfiltered totals are maintained at write time in participant_stats
+        leaderboard_data, _ = db_manager.load_leaderboard(DB_PATH, location_slug)
+        for stats in leaderboard_data:
+            stats['gender'] = stats['gender'] or 'Н/Д'
+            aggregation.set_best_time_race_url(stats)
+        best_run_info = db_manager.load_fastest_run(DB_PATH, location_slug)
+    else:
+        filters = aggregation.race_filters(year_filter, season_filter, month_filter, race_number_filter, filter_mode)
+        # Views materialized by snapshots.py after a scrape are served as stored
+        snapshot = db_manager.load_snapshot(DB_PATH, location_slug, db_manager.snapshot_period(filters), ag_filter or '')
+        if snapshot:
+            leaderboard_data, best_run_info = snapshot['leaderboard'], snapshot['fastest']
+        else:
+            races = aggregation.load_period(DB_PATH, location_slug, filters)
+            leaderboard_data, best_run_info = aggregation.period_leaderboard(races, ag_filter)
+
+    if not (is_default_view and paged):
+        top_male, top_female = (None, None)
+        for runner in leaderboard_data:
+            if runner['gender'] == 'М' and top_male is None: top_male = runner['name']
+            if runner['gender'] == 'Ж' and top_female is None: top_female = runner['name']
+        if paged:
+            total_count = len(leaderboard_data)
+            leaderboard_data, next_cursor = select_page(leaderboard_data, order_by, after, limit)
+
+    record_age_days = None
+    if best_run_info and best_run_info.get('date'):
+        try:
+            record_date_obj = datetime.strptime(best_run_info['date'], '%d.%m.%Y')
+            record_age_days = (datetime.now() - record_date_obj).days
+        except ValueError: pass
+
+    response_data = {
+        'leaderboard': leaderboard_data,
+        'pages': max(1, math.ceil(total_count / limit)) if paged else 1,
+        'metadata': {
+            'top_male': top_male,
+            'top_female': top_female,
+            'overall_fastest': {
+                'name': best_run_info.get('name') if best_run_info else None,
+                'time': best_run_info.get('time') if best_run_info else None,
+                'race_number': best_run_info.get('race_number') if best_run_info else None,
+                'age_days': record_age_days
+            }
+        }
+    }
+    if paged:
+        response_data.update(sort=order_by, total=total_count, next_cursor=next_cursor)
+    return response_data
+
+@app.route('/api/data')
+def get_data():
+    try:
+        params = (
+            request.args.get('location', default='korolev', type=str),
+            request.args.get('page', default=1, type=int),
+            request.args.get('ag', default=None, type=str),
+            request.args.get('year', default=None, type=int),
+            request.args.get('season', default=None, type=str),
+            request.args.get('month', default=None, type=int),
+            request.args.get('race_number', default=None, type=int),
+            request.args.get('filter', default=None, type=str),
+        )
+        sort = request.args.get('sort', default=None, type=str)
+        limit = request.args.get('limit', default=None, type=int)
+        cursor = request.args.get('cursor', default=None, type=str)
+        if sort and sort not in db_manager.LEADERBOARD_ORDERS:
+            return jsonify({"error": f"Unknown sort '{sort}', expected one of: {', '.join(db_manager.LEADERBOARD_ORDERS)}."}), 400
+        if limit is not None and limit < 1:
+            return jsonify({"error": "limit must be at least 1."}), 400
+        after = None
+        if cursor:
+            try:
+                after = decode_cursor(cursor, sort or default_order(params[0], params[2]))
+            except ValueError:
+                return jsonify({"error": "Invalid cursor."}), 400
+        # The date is part of the key: current_season and the record age depend on it
+        key = ('data', date.today()) + params + (sort, limit, cursor)
+        compute = lambda: build_data_response(*params, sort=sort, limit=limit, after=after)
+        if request.args.get('format') == 'ndjson':
+            return ndjson_response(key, compute)
+        return api_response(key, compute)
     except Exception as e:
         print(f"Error in /api/data: {e}")
         import traceback
@@ -338,53 +390,103 @@ def get_data():
 
 @app.route('/api/global-search')
 def global_search():
-    query = request.args.get('query', default='', type=str).upper()
+    query = request.args.get('query', default='', type=str)
     if not query:
         return jsonify([])
 
-    all_races = db_manager.load_all_results(DB_PATH, location_slug='all')
-    matching_runners = {}
-    for race in all_races:
-        for runner in race.get('data', {}).get('runners', []):
-            runner_id = runner.get('id')
-            runner_name = runner.get('name', '').upper()
-            if runner_id and (query in runner_name or query in str(runner_id)):
-                if runner_id not in matching_runners:
-                    matching_runners[runner_id] = {
-                        'id': runner_id,
-                        'name': runner.get('name')
-                    }
-    return jsonify(list(matching_runners.values()))
+    limit = max(1, min(request.args.get('limit', default=20, type=int), db_manager.SEARCH_LIMIT))
+    matching_runners = db_manager.search_runners(DB_PATH, query, limit=limit)
+    return jsonify([{'id': runner['id'], 'name': runner['name']} for runner in matching_runners])
+
+def build_runner_profile(runner_id):
+    """Profile of one participant: totals, per-location stats and personal bests, runs, shifts and progression."""
+    history = db_manager.load_participant_history(DB_PATH, runner_id)
+    if history is None:
+        return None
+
+    # Progression lists each run that beat the participant's best time at that point, over all locations
+    progression, best_time = [], float('inf')
+    for run in history['runs']:
+        run['race_url'] = aggregation.race_url(run['location_slug'], run['race_date'])
+        time = run['time_in_seconds']
+        run['personal_best'] = time is not None and time < best_time
+        if run['personal_best']:
+            best_time = time
+            progression.append({k: run[k] for k in ('race_date', 'location_slug', 'race_number', 'time_in_seconds', 'race_url')})
+
+    ran = {(run['race_date'], run['location_slug']) for run in history['runs']}
+    for shift in history['volunteering']:
+        shift['race_url'] = aggregation.race_url(shift['location_slug'], shift['race_date'])
+        shift['also_ran'] = (shift['race_date'], shift['location_slug']) in ran
+
+    totals, locations = None, []
+    for stats in history['stats']:
+        stats['total_score'] /= 10
+        stats['best_time_race_url'] = aggregation.race_url(stats['best_time_location_slug'], stats['best_time_date'])
+        if stats['location_slug'] == db_manager.ALL_LOCATIONS:
+            del stats['location_slug'], stats['location_name']
+            totals = stats
+        else:
+            locations.append(stats)
+    locations.sort(key=lambda stats: (-stats['run_count'] - stats['volunteer_count'], stats['location_slug']))
+
+    return {
+        'id': history['id'], 'name': history['name'], 'gender': history['gender'], 'age_group': history['age_group'],
+        'last_seen': history['last_seen'], 'totals': totals, 'locations': locations,
+        # Newest first, as results pages list them
+        'runs': history['runs'][::-1], 'volunteering': history['volunteering'][::-1],
+        'progression': progression,
+    }
+
+@app.route('/api/runner/<int:runner_id>')
+def get_runner(runner_id):
+    key = ('runner', runner_id)
+    # Built once and handed to api_response, so a cache miss never builds the profile twice
+    profile = response_cache.get_or_compute(key, lambda: build_runner_profile(runner_id))
+    if profile is None:
+        return jsonify({"error": f"Unknown participant {runner_id}."}), 404
+    return api_response(key, lambda: profile)
+
+@app.route('/runner/<int:runner_id>')
+def runner_page(runner_id):
+    return render_template('runner.html', runner_id=runner_id)
 
 
 @app.route('/api/locations')
 def get_locations():
     """API эндпоинт для получения списка всех локаций, у которых есть забеги."""
-    locations = db_manager.load_locations_with_races(DB_PATH)
-    return jsonify(locations)
+    return api_response(('locations',), lambda: db_manager.load_locations_with_races(DB_PATH))
 
 @app.route('/api/age-groups')
 def get_age_groups():
-    age_groups = db_manager.get_all_age_groups(DB_PATH)
-    return jsonify(age_groups)
+    location_slug = request.args.get('location', default='all', type=str)
+    return api_response(('age-groups', location_slug), lambda: db_manager.get_all_age_groups(DB_PATH, location_slug))
+
+def list_years(location_slug):
+    return db_manager.load_race_years(DB_PATH, location_slug=location_slug)
+
+def list_race_dates(location_slug):
+    return db_manager.load_race_numbers(DB_PATH, location_slug=location_slug)
 
 @app.route('/api/years')
 def get_available_years():
     location_slug = request.args.get('location', default='korolev', type=str)
-    all_races = db_manager.load_all_results(DB_PATH, location_slug=location_slug)
-    years = {datetime.strptime(race['race_date'], '%d.%m.%Y').year for race in all_races if race.get('data')}
-    return jsonify(sorted(list(years), reverse=True))
+    return api_response(('years', location_slug), lambda: list_years(location_slug))
 
 @app.route('/api/racedates')
 def get_available_races():
     location_slug = request.args.get('location', default='korolev', type=str)
-    all_races = db_manager.load_all_results(DB_PATH, location_slug=location_slug)
-    races = [
-        {"number": race['race_number'], "date": race['race_date']}
-        for race in all_races if race.get('race_number') and race.get('race_number') > 0
-    ]
-    races.sort(key=lambda x: x['number'], reverse=True)
-    return jsonify(races)
+    return api_response(('racedates', location_slug), lambda: list_race_dates(location_slug))
+
+@app.route('/api/cache-stats')
+def get_cache_stats():
+    return jsonify(response_cache.stats())
+
+@app.route('/metrics')
+def get_metrics():
+    if not metrics.ENABLED:
+        return jsonify({"error": "Metrics are disabled, set VERST_METRICS_DIR to enable them."}), 404
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
 
 @app.route('/search')
 def search():
@@ -0,0 +1,275 @@
+"""Read-only columnar copy of the race archive, memory-mapped by every web worker.
+
+build() writes races, runs, volunteer shifts, participants and locations as flat arrays into
+one file next to the database and swaps it in atomically; main.py rebuilds it after every
+scrape. current() maps the file read-only, so all gunicorn workers share a single copy in the
+page cache, and arrays are read in place (memoryview casts, or numpy.frombuffer for the
+NumPy backend) with nothing to decode. A worker re-opens the file when a new one appears, and
+an archive is only used while its generation matches the database's: until it is rebuilt,
+filtered views are read from SQLite as before. VERST_ARCHIVE=0 turns it off.
+
+    python archive.py
+"""
+import array
+import mmap
+import os
+import struct
+import sys
+
+import db_manager
+
+DB_PATH = os.path.join(os.path.dirname(__file__), db_manager.DB_NAME)
+ENABLED = os.environ.get('VERST_ARCHIVE', '1') != '0'
+MAGIC = b'VERSTARC'
+# Bumped whenever the layout changes; files of other formats are ignored
+ARCHIVE_FORMAT = 1
+# magic, format, byte order (arrays are native), generation, section count
+HEADER = struct.Struct('<8sIIqI')
+# name, array typecode, offset, item count
+SECTION = struct.Struct('<24s1sxxxxxxxQQ')
+# Stands for NULL in integer columns
+NULL = -2 ** 31
+
+_opened = {}
+
+
+def archive_path(db_path):
+    return os.path.splitext(db_path)[0] + '.archive'
+
+
+class _Strings:
+    """Table of strings stored as one UTF-8 blob plus n + 1 offsets."""
+
+    def __init__(self, offsets, blob):
+        self.offsets = offsets
+        self.blob = blob
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        return str(self.blob[self.offsets[i]:self.offsets[i + 1]], 'utf-8')
+
+    def tolist(self):
+        return [self[i] for i in range(len(self))]
+
+
+class Archive:
+    """An opened archive file; arrays are memoryviews over the mapping."""
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self.mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, file_format, little_endian, self.generation, section_count = HEADER.unpack_from(self.mapping)
+        if magic != MAGIC or file_format != ARCHIVE_FORMAT or little_endian != (sys.byteorder == 'little'):
+            raise ValueError(f"{path} is not an archive of format {ARCHIVE_FORMAT} for this machine")
+        self.sections = {}
+        for i in range(section_count):
+            name, typecode, offset, count = SECTION.unpack_from(self.mapping, HEADER.size + i * SECTION.size)
+            name, typecode = name.rstrip(b'\0').decode(), typecode.decode()
+            size = array.array(typecode).itemsize
+            self.sections[name] = (typecode, offset, count)
+            setattr(self, name, memoryview(self.mapping)[offset:offset + count * size].cast(typecode))
+
+        self.locations = _Strings(self.location_offsets, self.location_bytes)
+        self.race_dates = _Strings(self.race_date_offsets, self.race_date_bytes)
+        self.names = _Strings(self.name_offsets, self.name_bytes)
+        self.strings = _Strings(self.string_offsets, self.string_bytes).tolist()
+        self.location_index = {slug: i for i, slug in enumerate(self.locations.tolist())}
+
+    def select_races(self, location_slug=None, year=None, season_year=None, months=None, month=None, race_number=None):
+        """Positions of the races load_all_results would return for these filters, in the same order."""
+        if location_slug and location_slug != db_manager.ALL_LOCATIONS:
+            location = self.location_index.get(location_slug)
+            if location is None:
+                return []
+            candidates = self.location_races[self.location_race_start[location]:self.location_race_start[location + 1]].tolist()
+        else:
+            candidates = range(self.race_count())
+        selected = []
+        for i in candidates:
+            if ((year is None or self.race_year[i] == year) and (season_year is None or self.race_season_year[i] == season_year)
+                    and (month is None or self.race_month[i] == month) and (months is None or self.race_month[i] in months)
+                    and (race_number is None or self.race_number[i] == race_number)):
+                selected.append(i)
+        return selected
+
+    def race_count(self):
+        return len(self.race_number)
+
+    def race(self, i):
+        """(race_number, race_date, location_slug) of a race, as iter_race_rows yields it."""
+        number = self.race_number[i]
+        return None if number == NULL else number, self.race_dates[i], self.locations[self.race_location[i]]
+
+    def name(self, participant):
+        return self.names[participant] if participant >= 0 else None
+
+    def iter_race_rows(self, location_slug=None, **filters):
+        """Same tuples as db_manager.iter_race_rows, read from the archive."""
+        strings = self.strings + [None]
+        for i in self.select_races(location_slug, **filters):
+            start, end = self.race_run_start[i], self.race_run_start[i + 1]
+            runners = [
+                (runner_id or None, self.name(participant) if runner_id else db_manager.UNKNOWN_RUNNER_NAME,
+                 None if score != score else score, None if time == NULL else time, strings[gender], strings[age_group],
+                 None if overall_rank == NULL else overall_rank, None if gender_rank == NULL else gender_rank)
+                for runner_id, participant, score, time, gender, age_group, overall_rank, gender_rank in zip(
+                    self.run_runner[start:end].tolist(), self.run_participant[start:end].tolist(),
+                    self.run_score[start:end].tolist(), self.run_time[start:end].tolist(),
+                    self.run_gender[start:end].tolist(), self.run_age_group[start:end].tolist(),
+                    self.run_overall_rank[start:end].tolist(), self.run_gender_rank[start:end].tolist())
+            ]
+            start, end = self.race_volunteer_start[i], self.race_volunteer_start[i + 1]
+            volunteers = [(volunteer_id, self.name(participant)) for volunteer_id, participant in zip(
+                self.volunteer_id[start:end].tolist(), self.volunteer_participant[start:end].tolist())]
+            yield self.race(i), runners, volunteers
+
+
+def current(db_path):
+    """The archive of db_path if it exists and is up to date with the database, otherwise None."""
+    if not ENABLED:
+        return None
+    path = archive_path(db_path)
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    key = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+    opened = _opened.get(path)
+    if opened is None or opened[0] != key:
+        # A replaced file stays mapped for whoever still reads the old archive
+        try:
+            opened = _opened[path] = (key, Archive(path))
+        except (OSError, ValueError) as e:
+            print(f"Warning: Could not open archive {path}: {e}")
+            opened = _opened[path] = (key, None)
+    archive = opened[1]
+    if archive is None or archive.generation != db_manager.get_generation(db_path):
+        return None
+    return archive
+
+
+def is_current(db_path):
+    """Whether the archive file of db_path is stamped with the database's generation, i.e. needs no rebuild.
+
+    Only reads the header, and does not depend on VERST_ARCHIVE.
+    """
+    try:
+        with open(archive_path(db_path), 'rb') as f:
+            magic, file_format, little_endian, generation, _ = HEADER.unpack(f.read(HEADER.size))
+    except (OSError, struct.error):
+        return False
+    return (magic == MAGIC and file_format == ARCHIVE_FORMAT and little_endian == (sys.byteorder == 'little')
+            and generation == db_manager.get_generation(db_path))
+
+
+def _string_table(values):
+    blobs = [value.encode('utf-8') for value in values]
+    offsets = array.array('q', [0])
+    for blob in blobs:
+        offsets.append(offsets[-1] + len(blob))
+    return offsets, array.array('B', b''.join(blobs))
+
+def _code(codes, value):
+    if value is None:
+        return -1
+    return codes.setdefault(value, len(codes))
+
+def _int(value):
+    return NULL if value is None else value
+
+
+def build(db_path):
+    """Writes the archive of db_path from one consistent read; returns (races, runs, volunteer shifts)."""
+    conn = db_manager.get_connection(db_path)
+    cursor = conn.cursor()
+    columns = {name: array.array(typecode) for name, typecode in (
+        ('race_location', 'i'), ('race_number', 'i'), ('race_year', 'i'), ('race_month', 'i'), ('race_season_year', 'i'),
+        ('race_run_start', 'q'), ('race_volunteer_start', 'q'),
+        ('run_runner', 'q'), ('run_participant', 'i'), ('run_score', 'd'), ('run_time', 'i'), ('run_gender', 'h'),
+        ('run_age_group', 'h'), ('run_overall_rank', 'i'), ('run_gender_rank', 'i'),
+        ('volunteer_id', 'q'), ('volunteer_participant', 'i'), ('participant_id', 'q'),
+    )}
+    string_codes = {}
+    # A read transaction, so the archive matches the generation it is stamped with
+    cursor.execute('BEGIN')
+    try:
+        generation = db_manager.get_generation(db_path)
+        participants = cursor.execute('SELECT id, name FROM participants ORDER BY id').fetchall()
+        participant_index = {participant_id: i for i, (participant_id, _) in enumerate(participants)}
+        columns['participant_id'].extend(participant_id for participant_id, _ in participants)
+        names = [name or '' for _, name in participants]
+        del participants
+
+        # The order load_all_results returns races in
+        races = cursor.execute('''
+            SELECT id, race_date, race_number, location_slug, year, month, season_year FROM race_results
+            WHERE data IS NOT NULL ORDER BY race_date DESC, location_slug DESC
+        ''').fetchall()
+        locations = sorted({race[3] for race in races})
+        location_index = {slug: i for i, slug in enumerate(locations)}
+        location_races = [[] for _ in locations]
+        columns['race_run_start'].append(0)
+        columns['race_volunteer_start'].append(0)
+        for position, (race_id, race_date, race_number, slug, year, month, season_year) in enumerate(races):
+            location_races[location_index[slug]].append(position)
+            for name, value in (('race_location', location_index[slug]), ('race_number', _int(race_number)),
+                                ('race_year', _int(year)), ('race_month', _int(month)), ('race_season_year', _int(season_year))):
+                columns[name].append(value)
+
+            cursor.execute('''
+                SELECT runner_id, score, time_in_seconds, gender, age_group, overall_rank, gender_rank
+                FROM runs WHERE race_id = ? ORDER BY overall_rank, rowid
+            ''', (race_id,))
+            for runner_id, score, time, gender, age_group, overall_rank, gender_rank in cursor:
+                columns['run_runner'].append(runner_id or 0)
+                columns['run_participant'].append(participant_index.get(runner_id, -1))
+                columns['run_score'].append(float('nan') if score is None else score)
+                columns['run_time'].append(_int(time))
+                columns['run_gender'].append(_code(string_codes, gender))
+                columns['run_age_group'].append(_code(string_codes, age_group))
+                columns['run_overall_rank'].append(_int(overall_rank))
+                columns['run_gender_rank'].append(_int(gender_rank))
+            cursor.execute('SELECT volunteer_id FROM volunteering WHERE race_id = ? ORDER BY rowid', (race_id,))
+            for volunteer_id, in cursor:
+                columns['volunteer_id'].append(volunteer_id)
+                columns['volunteer_participant'].append(participant_index.get(volunteer_id, -1))
+            columns['race_run_start'].append(len(columns['run_runner']))
+            columns['race_volunteer_start'].append(len(columns['volunteer_id']))
+    finally:
+        conn.rollback()
+
+    columns['location_race_start'] = array.array('q', [0])
+    columns['location_races'] = array.array('i')
+    for positions in location_races:
+        columns['location_races'].extend(positions)
+        columns['location_race_start'].append(len(columns['location_races']))
+    for prefix, values in (('location', locations), ('race_date', [race[1] for race in races]), ('name', names),
+                           ('string', list(string_codes))):
+        columns[f'{prefix}_offsets'], columns[f'{prefix}_bytes'] = _string_table(values)
+
+    path = archive_path(db_path)
+    with open(f'{path}.tmp', 'wb') as f:
+        f.write(HEADER.pack(MAGIC, ARCHIVE_FORMAT, sys.byteorder == 'little', generation, len(columns)))
+        offset = HEADER.size + SECTION.size * len(columns)
+        for name, values in columns.items():
+            # Every array starts 8-byte aligned
+            offset += -offset % 8
+            f.write(SECTION.pack(name.encode(), values.typecode.encode(), offset, len(values)))
+            offset += len(values) * values.itemsize
+        for values in columns.values():
+            f.write(b'\0' * (-f.tell() % 8))
+            values.tofile(f)
+        f.flush()
+        os.fsync(f.fileno())
+    # Workers still reading the old file keep their mapping; new requests open this one
+    os.replace(f'{path}.tmp', path)
+    return len(races), len(columns['run_runner']), len(columns['volunteer_id'])
+
+
+if __name__ == '__main__':
+    db_manager.init_db(DB_PATH)
+    races, runs, shifts = build(DB_PATH)
+    print(f"Архив записан: {races} забегов, {runs} результатов, {shifts} волонтерских смен "
+          f"({os.path.getsize(archive_path(DB_PATH)) / 1e6:.1f} МБ).")
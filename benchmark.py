@@ -0,0 +1,459 @@
+"""Reproducible benchmarks of the site and the scraper on a synthetic 5verst-scale database.
+
+    python benchmark.py --generate [--db=benchmark.db] [--seed=1] [--locations=190] [--races=200]
+                        [--min-runners=50] [--max-runners=500] [--html-dir=DIR --html-base-url=URL]
+    python benchmark.py [--db=benchmark.db] [--repeat=30] [--parse-pages=50] [--save-races=200] [--output=FILE]
+    python benchmark.py --compare=OLD.json NEW.json
+    python benchmark.py --serve=DIR [--port=8000]
+
+--generate fills the database through save_results_batch, as main.py does, and builds the
+leaderboard snapshots and the archive afterwards. With --html-dir it also writes the events
+page, race lists and results pages of every race; --serve serves them so that main.py can scrape them in place of
+5verst.ru (with VERST_BASE_URL and --html-base-url both set to http://127.0.0.1:PORT).
+
+A run times the API endpoints with the response cache disabled, the search paths, the lookup
+tables, both results parsers and save throughput (on a throwaway copy of the database), and
+reports latency percentiles and peak traced memory per case. The JSON output of two runs can
+be compared with --compare.
+"""
+import itertools
+import json
+import math
+import os
+import platform
+import random
+import resource
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import date, datetime, timedelta
+from functools import partial
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+
+import aggregation
+import archive
+import db_manager
+import main
+import results_parser
+import snapshots
+from main import get_option
+
+FIRST_PARTICIPANT_ID = 100000
+LAST_RACE_DATE = date(2024, 12, 28)
+FIRST_NAMES = {
+    'М': ['Александр', 'Алексей', 'Андрей', 'Артём', 'Дмитрий', 'Евгений', 'Иван', 'Илья', 'Кирилл', 'Максим',
+          'Михаил', 'Никита', 'Николай', 'Олег', 'Павел', 'Роман', 'Сергей', 'Владимир', 'Юрий', 'Ярослав'],
+    'Ж': ['Анастасия', 'Анна', 'Валентина', 'Дарья', 'Екатерина', 'Елена', 'Ирина', 'Ксения', 'Мария', 'Марина',
+          'Наталья', 'Ольга', 'Полина', 'Светлана', 'Софья', 'Татьяна', 'Ульяна', 'Юлия', 'Яна', 'Вера'],
+}
+LAST_NAMES = ['ИВАНОВ', 'СМИРНОВ', 'КУЗНЕЦОВ', 'ПОПОВ', 'ВАСИЛЬЕВ', 'ПЕТРОВ', 'СОКОЛОВ', 'МИХАЙЛОВ', 'НОВИКОВ',
+              'ФЕДОРОВ', 'МОРОЗОВ', 'ВОЛКОВ', 'АЛЕКСЕЕВ', 'ЛЕБЕДЕВ', 'СЕМЕНОВ', 'ЕГОРОВ', 'ПАВЛОВ', 'КОЗЛОВ',
+              'СТЕПАНОВ', 'НИКОЛАЕВ', 'ОРЛОВ', 'АНДРЕЕВ', 'МАКАРОВ', 'НИКИТИН', 'ЗАХАРОВ', 'ЗАЙЦЕВ', 'СОЛОВЬЕВ',
+              'БОРИСОВ', 'ЯКОВЛЕВ', 'ГРИГОРЬЕВ', 'РОМАНОВ', 'ВОРОБЬЕВ', 'СЕРГЕЕВ', 'КУЗЬМИН', 'ФРОЛОВ']
+AGE_GROUPS = ['10-14', '15-17', '18-19', '20-24', '25-29', '30-34', '35-39', '40-44', '45-49',
+              '50-54', '55-59', '60-64', '65-69', '70-74', '75-79']
+# Share of finishers without a barcode, i.e. without an id, and of runners from other locations
+UNKNOWN_RUNNER_SHARE = 0.02
+TOURIST_SHARE = 0.05
+
+
+class SyntheticArchive:
+    """Seeded model of the 5 вёрст archive: locations, their regulars, races and results.
+
+    The same seed and sizes always produce the same races, with results shaped exactly as
+    results_parser returns them for the pages render_results_page writes.
+    """
+
+    def __init__(self, seed=1, locations=190, races=200, min_runners=50, max_runners=500):
+        self.rng = random.Random(seed)
+        self.race_count = races
+        self.min_runners = min_runners
+        self.max_runners = max_runners
+        self.names, self.genders, self.age_groups, self.paces = [], [], [], []
+        self.locations = []
+        for index in range(locations):
+            turnout = self.rng.randint(min_runners, max_runners)
+            # Regulars of a location are about four times its usual turnout
+            first = FIRST_PARTICIPANT_ID + len(self.names)
+            for _ in range(turnout * 4):
+                self._add_participant()
+            slug = f'park{index + 1:03d}'
+            self.locations.append({'slug': slug, 'name': f'Парк {index + 1}', 'turnout': turnout,
+                                   'regulars': range(first, FIRST_PARTICIPANT_ID + len(self.names))})
+
+    def _add_participant(self):
+        rng = self.rng
+        gender = 'М' if rng.random() < 0.55 else 'Ж'
+        last_name = rng.choice(LAST_NAMES) + ('А' if gender == 'Ж' else '')
+        self.names.append(f'{rng.choice(FIRST_NAMES[gender])} {last_name}')
+        self.genders.append(gender)
+        age_index = rng.randrange(len(AGE_GROUPS))
+        self.age_groups.append(AGE_GROUPS[age_index])
+        # Usual 5 km time in seconds: slower with age and for women, with a wide spread
+        base = rng.uniform(1080, 2400) * (1.12 if gender == 'Ж' else 1.0)
+        self.paces.append(base * (1 + 0.015 * abs(age_index - 5)))
+
+    def participant(self, participant_id):
+        i = participant_id - FIRST_PARTICIPANT_ID
+        return self.names[i], self.genders[i], self.age_groups[i], self.paces[i]
+
+    def race_dates(self, location):
+        """(race_number, race_date) of every race of a location, one Saturday after another."""
+        count = max(1, round(self.race_count * self.rng.uniform(0.5, 1.5)))
+        last = LAST_RACE_DATE - timedelta(weeks=self.rng.randint(0, 2))
+        return [(k + 1, (last - timedelta(weeks=count - 1 - k)).strftime('%d.%m.%Y')) for k in range(count)]
+
+    def make_race(self, location):
+        """Results of one race at a location, as {'runners', 'volunteers'}."""
+        rng = self.rng
+        size = min(self.max_runners, max(self.min_runners, round(location['turnout'] * rng.uniform(0.6, 1.4))))
+        tourists = sum(rng.random() < TOURIST_SHARE for _ in range(size))
+        ids = set(rng.sample(location['regulars'], min(size - tourists, len(location['regulars']))))
+        ids.update(rng.randrange(FIRST_PARTICIPANT_ID, FIRST_PARTICIPANT_ID + len(self.names)) for _ in range(tourists))
+
+        finishers = []
+        for participant_id in sorted(ids):
+            name, gender, age_group, pace = self.participant(participant_id)
+            time_in_seconds = int(pace * rng.uniform(0.95, 1.1))
+            if rng.random() < UNKNOWN_RUNNER_SHARE:
+                finishers.append((time_in_seconds, None, db_manager.UNKNOWN_RUNNER_NAME, 'Н/Д', None, 0.0))
+            else:
+                # Roughly an age grade: the faster for the gender and age, the higher
+                record = 840 if gender == 'М' else 930
+                score = round(min(99.99, 100 * record * (1 + 0.01 * AGE_GROUPS.index(age_group)) / time_in_seconds), 2)
+                finishers.append((time_in_seconds, participant_id, name, gender, age_group, score))
+        finishers.sort(key=lambda finisher: finisher[0])
+
+        runners, women = [], 0
+        for rank, (time_in_seconds, participant_id, name, gender, age_group, score) in enumerate(finishers, 1):
+            runner = {'id': participant_id, 'name': name, 'score': score, 'time_in_seconds': time_in_seconds,
+                      'gender': gender, 'age_group': age_group, 'overall_rank': rank}
+            if gender == 'Ж':
+                women += 1
+                runner['gender_rank'] = women
+            runners.append(runner)
+
+        volunteer_ids = rng.sample(location['regulars'], min(rng.randint(5, 15), len(location['regulars'])))
+        volunteers = [{'id': volunteer_id, 'name': self.participant(volunteer_id)[0]} for volunteer_id in volunteer_ids]
+        return {'runners': runners, 'volunteers': volunteers}
+
+
+def format_time(seconds):
+    return f'{seconds // 3600:02d}:{seconds % 3600 // 60:02d}:{seconds % 60:02d}'
+
+def render_results_page(results, base_url='https://5verst.ru'):
+    """A results page in the markup of 5verst.ru, as far as results_parser looks at it."""
+    rows = []
+    for runner in results['runners']:
+        if runner['id']:
+            name = f'<a href="{base_url}/userstats/{runner["id"]}">{runner["name"]}</a><div class="club">Клуб любителей бега</div>'
+            age_grade = f'{runner["gender"]}{runner["age_group"] or ""} <span class="age-grade">{runner["score"]:.2f}%</span>'
+        else:
+            name, age_grade = runner['name'], ''
+        rows.append(f'<tr><td>{runner["overall_rank"]}</td><td>{name}</td><td>{age_grade}</td>'
+                    f'<td>{format_time(runner["time_in_seconds"])}</td><td><span class="badge">10</span></td></tr>')
+    volunteers = ''.join(f'<tr><td><a href="{base_url}/userstats/{volunteer["id"]}">{volunteer["name"]}</a></td><td>Секундомер</td></tr>'
+                         for volunteer in results['volunteers'])
+    return ('<!DOCTYPE html><html lang="ru"><head><meta charset="utf-8"><title>Результаты</title></head><body>'
+            '<table class="results"><thead><tr><th>#</th><th>Участник</th><th>Возрастной рейтинг</th><th>Время</th><th>Достижения</th></tr></thead>'
+            f'<tbody>{"".join(rows)}</tbody></table>'
+            f'<table class="volunteers"><thead><tr><th>Волонтёр</th><th>Роль</th></tr></thead><tbody>{volunteers}</tbody></table>'
+            '</body></html>')
+
+def write_page(html_dir, path, html):
+    directory = os.path.join(html_dir, path)
+    os.makedirs(directory, exist_ok=True)
+    with open(os.path.join(directory, 'index.html'), 'w', encoding='utf-8') as f:
+        f.write(html)
+
+def generate(db_path, seed=1, locations=190, races=200, min_runners=50, max_runners=500, html_dir=None, base_url=None):
+    """Fills db_path with a synthetic archive; returns (races, runners) written."""
+    archive = SyntheticArchive(seed, locations, races, min_runners, max_runners)
+    base_url = (base_url or 'https://5verst.ru').rstrip('/')
+    db_manager.init_db(db_path)
+    db_manager.save_locations(db_path, [{'slug': loc['slug'], 'name': loc['name'], 'url': f"{base_url}/{loc['slug']}/"}
+                                        for loc in archive.locations])
+    if html_dir:
+        links = ''.join(f'<a href="{base_url}/{loc["slug"]}/">{loc["name"]}</a>' for loc in archive.locations)
+        write_page(html_dir, 'events', f'<html><body><div class="events-columns">{links}</div></body></html>')
+
+    race_total = runner_total = 0
+    for loc in archive.locations:
+        batch, history = [], []
+        for race_number, race_date in archive.race_dates(loc):
+            results = archive.make_race(loc)
+            batch.append((race_date, loc['slug'], race_number, results))
+            runner_total += len(results['runners'])
+            if html_dir:
+                write_page(html_dir, f"{loc['slug']}/results/{race_date}", render_results_page(results, base_url))
+                history.append(f'<tr><td>{race_number}</td><td><a href="{base_url}/{loc["slug"]}/results/{race_date}/">{race_date}</a></td></tr>')
+            if len(batch) >= main.FLUSH_SIZE:
+                db_manager.save_results_batch(db_path, batch)
+                race_total += len(batch)
+                batch = []
+        if batch:
+            db_manager.save_results_batch(db_path, batch)
+            race_total += len(batch)
+        if html_dir:
+            write_page(html_dir, f"{loc['slug']}/results/all",
+                       f'<html><body><table><thead><tr><th>#</th><th>Дата</th></tr></thead><tbody>{"".join(reversed(history))}</tbody></table></body></html>')
+        print(f"  - {loc['slug']}: всего {race_total} забегов, {runner_total} результатов")
+    return race_total, runner_total
+
+
+class PageHandler(SimpleHTTPRequestHandler):
+    """Serves the generated pages as UTF-8, like 5verst.ru; requests would guess Latin-1 otherwise."""
+    extensions_map = {**SimpleHTTPRequestHandler.extensions_map, '.html': 'text/html; charset=utf-8'}
+
+    def log_message(self, format, *args):
+        pass
+
+def serve(html_dir, port):
+    server = ThreadingHTTPServer(('127.0.0.1', port), partial(PageHandler, directory=html_dir))
+    print(f"Страницы из {html_dir} доступны на http://127.0.0.1:{port}/")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+def percentile(sorted_values, p):
+    """Nearest-rank percentile of an already sorted list."""
+    return sorted_values[max(0, math.ceil(p / 100 * len(sorted_values)) - 1)]
+
+def measure(fn, repeat):
+    """Times `repeat` calls of fn after one warm-up call, then traces the peak memory of one more."""
+    fn()
+    seconds = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        seconds.append(time.perf_counter() - start)
+    tracemalloc.start()
+    try:
+        fn()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    seconds.sort()
+    ms = lambda value: round(value * 1000, 3)
+    return {
+        'runs': repeat, 'mean_ms': ms(sum(seconds) / repeat), 'min_ms': ms(seconds[0]),
+        'p50_ms': ms(percentile(seconds, 50)), 'p95_ms': ms(percentile(seconds, 95)),
+        'p99_ms': ms(percentile(seconds, 99)), 'max_ms': ms(seconds[-1]), 'peak_kib': peak // 1024,
+    }
+
+def database_summary(db_path):
+    cursor = db_manager.get_connection(db_path).cursor()
+    counts = {table: cursor.execute(f'SELECT COUNT(*) FROM {table}').fetchone()[0]
+              for table in ('locations', 'race_results', 'runs', 'volunteering', 'participants', 'leaderboard_snapshots')}
+    counts['size_bytes'] = os.path.getsize(db_path)
+    counts['race_data_bytes'] = cursor.execute('SELECT IFNULL(SUM(length(data)), 0) FROM race_results').fetchone()[0]
+    return counts
+
+def pick_views(db_path):
+    """Deterministic parameters of the benchmarked views: the busiest location, its latest year and month,
+    its most common age group, the most active participant and a frequent surname."""
+    cursor = db_manager.get_connection(db_path).cursor()
+    slug = cursor.execute('''
+        SELECT location_slug FROM race_results GROUP BY location_slug ORDER BY SUM(runner_count) DESC, location_slug LIMIT 1
+    ''').fetchone()[0]
+    year, month = cursor.execute('''
+        SELECT year, month FROM race_results WHERE location_slug = ? ORDER BY race_date_iso DESC LIMIT 1
+    ''', (slug,)).fetchone()
+    gender, age_group = cursor.execute('''
+        SELECT gender, age_group FROM age_groups WHERE location_slug = ? ORDER BY run_count DESC LIMIT 1
+    ''', (slug,)).fetchone()
+    runner_id = cursor.execute('''
+        SELECT participant_id FROM participant_stats WHERE location_slug = ? ORDER BY run_count DESC, participant_id LIMIT 1
+    ''', (db_manager.ALL_LOCATIONS,)).fetchone()[0]
+    surname = cursor.execute('SELECT name FROM participants WHERE id = ?', (runner_id,)).fetchone()[0].split()[-1]
+    return {'location': slug, 'year': year, 'month': month, 'ag': f'{gender}{age_group}', 'runner_id': runner_id,
+            'surname': surname.casefold()}
+
+def sample_races(db_path, count):
+    """Stored results of `count` races spread over the archive, with their location and date."""
+    cursor = db_manager.get_connection(db_path).cursor()
+    rows = cursor.execute('SELECT race_date, location_slug FROM race_results WHERE data IS NOT NULL ORDER BY id').fetchall()
+    step = max(1, len(rows) // count)
+    return [(slug, race_date, db_manager.load_results(db_path, race_date, slug)) for race_date, slug in rows[::step][:count]]
+
+def run_benchmarks(db_path, repeat=30, parse_pages=50, save_races=200):
+    """Runs every benchmark case against db_path; returns {case: measurements}."""
+    # app reads its database path when imported
+    os.environ['VERST_DB_PATH'] = db_path
+    import app
+    # Every request computes its response; the LRU would otherwise answer all but the first
+    app.response_cache = app.ResponseCache(max_entries=0)
+    client = app.app.test_client()
+    views = pick_views(db_path)
+    loc, ag = views['location'], views['ag']
+    results = {}
+
+    def endpoint(name, url):
+        sizes = []
+
+        def request():
+            response = client.get(url)
+            if response.status_code != 200:
+                raise RuntimeError(f'{url}: HTTP {response.status_code}')
+            sizes.append(len(response.get_data()))
+
+        print(f"  - {name}: {url}")
+        results[name] = dict(measure(request, repeat), url=url, response_bytes=sizes[-1])
+
+    def function(name, fn, repeat=repeat, **extra):
+        print(f"  - {name}")
+        results[name] = dict(measure(fn, repeat), **extra)
+
+    endpoint('api_data_location', f'/api/data?location={loc}')
+    endpoint('api_data_location_page', f'/api/data?location={loc}&sort=score&limit=100')
+    endpoint('api_data_all', '/api/data?location=all')
+    endpoint('api_data_all_age_group', f'/api/data?location=all&ag={ag}')
+    endpoint('api_data_age_group', f'/api/data?location={loc}&ag={ag}')
+    endpoint('api_data_year', f"/api/data?location={loc}&year={views['year']}")
+    # A month is not among the materialized views, so this one aggregates on every request
+    endpoint('api_data_month', f"/api/data?location={loc}&year={views['year']}&month={views['month']}")
+    endpoint('api_data_all_month', f"/api/data?location=all&year={views['year']}&month={views['month']}")
+    # The same view read from SQLite rather than the memory-mapped archive
+    enabled, archive.ENABLED = archive.ENABLED, False
+    endpoint('api_data_all_month_sqlite', f"/api/data?location=all&year={views['year']}&month={views['month']}")
+    archive.ENABLED = enabled
+    endpoint('api_data_month_age_group', f"/api/data?location={loc}&year={views['year']}&month={views['month']}&ag={ag}")
+    endpoint('api_runner', f"/api/runner/{views['runner_id']}")
+    endpoint('api_global_search', f"/api/global-search?query={views['surname']}")
+    endpoint('search_page', f"/search?query={views['surname']}")
+
+    # Words of three letters and more go through the trigram index, shorter ones scan participants
+    function('search_runners_index', lambda: db_manager.search_runners(db_path, views['surname']), query=views['surname'])
+    function('search_runners_scan', lambda: db_manager.search_runners(db_path, views['surname'][:2]), query=views['surname'][:2])
+    function('get_all_age_groups', lambda: db_manager.get_all_age_groups(db_path))
+    function('get_all_age_groups_location', lambda: db_manager.get_all_age_groups(db_path, loc))
+
+    races = sample_races(db_path, parse_pages)
+    pages = [render_results_page(race) for _, _, race in races]
+    mismatched = sum(results_parser.parse_results(page) != race for page, (_, _, race) in zip(pages, races))
+    if mismatched:
+        print(f"Внимание: {mismatched} из {len(pages)} страниц разобраны не так, как сохранены.")
+    for parser_name, parse in results_parser.PARSERS.items():
+        page_iter = itertools.cycle(pages)
+        function(f'parse_results_{parser_name}', lambda: parse(next(page_iter)), repeat=len(pages),
+                 pages=len(pages), mean_page_bytes=sum(map(len, pages)) // len(pages))
+
+    # Stored race results: the JSON text of earlier versions against the compact format
+    for format_name, encode in (('json', json.dumps), ('compact', db_manager.encode_results)):
+        encoded = [encode(race) for _, _, race in races]
+        blob_iter = itertools.cycle(encoded)
+        function(f'decode_results_{format_name}', lambda: db_manager.decode_results(next(blob_iter)), repeat=len(encoded),
+                 races=len(encoded), mean_bytes=sum(len(blob.encode('utf-8') if isinstance(blob, str) else blob) for blob in encoded) // len(encoded))
+
+    results['save_results_batch'] = measure_saves(db_path, races, save_races)
+    return results, views
+
+def measure_saves(db_path, races, count):
+    """Throughput of save_results_batch: the sampled races saved again under new dates, into a copy of the database."""
+    work_dir = tempfile.mkdtemp(prefix='verst-benchmark-')
+    copy_path = os.path.join(work_dir, db_manager.DB_NAME)
+    try:
+        source = sqlite3.connect(db_path)
+        target = sqlite3.connect(copy_path)
+        source.backup(target)
+        source.close()
+        target.close()
+
+        # New races are a week after the archive ends, one more week per round through the sample.
+        # Two extra batches go to the untimed warm-up and memory trace of measure()
+        batch_count = math.ceil(count / main.FLUSH_SIZE) + 2
+        new_races = []
+        for i in range(batch_count * main.FLUSH_SIZE):
+            slug, _, results = races[i % len(races)]
+            race_date = (LAST_RACE_DATE + timedelta(weeks=1 + i // len(races))).strftime('%d.%m.%Y')
+            new_races.append((race_date, slug, 10000 + i, results))
+        batches = [new_races[i:i + main.FLUSH_SIZE] for i in range(0, len(new_races), main.FLUSH_SIZE)]
+        timed = batches[1:-1]
+        runners = sum(len(results['runners']) for batch in timed for _, _, _, results in batch)
+        print(f"  - save_results_batch: {len(timed) * main.FLUSH_SIZE} забегов пачками по {main.FLUSH_SIZE}")
+        batch_iter = iter(batches)
+        stats = measure(lambda: db_manager.save_results_batch(copy_path, next(batch_iter)), len(timed))
+        seconds = stats['mean_ms'] * stats['runs'] / 1000
+        stats.update(races=len(timed) * main.FLUSH_SIZE, batch_size=main.FLUSH_SIZE,
+                     races_per_second=round(len(timed) * main.FLUSH_SIZE / seconds, 1),
+                     runners_per_second=round(runners / seconds))
+        return stats
+    finally:
+        db_manager.close_connection(copy_path)
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare(old_path, new_path):
+    """Prints the median and p95 of every case present in both runs, with the relative change."""
+    with open(old_path, encoding='utf-8') as f:
+        old = json.load(f)['results']
+    with open(new_path, encoding='utf-8') as f:
+        new = json.load(f)['results']
+    print(f"{'case':32} {'p50 old':>10} {'p50 new':>10} {'change':>8} {'p95 old':>10} {'p95 new':>10}")
+    for case in old:
+        if case in new:
+            a, b = old[case], new[case]
+            change = (b['p50_ms'] - a['p50_ms']) / a['p50_ms'] * 100 if a['p50_ms'] else 0.0
+            print(f"{case:32} {a['p50_ms']:10.2f} {b['p50_ms']:10.2f} {change:+7.1f}% {a['p95_ms']:10.2f} {b['p95_ms']:10.2f}")
+
+
+if __name__ == '__main__':
+    db_path = get_option('db', 'benchmark.db')
+    if get_option('compare', None):
+        new_paths = [arg for arg in sys.argv[1:] if not arg.startswith('--')]
+        if not new_paths:
+            print("Укажите второй файл: python benchmark.py --compare=OLD.json NEW.json")
+            sys.exit(1)
+        compare(get_option('compare', None), new_paths[0])
+    elif get_option('serve', None):
+        serve(get_option('serve', None), get_option('port', 8000, int))
+    elif '--generate' in sys.argv:
+        if os.path.exists(db_path):
+            print(f"Ошибка: {db_path} уже существует.")
+            sys.exit(1)
+        start = time.perf_counter()
+        race_count, runner_count = generate(
+            db_path, seed=get_option('seed', 1, int), locations=get_option('locations', 190, int),
+            races=get_option('races', 200, int), min_runners=get_option('min-runners', 50, int),
+            max_runners=get_option('max-runners', 500, int), html_dir=get_option('html-dir', None),
+            base_url=get_option('html-base-url', None),
+        )
+        print(f"Сохранено {race_count} забегов, {runner_count} результатов за {time.perf_counter() - start:.0f} с.")
+        print(f"Готовых рейтингов построено: {snapshots.build_snapshots(db_path)}.")
+        archive.build(db_path)
+    else:
+        if not os.path.exists(db_path):
+            print(f"Ошибка: {db_path} не найден, сначала запустите python benchmark.py --generate.")
+            sys.exit(1)
+        db_manager.init_db(db_path)
+        results, views = run_benchmarks(db_path, repeat=get_option('repeat', 30, int),
+                                        parse_pages=get_option('parse-pages', 50, int),
+                                        save_races=get_option('save-races', 200, int))
+        report = {
+            'meta': {
+                'started_at': datetime.now().isoformat(timespec='seconds'), 'revision': git_revision(),
+                'python': platform.python_version(), 'sqlite': sqlite3.sqlite_version, 'platform': platform.platform(),
+                'aggregation': aggregation.BACKEND, 'database': database_summary(db_path), 'views': views,
+                'max_rss_kib': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            },
+            'results': results,
+        }
+        output = get_option('output', f"benchmark-{datetime.now():%Y%m%d-%H%M%S}.json")
+        with open(output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"{'case':32} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'peak KiB':>9}")
+        for case, stats in results.items():
+            print(f"{case:32} {stats['p50_ms']:9.2f} {stats['p95_ms']:9.2f} {stats['p99_ms']:9.2f} {stats['peak_kib']:9}")
+        print(f"Результаты записаны в {output}.")
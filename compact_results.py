@@ -0,0 +1,24 @@
+"""Rewrites race results stored as JSON text in the compact format new saves use.
+
+Safe to run while the site and the scraper are working; an interrupted run continues where
+it stopped. The freed pages are reused by SQLite but the file only shrinks after VACUUM,
+which locks the database for its duration:
+
+    python compact_results.py [--vacuum]
+"""
+import os
+import sys
+
+import db_manager
+
+DB_PATH = os.path.join(os.path.dirname(__file__), db_manager.DB_NAME)
+
+
+if __name__ == '__main__':
+    db_manager.init_db(DB_PATH)
+    size = os.path.getsize(DB_PATH)
+    converted, before, after = db_manager.compact_results(DB_PATH)
+    print(f"Переписано забегов: {converted}, {before / 1e6:.1f} МБ -> {after / 1e6:.1f} МБ.")
+    if '--vacuum' in sys.argv:
+        db_manager.get_connection(DB_PATH).execute('VACUUM')
+        print(f"Размер базы: {size / 1e6:.1f} МБ -> {os.path.getsize(DB_PATH) / 1e6:.1f} МБ.")
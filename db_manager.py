@@ -1,19 +1,104 @@
 import sqlite3
 import json
+import os
+import threading
+import zlib
+from contextlib import contextmanager
+from datetime import datetime
+
+import metrics
 
 DB_NAME = 'race_data.db'
+BUSY_TIMEOUT_MS = 30000
+SCHEMA_VERSION = 7
+ALL_LOCATIONS = 'all'
+UNKNOWN_RUNNER_NAME = 'Неизвестный'
+SEARCH_LIMIT = 100
+# Bumped whenever the stored snapshot payload changes shape; rows of other formats are ignored
+SNAPSHOT_FORMAT = 1
+# First byte of a compact race_results.data blob (see encode_results). Rows written by earlier
+# versions still hold JSON text and are decoded as such; databases created before the column
+# was declared BLOB keep the TEXT declaration, which stores blobs unchanged all the same
+RESULTS_FORMAT = 1
+# participant_stats.total_score is rounded to this many decimals whenever it changes, so totals kept up
+# incrementally stay equal to a full recompute instead of drifting by float error
+SCORE_DIGITS = 6
+
+def _date_columns(race_date):
+    """(race_date_iso, year, month, season_year) of a dd.mm.yyyy date; December counts towards next year's winter."""
+    try:
+        parsed = datetime.strptime(race_date, '%d.%m.%Y')
+    except (ValueError, TypeError):
+        return None, None, None, None
+    return parsed.strftime('%Y-%m-%d'), parsed.year, parsed.month, parsed.year + 1 if parsed.month == 12 else parsed.year
+
+def _casefold(value):
+    return value.casefold() if value is not None else None
+
+_local = threading.local()
+
+def get_connection(db_path):
+    """Returns this thread's connection to db_path, opening and tuning it on first use.
+
+    Connections are kept per thread and per process, so forked gunicorn workers and the
+    scraper threads never share one.
+    """
+    connections = getattr(_local, 'connections', None)
+    if connections is None:
+        connections = _local.connections = {}
+    key = (db_path, os.getpid())
+    conn = connections.get(key)
+    if conn is None:
+        conn = sqlite3.connect(db_path, timeout=BUSY_TIMEOUT_MS / 1000)
+        conn.execute(f'PRAGMA busy_timeout = {BUSY_TIMEOUT_MS}')
+        conn.execute('PRAGMA synchronous = NORMAL')
+        conn.execute('PRAGMA cache_size = -65536')
+        conn.execute('PRAGMA mmap_size = 268435456')
+        conn.execute('PRAGMA temp_store = MEMORY')
+        conn.create_function('casefold', 1, _casefold, deterministic=True)
+        connections[key] = conn
+    return conn
+
+def close_connection(db_path):
+    """Closes this thread's connection to db_path, if any."""
+    conn = getattr(_local, 'connections', {}).pop((db_path, os.getpid()), None)
+    if conn is not None:
+        conn.close()
+
+@contextmanager
+def _write_transaction(conn):
+    # BEGIN IMMEDIATE takes the write lock up front, so a busy database is waited out
+    # by busy_timeout instead of failing halfway through the transaction
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        yield conn.cursor()
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
 
 def init_db(db_path):
-    conn = sqlite3.connect(db_path)
+    conn = get_connection(db_path)
     cursor = conn.cursor()
-    # Create race_results table with composite primary key
+    # WAL lets the web workers keep reading while the scraper writes; the mode is stored in the file
+    cursor.execute('PRAGMA journal_mode = WAL')
+    # Create race_results table; `id` is the stable race key used by the normalized tables,
+    # scraped_at (UTC) and runner_count let the scraper plan a run without loading any results,
+    # race_date_iso/year/month/season_year let period filters run in SQL
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS race_results (
+            id INTEGER PRIMARY KEY,
             race_date TEXT NOT NULL,
             location_slug TEXT NOT NULL,
-            data TEXT,
+            data BLOB,
             race_number INTEGER,
-            PRIMARY KEY (race_date, location_slug)
+            scraped_at TEXT,
+            runner_count INTEGER,
+            race_date_iso TEXT,
+            year INTEGER,
+            month INTEGER,
+            season_year INTEGER,
+            UNIQUE (race_date, location_slug)
         )
     ''')
     # Create locations table
@@ -24,31 +109,537 @@ def init_db(db_path):
             url TEXT NOT NULL
         )
     ''')
+    # Normalized per-participant tables
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS participants (
+            id INTEGER PRIMARY KEY,
+            name TEXT,
+            gender TEXT,
+            age_group TEXT,
+            last_seen TEXT
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS runs (
+            race_id INTEGER NOT NULL REFERENCES race_results (id),
+            runner_id INTEGER,
+            overall_rank INTEGER,
+            gender_rank INTEGER,
+            time_in_seconds INTEGER,
+            score REAL,
+            gender TEXT,
+            age_group TEXT
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS volunteering (
+            race_id INTEGER NOT NULL REFERENCES race_results (id),
+            volunteer_id INTEGER NOT NULL
+        )
+    ''')
+    # Running totals per participant and location; location_slug 'all' holds the all-locations rollup.
+    # total_score is kept in raw points (age grade % plus volunteer bonuses) and divided by 10 when served.
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS participant_stats (
+            participant_id INTEGER NOT NULL,
+            location_slug TEXT NOT NULL,
+            total_score REAL NOT NULL DEFAULT 0,
+            run_count INTEGER NOT NULL DEFAULT 0,
+            volunteer_count INTEGER NOT NULL DEFAULT 0,
+            total_time_seconds INTEGER NOT NULL DEFAULT 0,
+            best_time_seconds INTEGER,
+            best_time_race_id INTEGER,
+            gold_medals INTEGER NOT NULL DEFAULT 0,
+            silver_medals INTEGER NOT NULL DEFAULT 0,
+            bronze_medals INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (participant_id, location_slug)
+        )
+    ''')
+    # Single-row counters; 'generation' is bumped by every write so readers can invalidate caches
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS meta (
+            key TEXT PRIMARY KEY,
+            value INTEGER NOT NULL
+        )
+    ''')
+    cursor.execute("INSERT OR IGNORE INTO meta (key, value) VALUES ('generation', 0)")
+    # Journal of the current scrape job so an interrupted run can be resumed: the locations
+    # to scan (planned_at is set once their races are in scrape_tasks) and one task per race
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS scrape_job_locations (
+            slug TEXT PRIMARY KEY,
+            name TEXT NOT NULL,
+            url TEXT NOT NULL,
+            full_scan INTEGER NOT NULL DEFAULT 0,
+            planned_at TEXT
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS scrape_tasks (
+            race_date TEXT NOT NULL,
+            location_slug TEXT NOT NULL,
+            race_number INTEGER,
+            url TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            last_error TEXT,
+            seconds REAL,
+            planned_at TEXT NOT NULL,
+            finished_at TEXT,
+            PRIMARY KEY (race_date, location_slug)
+        )
+    ''')
+    # Polling state of scheduler.py per location: validators and race list digest of its history
+    # page, the race day it awaits results for, and unix times of its next poll and re-check
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS location_schedule (
+            location_slug TEXT PRIMARY KEY,
+            etag TEXT,
+            last_modified TEXT,
+            race_list_digest TEXT,
+            awaiting TEXT,
+            poll_interval REAL,
+            next_poll REAL,
+            recheck_at REAL
+        )
+    ''')
+    # Lookup tables behind the filter dropdowns, kept current by _save_race. Age groups carry the
+    # number of runs so a re-scraped race can take its own away; location_slug 'all' holds the rollup
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS age_groups (
+            location_slug TEXT NOT NULL,
+            gender TEXT NOT NULL,
+            age_group TEXT NOT NULL,
+            run_count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (location_slug, gender, age_group)
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS race_years (
+            location_slug TEXT NOT NULL,
+            year INTEGER NOT NULL,
+            PRIMARY KEY (location_slug, year)
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS race_numbers (
+            race_id INTEGER PRIMARY KEY REFERENCES race_results (id),
+            location_slug TEXT NOT NULL,
+            race_number INTEGER,
+            race_date TEXT NOT NULL
+        )
+    ''')
+    # Ready-to-serve leaderboards of popular filtered views, built by snapshots.py. `period` is the
+    # canonical JSON of the load_all_results filters, age_group is '' for all participants.
+    # Rows are deleted as soon as a race they cover is saved.
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS leaderboard_snapshots (
+            location_slug TEXT NOT NULL,
+            period TEXT NOT NULL,
+            age_group TEXT NOT NULL,
+            format INTEGER NOT NULL,
+            payload TEXT NOT NULL,
+            built_at TEXT NOT NULL,
+            PRIMARY KEY (location_slug, period, age_group)
+        )
+    ''')
+    _create_search_index(cursor)
+    conn.commit()
+    _migrate(conn)
     cursor.execute('CREATE INDEX IF NOT EXISTS idx_race_number ON race_results (race_number)')
     cursor.execute('CREATE INDEX IF NOT EXISTS idx_location ON race_results (location_slug)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_race_date_iso ON race_results (race_date_iso)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_race_year ON race_results (location_slug, year, month)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_race_season_year ON race_results (location_slug, season_year, month)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_race_numbers_location ON race_numbers (location_slug, race_number)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_runs_race ON runs (race_id, overall_rank)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_runs_runner ON runs (runner_id)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_runs_age_group ON runs (age_group, gender)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_volunteering_race ON volunteering (race_id)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_volunteering_volunteer ON volunteering (volunteer_id)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_stats_score ON participant_stats (location_slug, total_score DESC)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_stats_best_time ON participant_stats (location_slug, best_time_seconds)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_stats_best_race ON participant_stats (best_time_race_id)')
+    # Match the LEADERBOARD_ORDERS expressions, so a page is read in order instead of sorting every row
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_stats_order_score ON participant_stats (location_slug, -(total_score / 10.0), participant_id)')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_stats_order_best_time
+        ON participant_stats (location_slug, best_time_seconds IS NULL, IFNULL(best_time_seconds, 0), participant_id)
+    ''')
     conn.commit()
-    conn.close()
 
-def save_locations(db_path, locations):
-    conn = sqlite3.connect(db_path)
-    cursor = conn.cursor()
+def _create_search_index(cursor):
+    """Trigram full-text index over participant names and IDs, kept in sync with participants by triggers."""
+    try:
+        cursor.execute("CREATE VIRTUAL TABLE IF NOT EXISTS participants_fts USING fts5 (name, participant_id, tokenize = 'trigram')")
+    except sqlite3.OperationalError as e:
+        # SQLite older than 3.34 has no trigram tokenizer; search_runners falls back to a table scan
+        print(f"Warning: Full-text search index is unavailable: {e}")
+        return
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS participants_fts_insert AFTER INSERT ON participants BEGIN
+            INSERT INTO participants_fts (rowid, name, participant_id) VALUES (new.id, new.name, new.id);
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS participants_fts_update AFTER UPDATE OF name ON participants
+        WHEN old.name IS NOT new.name BEGIN
+            DELETE FROM participants_fts WHERE rowid = old.id;
+            INSERT INTO participants_fts (rowid, name, participant_id) VALUES (new.id, new.name, new.id);
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS participants_fts_delete AFTER DELETE ON participants BEGIN
+            DELETE FROM participants_fts WHERE rowid = old.id;
+        END
+    ''')
+
+def _has_search_index(cursor):
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'participants_fts'")
+    return cursor.fetchone() is not None
+
+def _migrate(conn):
+    """Brings an existing database up to SCHEMA_VERSION. Safe to run from several processes at once."""
+    with _write_transaction(conn) as cursor:
+        version = cursor.execute('PRAGMA user_version').fetchone()[0]
+        if version < 1:
+            _migrate_v1(cursor)
+        if version < 2:
+            _rebuild_participant_stats(cursor)
+        if version < 3 and _has_search_index(cursor):
+            cursor.execute('DELETE FROM participants_fts')
+            cursor.execute('INSERT INTO participants_fts (rowid, name, participant_id) SELECT id, name, id FROM participants')
+        if version < 4:
+            _migrate_v4(cursor)
+        if version < 5:
+            _migrate_v5(cursor)
+        if version < 6:
+            _migrate_v6(cursor)
+        if version < 7:
+            cursor.execute(f'UPDATE participant_stats SET total_score = ROUND(total_score, {SCORE_DIGITS})')
+        cursor.execute(f'PRAGMA user_version = {SCHEMA_VERSION}')
+
+def _migrate_v1(cursor):
+    # Old databases keyed race_results by (race_date, location_slug) only; rebuild it with an id column
+    columns = [row[1] for row in cursor.execute('PRAGMA table_info(race_results)')]
+    if 'id' not in columns:
+        cursor.execute('DROP INDEX IF EXISTS idx_race_number')
+        cursor.execute('DROP INDEX IF EXISTS idx_location')
+        cursor.execute('ALTER TABLE race_results RENAME TO race_results_old')
+        cursor.execute('''
+            CREATE TABLE race_results (
+                id INTEGER PRIMARY KEY,
+                race_date TEXT NOT NULL,
+                location_slug TEXT NOT NULL,
+                data BLOB,
+                race_number INTEGER,
+                UNIQUE (race_date, location_slug)
+            )
+        ''')
+        cursor.execute('''
+            INSERT INTO race_results (race_date, location_slug, data, race_number)
+            SELECT race_date, location_slug, data, race_number FROM race_results_old
+        ''')
+        cursor.execute('DROP TABLE race_results_old')
+
+    # One-shot copy of the JSON blobs into the normalized tables
+    cursor.execute('SELECT id, race_date, data FROM race_results WHERE data IS NOT NULL')
+    for race_id, race_date, data in cursor.fetchall():
+        try:
+            results = decode_results(data)
+        except (ValueError, zlib.error):
+            print(f"Warning: Could not decode JSON for race_date {race_date}")
+            continue
+        _store_race_rows(cursor, race_id, race_date, results)
+
+def _migrate_v4(cursor):
+    columns = [row[1] for row in cursor.execute('PRAGMA table_info(race_results)')]
+    if 'scraped_at' not in columns:
+        cursor.execute('ALTER TABLE race_results ADD COLUMN scraped_at TEXT')
+    if 'runner_count' not in columns:
+        cursor.execute('ALTER TABLE race_results ADD COLUMN runner_count INTEGER')
+    # Fetch times of existing races are unknown and stay NULL
+    cursor.execute('''
+        UPDATE race_results SET runner_count = (SELECT COUNT(*) FROM runs WHERE runs.race_id = race_results.id)
+        WHERE data IS NOT NULL
+    ''')
+
+def _migrate_v5(cursor):
+    columns = [row[1] for row in cursor.execute('PRAGMA table_info(race_results)')]
+    for column, column_type in (('race_date_iso', 'TEXT'), ('year', 'INTEGER'), ('month', 'INTEGER'), ('season_year', 'INTEGER')):
+        if column not in columns:
+            cursor.execute(f'ALTER TABLE race_results ADD COLUMN {column} {column_type}')
+    cursor.execute('SELECT id, race_date FROM race_results')
     cursor.executemany(
-        'INSERT OR REPLACE INTO locations (slug, name, url) VALUES (:slug, :name, :url)',
-        locations
+        'UPDATE race_results SET race_date_iso = ?, year = ?, month = ?, season_year = ? WHERE id = ?',
+        [_date_columns(race_date) + (race_id,) for race_id, race_date in cursor.fetchall()]
     )
-    conn.commit()
-    conn.close()
+
+def _migrate_v6(cursor):
+    cursor.execute('DELETE FROM age_groups')
+    cursor.execute('''
+        INSERT INTO age_groups (location_slug, gender, age_group, run_count)
+        SELECT IFNULL(l.slug, rr.location_slug), r.gender, r.age_group, COUNT(*)
+        FROM runs r JOIN race_results rr ON rr.id = r.race_id
+        JOIN (SELECT NULL AS slug UNION ALL SELECT ?) l
+        WHERE r.age_group IS NOT NULL AND r.age_group != '' AND r.gender IS NOT NULL AND r.gender != ''
+        GROUP BY IFNULL(l.slug, rr.location_slug), r.gender, r.age_group
+    ''', (ALL_LOCATIONS,))
+    cursor.execute('DELETE FROM race_years')
+    cursor.execute('''
+        INSERT INTO race_years (location_slug, year)
+        SELECT DISTINCT location_slug, year FROM race_results WHERE data IS NOT NULL AND year IS NOT NULL
+        UNION SELECT DISTINCT 'all', year FROM race_results WHERE data IS NOT NULL AND year IS NOT NULL
+    ''')
+    cursor.execute('DELETE FROM race_numbers')
+    cursor.execute('''
+        INSERT INTO race_numbers (race_id, location_slug, race_number, race_date)
+        SELECT id, location_slug, race_number, race_date FROM race_results WHERE data IS NOT NULL
+    ''')
+
+def _store_race_rows(cursor, race_id, race_date, results):
+    """Replaces the runs and volunteering rows of one race and updates the participants it mentions.
+
+    Returns the ids of the participants whose stored name this race changed.
+    """
+    last_seen = _date_columns(race_date)[0] or ''
+    runners = results.get('runners', [])
+    volunteers = results.get('volunteers', [])
+
+    cursor.execute('DELETE FROM runs WHERE race_id = ?', (race_id,))
+    cursor.execute('DELETE FROM volunteering WHERE race_id = ?', (race_id,))
+
+    participants = [(r['id'], r.get('name'), r.get('gender'), r.get('age_group'), last_seen) for r in runners if r.get('id')]
+    participants += [(v['id'], v.get('name'), None, None, last_seen) for v in volunteers if v.get('id')]
+    names = {participant[0]: participant[1] for participant in participants}
+    cursor.execute(
+        'SELECT p.id, p.name, p.last_seen FROM json_each(?) w JOIN participants p ON p.id = w.value',
+        (json.dumps(list(names)),)
+    )
+    # Same rule as the upsert below: the name of the latest race wins
+    renamed = [pid for pid, name, seen in cursor.fetchall() if names[pid] != name and last_seen >= seen]
+    cursor.executemany('''
+        INSERT INTO participants (id, name, gender, age_group, last_seen) VALUES (?, ?, ?, ?, ?)
+        ON CONFLICT (id) DO UPDATE SET
+            name = CASE WHEN excluded.last_seen >= participants.last_seen THEN excluded.name ELSE participants.name END,
+            gender = CASE WHEN participants.gender IS NULL OR participants.gender = 'Н/Д' THEN excluded.gender ELSE participants.gender END,
+            age_group = CASE WHEN excluded.age_group IS NOT NULL AND (participants.age_group IS NULL OR excluded.last_seen >= participants.last_seen)
+                             THEN excluded.age_group ELSE participants.age_group END,
+            last_seen = max(participants.last_seen, excluded.last_seen)
+    ''', participants)
+
+    cursor.executemany(
+        'INSERT INTO runs (race_id, runner_id, overall_rank, gender_rank, time_in_seconds, score, gender, age_group) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+        [(race_id, r.get('id'), r.get('overall_rank'), r.get('gender_rank'), r.get('time_in_seconds'),
+          r.get('score'), r.get('gender'), r.get('age_group')) for r in runners]
+    )
+    cursor.executemany(
+        'INSERT INTO volunteering (race_id, volunteer_id) VALUES (?, ?)',
+        [(race_id, v['id']) for v in volunteers if v.get('id')]
+    )
+    return renamed
+
+# Per-participant contribution of one race: score points, runs, volunteer shifts, time and medals.
+# A volunteer who also ran that race gets 5 points, otherwise 55.
+_CONTRIBUTIONS_SQL = '''
+    SELECT r.runner_id, rr.location_slug, COALESCE(r.score, 0.0), 1, 0, COALESCE(r.time_in_seconds, 0),
+           IFNULL((r.gender = 'М' AND r.overall_rank = 1) OR (r.gender = 'Ж' AND r.gender_rank = 1), 0),
+           IFNULL((r.gender = 'М' AND r.overall_rank = 2) OR (r.gender = 'Ж' AND r.gender_rank = 2), 0),
+           IFNULL((r.gender = 'М' AND r.overall_rank = 3) OR (r.gender = 'Ж' AND r.gender_rank = 3), 0)
+    FROM runs r JOIN race_results rr ON rr.id = r.race_id
+    WHERE r.runner_id AND {race_filter}
+    UNION ALL
+    SELECT v.volunteer_id, rr.location_slug,
+           CASE WHEN EXISTS (SELECT 1 FROM runs r WHERE r.race_id = v.race_id AND r.runner_id = v.volunteer_id) THEN 5 ELSE 55 END,
+           0, 1, 0, 0, 0, 0
+    FROM volunteering v JOIN race_results rr ON rr.id = v.race_id
+    WHERE v.volunteer_id AND {race_filter}
+'''
+
+_BEST_TIME_SQL = '''
+    SELECT r.time_in_seconds, r.race_id
+    FROM runs r JOIN race_results rr ON rr.id = r.race_id
+    WHERE r.runner_id = ? AND (? = 'all' OR rr.location_slug = ?) AND r.time_in_seconds IS NOT NULL
+    ORDER BY r.time_in_seconds, r.race_id
+    LIMIT 1
+'''
+
+def _rebuild_participant_stats(cursor):
+    """Recomputes participant_stats from scratch out of the runs and volunteering tables."""
+    cursor.execute('DELETE FROM participant_stats')
+    cursor.execute(f'''
+        WITH c (pid, loc, pts, runs, vols, t, gold, silver, bronze) AS ({_CONTRIBUTIONS_SQL.format(race_filter='1')})
+        INSERT INTO participant_stats (participant_id, location_slug, total_score, run_count, volunteer_count,
+                                       total_time_seconds, gold_medals, silver_medals, bronze_medals)
+        SELECT pid, loc, ROUND(SUM(pts), {SCORE_DIGITS}), SUM(runs), SUM(vols), SUM(t), SUM(gold), SUM(silver), SUM(bronze)
+        FROM c GROUP BY pid, loc
+        UNION ALL
+        SELECT pid, 'all', ROUND(SUM(pts), {SCORE_DIGITS}), SUM(runs), SUM(vols), SUM(t), SUM(gold), SUM(silver), SUM(bronze)
+        FROM c GROUP BY pid
+    ''')
+    cursor.execute('''
+        UPDATE participant_stats SET (best_time_seconds, best_time_race_id) = (
+            SELECT r.time_in_seconds, r.race_id
+            FROM runs r JOIN race_results rr ON rr.id = r.race_id
+            WHERE r.runner_id = participant_stats.participant_id
+              AND (participant_stats.location_slug = 'all' OR rr.location_slug = participant_stats.location_slug)
+              AND r.time_in_seconds IS NOT NULL
+            ORDER BY r.time_in_seconds, r.race_id
+            LIMIT 1
+        )
+        WHERE run_count > 0
+    ''')
+
+def _race_contributions(cursor, race_id):
+    cursor.execute(_CONTRIBUTIONS_SQL.format(race_filter='rr.id = :race_id'), {'race_id': race_id})
+    totals = {}
+    for pid, loc, pts, runs, vols, t, gold, silver, bronze in cursor.fetchall():
+        row = totals.setdefault(pid, [loc, 0.0, 0, 0, 0, None, 0, 0, 0])
+        row[1] += pts
+        row[2] += runs
+        row[3] += vols
+        row[4] += t
+        if runs and (row[5] is None or t < row[5]):
+            row[5] = t
+        row[6] += gold
+        row[7] += silver
+        row[8] += bronze
+    return totals
+
+def _add_race_stats(cursor, race_id):
+    rows = []
+    for pid, (loc, pts, runs, vols, t, best, gold, silver, bronze) in _race_contributions(cursor, race_id).items():
+        best_race_id = race_id if best is not None else None
+        for stats_loc in (loc, ALL_LOCATIONS):
+            rows.append((pid, stats_loc, pts, runs, vols, t, best, best_race_id, gold, silver, bronze))
+    cursor.executemany(f'''
+        INSERT INTO participant_stats (participant_id, location_slug, total_score, run_count, volunteer_count,
+                                       total_time_seconds, best_time_seconds, best_time_race_id,
+                                       gold_medals, silver_medals, bronze_medals)
+        VALUES (?, ?, ROUND(?, {SCORE_DIGITS}), ?, ?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT (participant_id, location_slug) DO UPDATE SET
+            total_score = ROUND(total_score + excluded.total_score, {SCORE_DIGITS}),
+            run_count = run_count + excluded.run_count,
+            volunteer_count = volunteer_count + excluded.volunteer_count,
+            total_time_seconds = total_time_seconds + excluded.total_time_seconds,
+            best_time_race_id = CASE WHEN best_time_seconds IS NULL OR excluded.best_time_seconds < best_time_seconds
+                                     THEN excluded.best_time_race_id ELSE best_time_race_id END,
+            best_time_seconds = CASE WHEN best_time_seconds IS NULL OR excluded.best_time_seconds < best_time_seconds
+                                     THEN excluded.best_time_seconds ELSE best_time_seconds END,
+            gold_medals = gold_medals + excluded.gold_medals,
+            silver_medals = silver_medals + excluded.silver_medals,
+            bronze_medals = bronze_medals + excluded.bronze_medals
+    ''', rows)
+
+def _remove_race_stats(cursor, race_id):
+    """Subtracts the stored contribution of a race. Returns the (participant, location) pairs whose best time came from it."""
+    rows = []
+    for pid, (loc, pts, runs, vols, t, best, gold, silver, bronze) in _race_contributions(cursor, race_id).items():
+        for stats_loc in (loc, ALL_LOCATIONS):
+            rows.append((pts, runs, vols, t, gold, silver, bronze, pid, stats_loc))
+    cursor.executemany(f'''
+        UPDATE participant_stats SET
+            total_score = ROUND(total_score - ?, {SCORE_DIGITS}), run_count = run_count - ?, volunteer_count = volunteer_count - ?,
+            total_time_seconds = total_time_seconds - ?,
+            gold_medals = gold_medals - ?, silver_medals = silver_medals - ?, bronze_medals = bronze_medals - ?
+        WHERE participant_id = ? AND location_slug = ?
+    ''', rows)
+    cursor.executemany(
+        'DELETE FROM participant_stats WHERE participant_id = ? AND location_slug = ? AND run_count <= 0 AND volunteer_count <= 0',
+        [row[-2:] for row in rows]
+    )
+    cursor.execute('SELECT participant_id, location_slug FROM participant_stats WHERE best_time_race_id = ?', (race_id,))
+    lost_best = cursor.fetchall()
+    cursor.execute('UPDATE participant_stats SET best_time_seconds = NULL, best_time_race_id = NULL WHERE best_time_race_id = ?', (race_id,))
+    return lost_best
+
+def _refresh_best_times(cursor, pairs):
+    for pid, loc in pairs:
+        cursor.execute(_BEST_TIME_SQL, (pid, loc, loc))
+        best = cursor.fetchone()
+        if best:
+            cursor.execute(
+                'UPDATE participant_stats SET best_time_seconds = ?, best_time_race_id = ? WHERE participant_id = ? AND location_slug = ?',
+                (best[0], best[1], pid, loc)
+            )
+
+def _count_race_age_groups(cursor, race_id, sign):
+    """Adds (sign=1) or subtracts (sign=-1) the runs of a race to the age_groups lookup table."""
+    cursor.execute('''
+        INSERT INTO age_groups (location_slug, gender, age_group, run_count)
+        SELECT l.slug, r.gender, r.age_group, ?1 * COUNT(*)
+        FROM runs r
+        JOIN (SELECT location_slug AS slug FROM race_results WHERE id = ?2 UNION ALL SELECT ?3) l
+        WHERE r.race_id = ?2 AND r.age_group IS NOT NULL AND r.age_group != '' AND r.gender IS NOT NULL AND r.gender != ''
+        GROUP BY l.slug, r.gender, r.age_group
+        ON CONFLICT (location_slug, gender, age_group) DO UPDATE SET run_count = run_count + excluded.run_count
+    ''', (sign, race_id, ALL_LOCATIONS))
+    if sign < 0:
+        cursor.execute('DELETE FROM age_groups WHERE run_count <= 0')
+
+def _add_race_lookups(cursor, race_id):
+    """Records the year and number of a saved race in race_years and race_numbers."""
+    cursor.execute('''
+        INSERT OR REPLACE INTO race_numbers (race_id, location_slug, race_number, race_date)
+        SELECT id, location_slug, race_number, race_date FROM race_results WHERE id = ?
+    ''', (race_id,))
+    cursor.execute('''
+        INSERT OR IGNORE INTO race_years (location_slug, year)
+        SELECT l.slug, rr.year FROM race_results rr
+        JOIN (SELECT location_slug AS slug FROM race_results WHERE id = ?1 UNION ALL SELECT ?2) l
+        WHERE rr.id = ?1 AND rr.year IS NOT NULL
+    ''', (race_id, ALL_LOCATIONS))
+
+def _bump_generation(cursor):
+    cursor.execute("UPDATE meta SET value = value + 1 WHERE key = 'generation'")
+
+def get_meta(db_path, key, default=None):
+    conn = get_connection(db_path)
+    row = conn.execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+    return row[0] if row else default
+
+def set_meta(db_path, key, value):
+    conn = get_connection(db_path)
+    with _write_transaction(conn) as cursor:
+        cursor.execute('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)', (key, value))
+
+@metrics.timed('sql')
+def get_generation(db_path):
+    """Returns a counter that changes whenever races or locations are written."""
+    conn = get_connection(db_path)
+    cursor = conn.cursor()
+    cursor.execute("SELECT value FROM meta WHERE key = 'generation'")
+    row = cursor.fetchone()
+    return row[0] if row else 0
+
+def save_locations(db_path, locations):
+    """Upserts the locations list; returns True if a location was added or changed.
+
+    Rows that are already stored as they are are left alone, so the hourly refresh of an
+    unchanged list does not bump the generation and drop every cached response.
+    """
+    conn = get_connection(db_path)
+    with _write_transaction(conn) as cursor:
+        cursor.executemany('''
+            INSERT INTO locations (slug, name, url) VALUES (:slug, :name, :url)
+            ON CONFLICT (slug) DO UPDATE SET name = excluded.name, url = excluded.url
+            WHERE name != excluded.name OR url != excluded.url
+        ''', locations)
+        changed = cursor.rowcount > 0
+        if changed:
+            _bump_generation(cursor)
+    return changed
 
 def load_locations(db_path):
-    conn = sqlite3.connect(db_path)
+    conn = get_connection(db_path)
     cursor = conn.cursor()
     cursor.execute('SELECT slug, name, url FROM locations ORDER BY name')
     rows = cursor.fetchall()
-    conn.close()
     return [{'slug': r[0], 'name': r[1], 'url': r[2]} for r in rows]
 
+@metrics.timed('sql')
 def load_locations_with_races(db_path):
-    conn = sqlite3.connect(db_path)
+    conn = get_connection(db_path)
     cursor = conn.cursor()
     cursor.execute('''
         SELECT DISTINCT T1.slug, T1.name, T1.url
@@ -57,109 +648,699 @@ def load_locations_with_races(db_path):
         ORDER BY T1.name
     ''')
     rows = cursor.fetchall()
-    conn.close()
     return [{'slug': r[0], 'name': r[1], 'url': r[2]} for r in rows]
 
-def save_results(db_path, race_date, location_slug, race_number, results):
-    conn = sqlite3.connect(db_path)
-    cursor = conn.cursor()
-    results_json = json.dumps(results)
-    try:
-        cursor.execute(
-            'INSERT INTO race_results (race_date, location_slug, race_number, data) VALUES (?, ?, ?, ?)',
-            (race_date, location_slug, race_number, results_json)
+def _columns(rows):
+    """Splits a list of dicts into [keys, parallel value arrays, {key: indexes of the rows without it}]."""
+    keys = list(dict.fromkeys(key for row in rows for key in row))
+    missing = {key: [i for i, row in enumerate(rows) if key not in row] for key in keys}
+    return [keys, [[row.get(key) for row in rows] for key in keys], {key: rows for key, rows in missing.items() if rows}]
+
+def _rows(keys, columns, missing):
+    rows = [dict(zip(keys, values)) for values in zip(*columns)]
+    for key, indexes in missing.items():
+        for i in indexes:
+            del rows[i][key]
+    return rows
+
+def encode_results(results):
+    """Packs scraped results for race_results.data: a RESULTS_FORMAT byte, then zlib-compressed JSON
+    with every list of rows (runners, volunteers) stored column by column, so key names are not repeated."""
+    tables, other = {}, {}
+    for key, value in results.items():
+        if isinstance(value, list) and all(isinstance(row, dict) for row in value):
+            tables[key] = _columns(value)
+        else:
+            other[key] = value
+    body = json.dumps([tables, other], ensure_ascii=False, separators=(',', ':'))
+    return bytes([RESULTS_FORMAT]) + zlib.compress(body.encode('utf-8'))
+
+def decode_results(data):
+    """Inverse of encode_results; JSON text stored by earlier versions is decoded as well."""
+    if isinstance(data, str):
+        return json.loads(data)
+    if data[:1] != bytes([RESULTS_FORMAT]):
+        raise ValueError(f"Unknown race results format {data[:1].hex()}")
+    tables, other = json.loads(zlib.decompress(data[1:]))
+    results = {key: _rows(*table) for key, table in tables.items()}
+    results.update(other)
+    return results
+
+def _save_race(cursor, race_date, location_slug, race_number, results):
+    cursor.execute('SELECT race_number FROM race_results WHERE race_date = ? AND location_slug = ?', (race_date, location_slug))
+    previous = cursor.fetchone()
+    cursor.execute('''
+        INSERT INTO race_results (race_date, location_slug, race_number, data, scraped_at, runner_count,
+                                  race_date_iso, year, month, season_year)
+        VALUES (?, ?, ?, ?, datetime('now'), ?, ?, ?, ?, ?)
+        ON CONFLICT (race_date, location_slug) DO UPDATE SET
+            race_number = excluded.race_number, data = excluded.data,
+            scraped_at = excluded.scraped_at, runner_count = excluded.runner_count
+    ''', (race_date, location_slug, race_number, encode_results(results), len(results.get('runners', [])))
+       + _date_columns(race_date))
+    cursor.execute('SELECT id FROM race_results WHERE race_date = ? AND location_slug = ?', (race_date, location_slug))
+    race_id = cursor.fetchone()[0]
+    # Re-scraping a race replaces its contribution to the aggregates instead of adding it twice
+    lost_best = _remove_race_stats(cursor, race_id)
+    _count_race_age_groups(cursor, race_id, -1)
+    renamed = _store_race_rows(cursor, race_id, race_date, results)
+    _add_race_stats(cursor, race_id)
+    _count_race_age_groups(cursor, race_id, 1)
+    _add_race_lookups(cursor, race_id)
+    _refresh_best_times(cursor, lost_best)
+    _invalidate_snapshots(cursor, race_id, previous[0] if previous else None)
+    _invalidate_participant_snapshots(cursor, renamed)
+
+def snapshot_period(filters):
+    """Canonical key of a set of load_all_results filters; unset filters are left out."""
+    return json.dumps({key: value for key, value in filters.items() if value is not None}, sort_keys=True)
+
+def _invalidate_snapshots(cursor, race_id, previous_race_number):
+    """Deletes the snapshots whose filters select this race (under its old or new race number)."""
+    cursor.execute('''
+        DELETE FROM leaderboard_snapshots
+        WHERE rowid IN (
+            SELECT s.rowid FROM race_results rr
+            JOIN leaderboard_snapshots s ON s.location_slug = rr.location_slug
+            WHERE rr.id = ?
+              AND (json_extract(s.period, '$.race_number') IS NULL OR json_extract(s.period, '$.race_number') IN (rr.race_number, ?))
+              AND (json_extract(s.period, '$.year') IS NULL OR json_extract(s.period, '$.year') = rr.year)
+              AND (json_extract(s.period, '$.season_year') IS NULL OR json_extract(s.period, '$.season_year') = rr.season_year)
+              AND (json_extract(s.period, '$.month') IS NULL OR json_extract(s.period, '$.month') = rr.month)
+              AND (json_extract(s.period, '$.months') IS NULL OR rr.month IN (SELECT value FROM json_each(s.period, '$.months')))
         )
-    except sqlite3.IntegrityError:
-        cursor.execute(
-            'UPDATE race_results SET race_number = ?, data = ? WHERE race_date = ? AND location_slug = ?',
-            (race_number, results_json, race_date, location_slug)
+    ''', (race_id, previous_race_number))
+
+def _invalidate_participant_snapshots(cursor, participant_ids):
+    """Deletes every snapshot of the locations (and 'all') these participants appear in.
+
+    Snapshots store names, so a participant renamed through a race elsewhere would otherwise
+    keep the old name in them. Renames are rare enough to drop all periods of those locations.
+    """
+    if participant_ids:
+        cursor.execute('''
+            DELETE FROM leaderboard_snapshots WHERE location_slug IN (
+                SELECT location_slug FROM participant_stats WHERE participant_id IN (SELECT value FROM json_each(?))
+            )
+        ''', (json.dumps(participant_ids),))
+
+@metrics.timed('sql')
+def load_snapshot(db_path, location_slug, period, age_group):
+    """Returns the stored {'leaderboard', 'fastest'} of a view, or None if it is not materialized."""
+    conn = get_connection(db_path)
+    cursor = conn.cursor()
+    cursor.execute(
+        'SELECT payload FROM leaderboard_snapshots WHERE location_slug = ? AND period = ? AND age_group = ? AND format = ?',
+        (location_slug, period, age_group, SNAPSHOT_FORMAT)
+    )
+    row = cursor.fetchone()
+    if not row:
+        return None
+    metrics.count('blobs')
+    with metrics.stage('decode'):
+        return json.loads(row[0])
+
+def load_snapshot_keys(db_path):
+    conn = get_connection(db_path)
+    cursor = conn.cursor()
+    cursor.execute('SELECT location_slug, period, age_group FROM leaderboard_snapshots WHERE format = ?', (SNAPSHOT_FORMAT,))
+    return set(cursor.fetchall())
+
+def save_snapshots(db_path, snapshots, generation):
+    """Stores (location_slug, period, age_group, payload) snapshots computed at `generation`.
+
+    Nothing is written if races were saved in the meantime, since the snapshots may already
+    be out of date; returns whether they were stored.
+    """
+    conn = get_connection(db_path)
+    with _write_transaction(conn) as cursor:
+        cursor.execute("SELECT value FROM meta WHERE key = 'generation'")
+        if cursor.fetchone()[0] != generation:
+            return False
+        cursor.executemany('''
+            INSERT OR REPLACE INTO leaderboard_snapshots (location_slug, period, age_group, format, payload, built_at)
+            VALUES (?, ?, ?, ?, ?, datetime('now'))
+        ''', [(slug, period, age_group, SNAPSHOT_FORMAT, json.dumps(payload)) for slug, period, age_group, payload in snapshots])
+    return True
+
+def clear_snapshots(db_path):
+    conn = get_connection(db_path)
+    with _write_transaction(conn) as cursor:
+        cursor.execute('DELETE FROM leaderboard_snapshots')
+
+def save_results(db_path, race_date, location_slug, race_number, results):
+    save_results_batch(db_path, [(race_date, location_slug, race_number, results)])
+
+def save_results_batch(db_path, races, tasks=()):
+    """Saves several (race_date, location_slug, race_number, results) tuples in one transaction.
+
+    `tasks` are (race_date, location_slug, error, seconds) outcomes for the scrape journal,
+    recorded in the same transaction so a saved race is never left marked as pending.
+    """
+    conn = get_connection(db_path)
+    with _write_transaction(conn) as cursor:
+        for race_date, location_slug, race_number, results in races:
+            _save_race(cursor, race_date, location_slug, race_number, results)
+        _finish_scrape_tasks(cursor, tasks)
+        if races:
+            _bump_generation(cursor)
+
+def start_scrape_job(db_path, locations, full_scan):
+    """Replaces the scrape journal with a new job over `locations`."""
+    conn = get_connection(db_path)
+    with _write_transaction(conn) as cursor:
+        cursor.execute('DELETE FROM scrape_tasks')
+        cursor.execute('DELETE FROM scrape_job_locations')
+        cursor.executemany(
+            'INSERT INTO scrape_job_locations (slug, name, url, full_scan) VALUES (?, ?, ?, ?)',
+            [(loc['slug'], loc['name'], loc['url'], int(full_scan)) for loc in locations]
         )
-    conn.commit()
-    conn.close()
 
+def save_scrape_plan(db_path, location_slug, races):
+    """Adds the races chosen for one location to the journal and marks the location as planned."""
+    conn = get_connection(db_path)
+    with _write_transaction(conn) as cursor:
+        cursor.executemany('''
+            INSERT INTO scrape_tasks (race_date, location_slug, race_number, url, planned_at)
+            VALUES (?, ?, ?, ?, datetime('now'))
+            ON CONFLICT (race_date, location_slug) DO UPDATE SET race_number = excluded.race_number, url = excluded.url
+        ''', [(race['date'], location_slug, race['number'], race['url']) for race in races])
+        cursor.execute("UPDATE scrape_job_locations SET planned_at = datetime('now') WHERE slug = ?", (location_slug,))
+
+def _finish_scrape_tasks(cursor, tasks):
+    cursor.executemany('''
+        UPDATE scrape_tasks SET
+            status = CASE WHEN ?3 IS NULL THEN 'done' ELSE 'failed' END,
+            attempts = attempts + 1, last_error = ?3, seconds = ?4, finished_at = datetime('now')
+        WHERE race_date = ?1 AND location_slug = ?2
+    ''', tasks)
+
+def load_scrape_job(db_path, max_attempts):
+    """Returns what is left of the journaled job.
+
+    The result is (locations, tasks). `locations` are those whose race list was never
+    planned, each with its full_scan flag. `tasks` are (race, location_slug) pairs that are
+    not done and have had fewer than `max_attempts` attempts.
+    """
+    conn = get_connection(db_path)
+    cursor = conn.cursor()
+    cursor.execute('SELECT slug, name, url, full_scan FROM scrape_job_locations WHERE planned_at IS NULL ORDER BY rowid')
+    locations = [{'slug': r[0], 'name': r[1], 'url': r[2], 'full_scan': bool(r[3])} for r in cursor.fetchall()]
+    cursor.execute('''
+        SELECT race_date, race_number, url, location_slug FROM scrape_tasks
+        WHERE status != 'done' AND attempts < ? ORDER BY location_slug, rowid
+    ''', (max_attempts,))
+    tasks = [({'date': r[0], 'number': r[1], 'url': r[2]}, r[3]) for r in cursor.fetchall()]
+    return locations, tasks
+
+def count_scrape_tasks(db_path):
+    """Number of journaled tasks per status."""
+    conn = get_connection(db_path)
+    cursor = conn.cursor()
+    cursor.execute('SELECT status, COUNT(*) FROM scrape_tasks GROUP BY status')
+    return dict(cursor.fetchall())
+
+def _runner_from_row(row):
+    runner_id, name, score, time_in_seconds, gender, age_group, overall_rank, gender_rank = row
+    runner = {
+        'id': runner_id, 'name': name if runner_id else UNKNOWN_RUNNER_NAME,
+        'score': score, 'time_in_seconds': time_in_seconds,
+        'gender': gender, 'age_group': age_group, 'overall_rank': overall_rank
+    }
+    if gender_rank is not None:
+        runner['gender_rank'] = gender_rank
+    return runner
+
+def _load_race_data(cursor, race_ids):
+    """Rebuilds the {'runners', 'volunteers'} structure for the given races from the normalized tables."""
+    data = {race_id: {'runners': [], 'volunteers': []} for race_id in race_ids}
+    if not data:
+        return data
+    # Race ids are passed as one JSON array so no temporary table (and no write transaction) is needed
+    wanted = json.dumps(list(data))
+    cursor.execute('''
+        SELECT r.race_id, r.runner_id, p.name, r.score, r.time_in_seconds, r.gender, r.age_group, r.overall_rank, r.gender_rank
+        FROM json_each(?) w
+        JOIN runs r ON r.race_id = w.value
+        LEFT JOIN participants p ON p.id = r.runner_id
+        ORDER BY r.race_id, r.overall_rank
+    ''', (wanted,))
+    for row in cursor:
+        data[row[0]]['runners'].append(_runner_from_row(row[1:]))
+    cursor.execute('''
+        SELECT v.race_id, v.volunteer_id, p.name
+        FROM json_each(?) w
+        JOIN volunteering v ON v.race_id = w.value
+        LEFT JOIN participants p ON p.id = v.volunteer_id
+        ORDER BY v.rowid
+    ''', (wanted,))
+    for race_id, volunteer_id, name in cursor:
+        data[race_id]['volunteers'].append({'id': volunteer_id, 'name': name})
+    return data
+
+@metrics.timed('sql')
 def load_results(db_path, race_date, location_slug):
-    conn = sqlite3.connect(db_path)
+    conn = get_connection(db_path)
     cursor = conn.cursor()
-    cursor.execute('SELECT data FROM race_results WHERE race_date = ? AND location_slug = ?', (race_date, location_slug))
+    cursor.execute('SELECT id, data IS NOT NULL FROM race_results WHERE race_date = ? AND location_slug = ?', (race_date, location_slug))
     row = cursor.fetchone()
-    conn.close()
-    if row and row[0] is not None:
-        try:
-            return json.loads(row[0])
-        except json.JSONDecodeError:
-            return None
-    return None
+    results = None
+    if row and row[1]:
+        results = _load_race_data(cursor, [row[0]])[row[0]]
+    return results
+
+def load_scraped_results(db_path, race_date, location_slug):
+    """The results of a race exactly as they were scraped, decoded from race_results.data; None if not stored."""
+    conn = get_connection(db_path)
+    cursor = conn.cursor()
+    cursor.execute('SELECT data FROM race_results WHERE race_date = ? AND location_slug = ? AND data IS NOT NULL', (race_date, location_slug))
+    row = cursor.fetchone()
+    if not row:
+        return None
+    metrics.count('blobs')
+    with metrics.stage('decode'):
+        return decode_results(row[0])
 
-def load_all_results(db_path, location_slug=None):
-    conn = sqlite3.connect(db_path)
+def compact_results(db_path, batch_size=200):
+    """Rewrites race_results.data rows still stored as JSON text in the compact format.
+
+    Works in short write transactions of batch_size races, so the site and the scraper keep
+    running meanwhile and an interrupted run simply continues. Rows that cannot be decoded
+    are left as they are. Returns (converted, bytes before, bytes after).
+    """
+    conn = get_connection(db_path)
+    converted = before = after = 0
+    last_id = 0
+    while True:
+        with _write_transaction(conn) as cursor:
+            cursor.execute('''
+                SELECT id, data FROM race_results WHERE id > ? AND typeof(data) = 'text' ORDER BY id LIMIT ?
+            ''', (last_id, batch_size))
+            rows = cursor.fetchall()
+            if not rows:
+                return converted, before, after
+            updates = []
+            for race_id, data in rows:
+                try:
+                    blob = encode_results(json.loads(data))
+                except ValueError:
+                    continue
+                updates.append((blob, race_id))
+                before += len(data.encode('utf-8'))
+                after += len(blob)
+            cursor.executemany('UPDATE race_results SET data = ? WHERE id = ?', updates)
+            converted += len(updates)
+            last_id = rows[-1][0]
+
+def load_race_calendar(db_path, recent=12):
+    """Per location, the ISO dates and numbers of its `recent` latest races, newest first."""
+    conn = get_connection(db_path)
+    cursor = conn.cursor()
+    cursor.execute('''
+        SELECT location_slug, race_date_iso, race_number FROM (
+            SELECT location_slug, race_date_iso, race_number,
+                   ROW_NUMBER() OVER (PARTITION BY location_slug ORDER BY race_date_iso DESC) AS position
+            FROM race_results WHERE data IS NOT NULL AND race_date_iso IS NOT NULL
+        )
+        WHERE position <= ?
+        ORDER BY location_slug, race_date_iso DESC
+    ''', (recent,))
+    calendar = {}
+    for slug, race_date_iso, race_number in cursor:
+        calendar.setdefault(slug, []).append((race_date_iso, race_number))
+    return calendar
+
+def load_location_schedule(db_path):
+    conn = get_connection(db_path)
+    cursor = conn.cursor()
+    cursor.execute('SELECT * FROM location_schedule')
+    columns = [column[0] for column in cursor.description]
+    return {row[0]: dict(zip(columns, row)) for row in cursor.fetchall()}
+
+def save_location_schedule(db_path, states):
+    """Stores the polling state dicts (keyed like location_schedule's columns) of several locations."""
+    conn = get_connection(db_path)
+    with _write_transaction(conn) as cursor:
+        cursor.executemany('''
+            INSERT OR REPLACE INTO location_schedule
+                (location_slug, etag, last_modified, race_list_digest, awaiting, poll_interval, next_poll, recheck_at)
+            VALUES (:location_slug, :etag, :last_modified, :race_list_digest, :awaiting, :poll_interval, :next_poll, :recheck_at)
+        ''', states)
+
+def load_races(db_path, location_slug=None):
+    """Lists stored races (date, number, location) without loading their results."""
+    conn = get_connection(db_path)
     cursor = conn.cursor()
     if location_slug and location_slug != 'all':
-        cursor.execute('SELECT race_date, race_number, data, location_slug FROM race_results WHERE location_slug = ? ORDER BY race_date DESC', (location_slug,))
+        cursor.execute('SELECT race_date, race_number, location_slug FROM race_results WHERE location_slug = ? AND data IS NOT NULL', (location_slug,))
     else:
-        cursor.execute('SELECT race_date, race_number, data, location_slug FROM race_results ORDER BY race_date DESC')
-    
+        cursor.execute('SELECT race_date, race_number, location_slug FROM race_results WHERE data IS NOT NULL')
     rows = cursor.fetchall()
-    conn.close()
-    results = []
-    for row in rows:
-        if row[2] is None:
-            continue
-        try:
-            data = json.loads(row[2])
-            results.append({
-                'race_date': row[0],
-                'race_number': row[1],
-                'data': data,
-                'location_slug': row[3]
-            })
-        except json.JSONDecodeError:
-            print(f"Warning: Could not decode JSON for race_date {row[0]}")
-            continue
-    return results
+    return [{'race_date': r[0], 'race_number': r[1], 'location_slug': r[2]} for r in rows]
+
+def load_race_index(db_path, location_slug=None):
+    """Maps (race_date, location_slug) of every stored race to its runner count and UTC scrape time.
+
+    One query over race_results without touching the results themselves, so the scraper can
+    decide what to download for all locations at once.
+    """
+    conn = get_connection(db_path)
+    cursor = conn.cursor()
+    query = 'SELECT race_date, location_slug, runner_count, scraped_at FROM race_results WHERE data IS NOT NULL'
+    if location_slug and location_slug != 'all':
+        cursor.execute(query + ' AND location_slug = ?', (location_slug,))
+    else:
+        cursor.execute(query)
+    return {(r[0], r[1]): {'runner_count': r[2], 'scraped_at': r[3]} for r in cursor}
+
+@metrics.timed('sql')
+def load_race_numbers(db_path, location_slug=None):
+    """Numbered races as {'number', 'date'}, highest number first."""
+    conn = get_connection(db_path)
+    cursor = conn.cursor()
+    query = 'SELECT race_number, race_date FROM race_numbers WHERE race_number > 0'
+    if location_slug and location_slug != 'all':
+        cursor.execute(query + ' AND location_slug = ? ORDER BY race_number DESC, race_id', (location_slug,))
+    else:
+        cursor.execute(query + ' ORDER BY race_number DESC, race_id')
+    return [{'number': r[0], 'date': r[1]} for r in cursor]
+
+@metrics.timed('sql')
+def load_race_years(db_path, location_slug=None):
+    """Years with stored races, newest first."""
+    conn = get_connection(db_path)
+    cursor = conn.cursor()
+    cursor.execute('SELECT year FROM race_years WHERE location_slug = ? ORDER BY year DESC', (location_slug or ALL_LOCATIONS,))
+    return [row[0] for row in cursor]
+
+def _select_races(cursor, location_slug, year, season_year, months, month, race_number):
+    """(id, race_date, race_number, location_slug) of the stored races matching every given filter."""
+    conditions, params = ['data IS NOT NULL'], []
+    if location_slug and location_slug != 'all':
+        conditions.append('location_slug = ?')
+        params.append(location_slug)
+    for column, value in (('year', year), ('season_year', season_year), ('month', month), ('race_number', race_number)):
+        if value is not None:
+            conditions.append(f'{column} = ?')
+            params.append(value)
+    if months is not None:
+        conditions.append(f"month IN ({', '.join('?' * len(months))})")
+        params.extend(months)
+    cursor.execute(f"SELECT id, race_date, race_number, location_slug FROM race_results WHERE {' AND '.join(conditions)} ORDER BY race_date DESC, location_slug DESC", params)
+    return cursor.fetchall()
 
-def get_all_age_groups(db_path):
-    conn = sqlite3.connect(db_path)
+@metrics.timed('sql')
+def load_all_results(db_path, location_slug=None, year=None, season_year=None, months=None, month=None, race_number=None):
+    """Loads the races of a location with their results, optionally only those matching every given filter.
+
+    `season_year` counts December towards the following year; `months` is a collection of
+    allowed months. Only the selected races are decoded.
+    """
+    conn = get_connection(db_path)
+    cursor = conn.cursor()
+    rows = _select_races(cursor, location_slug, year, season_year, months, month, race_number)
+    data = _load_race_data(cursor, [row[0] for row in rows])
+    return [{
+        'race_date': row[1],
+        'race_number': row[2],
+        'data': data[row[0]],
+        'location_slug': row[3]
+    } for row in rows]
+
+def iter_race_rows(db_path, location_slug=None, year=None, season_year=None, months=None, month=None, race_number=None):
+    """Streams the races load_all_results would return, one at a time and as tuples.
+
+    Yields ((race_number, race_date, location_slug), runners, volunteers) with runners as
+    (runner_id, name, score, time_in_seconds, gender, age_group, overall_rank, gender_rank)
+    and volunteers as (volunteer_id, name), so only one race is held in memory at a time.
+    """
+    conn = get_connection(db_path)
     cursor = conn.cursor()
-    cursor.execute('SELECT data FROM race_results')
+    with metrics.stage('sql'):
+        races = _select_races(cursor, location_slug, year, season_year, months, month, race_number)
+    metrics.count('rows', len(races))
+    for race_id, race_date, race_number, slug in races:
+        with metrics.stage('sql'):
+            cursor.execute('''
+                SELECT r.runner_id, CASE WHEN r.runner_id THEN p.name ELSE ? END, r.score, r.time_in_seconds,
+                       r.gender, r.age_group, r.overall_rank, r.gender_rank
+                FROM runs r LEFT JOIN participants p ON p.id = r.runner_id
+                WHERE r.race_id = ?
+                ORDER BY r.overall_rank
+            ''', (UNKNOWN_RUNNER_NAME, race_id))
+            runners = cursor.fetchall()
+            cursor.execute('''
+                SELECT v.volunteer_id, p.name FROM volunteering v LEFT JOIN participants p ON p.id = v.volunteer_id
+                WHERE v.race_id = ?
+                ORDER BY v.rowid
+            ''', (race_id,))
+            volunteers = cursor.fetchall()
+        metrics.count('rows', len(runners) + len(volunteers))
+        yield (race_number, race_date, slug), runners, volunteers
+
+@metrics.timed('sql')
+def load_result_rows(db_path, location_slug=None, year=None, season_year=None, months=None, month=None, race_number=None):
+    """The same races as load_all_results as flat rows, for column-wise aggregation.
+
+    Returns (races, runs, volunteers): races are (race_number, race_date, location_slug); runs are
+    (race index, runner_id, score, time_in_seconds, gender, age_group, overall_rank, gender_rank)
+    and volunteers (race index, volunteer_id), with missing ids and ranks as 0. Names are left to
+    load_participant_names.
+    Runs come in index order, i.e. by race and overall rank like load_all_results lists them,
+    but without an ORDER BY; callers sort by (race index, overall_rank) themselves.
+    """
+    conn = get_connection(db_path)
+    cursor = conn.cursor()
+    rows = _select_races(cursor, location_slug, year, season_year, months, month, race_number)
+    wanted = json.dumps([row[0] for row in rows])
+    cursor.execute('''
+        SELECT w.key, IFNULL(r.runner_id, 0), r.score, r.time_in_seconds, r.gender, r.age_group,
+               IFNULL(r.overall_rank, 0), IFNULL(r.gender_rank, 0)
+        FROM json_each(?) w
+        JOIN runs r ON r.race_id = w.value
+    ''', (wanted,))
+    runs = cursor.fetchall()
+    cursor.execute('''
+        SELECT w.key, IFNULL(v.volunteer_id, 0)
+        FROM json_each(?) w
+        JOIN volunteering v ON v.race_id = w.value
+        ORDER BY w.key, v.rowid
+    ''', (wanted,))
+    volunteers = cursor.fetchall()
+    metrics.count('rows', len(rows) + len(runs) + len(volunteers))
+    return [(row[2], row[1], row[3]) for row in rows], runs, volunteers
+
+@metrics.timed('sql')
+def load_participant_names(db_path, participant_ids):
+    """Maps the given participant ids to their current names."""
+    conn = get_connection(db_path)
+    cursor = conn.cursor()
+    cursor.execute('''
+        SELECT p.id, p.name FROM json_each(?) w JOIN participants p ON p.id = w.value
+    ''', (json.dumps(list(participant_ids)),))
+    names = dict(cursor.fetchall())
+    metrics.count('rows', len(names))
+    return names
+
+@metrics.timed('sql')
+def get_all_age_groups(db_path, location_slug=None):
+    conn = get_connection(db_path)
+    cursor = conn.cursor()
+    cursor.execute('SELECT gender, age_group FROM age_groups WHERE location_slug = ?', (location_slug or ALL_LOCATIONS,))
     rows = cursor.fetchall()
-    conn.close()
-    age_groups = set()
-    for row in rows:
-        if row[0] is None:
-            continue
-        try:
-            data = json.loads(row[0])
-            for runner in data.get('runners', []):
-                if runner.get('age_group') and runner.get('gender'):
-                    age_groups.add(f"{runner['gender']}{runner['age_group']}")
-        except json.JSONDecodeError:
-            continue
-    return sorted(list(age_groups))
+    return sorted(f"{gender}{age_group}" for gender, age_group in rows)
+
+@metrics.timed('sql')
+def search_runners(db_path, query, limit=SEARCH_LIMIT):
+    """Finds runners and volunteers whose name or ID contains every word of the query.
+
+    Exact ID matches come first, then full-text rank. Words shorter than three characters
+    cannot use the trigram index and are checked against the matched names instead.
+    """
+    terms = query.casefold().split()
+    if not terms:
+        return []
+    long_terms = [t for t in terms if len(t) >= 3]
+    short_terms = [t for t in terms if len(t) < 3]
+    exact_id = int(query) if query.strip().isdigit() else None
 
-def search_runners(db_path, query):
-    conn = sqlite3.connect(db_path)
+    conn = get_connection(db_path)
     cursor = conn.cursor()
-    cursor.execute('SELECT data FROM race_results')
+    conditions = [
+        '(instr(CAST(p.id AS TEXT), ?) > 0 OR instr(casefold(p.name), ?) > 0)' for _ in short_terms
+    ]
+    params = [value for t in short_terms for value in (t, t)]
+    if long_terms and _has_search_index(cursor):
+        match = ' AND '.join('"{}"'.format(t.replace('"', '""')) for t in long_terms)
+        cursor.execute(f'''
+            SELECT p.id, p.name, p.gender, p.age_group
+            FROM participants_fts f
+            JOIN participants p ON p.id = f.rowid
+            WHERE participants_fts MATCH ? {''.join(' AND ' + c for c in conditions)}
+            ORDER BY p.id = ? DESC, f.rank
+            LIMIT ?
+        ''', [match] + params + [exact_id, limit])
+    else:
+        conditions += ['(instr(CAST(p.id AS TEXT), ?) > 0 OR instr(casefold(p.name), ?) > 0)' for _ in long_terms]
+        params += [value for t in long_terms for value in (t, t)]
+        cursor.execute(f'''
+            SELECT p.id, p.name, p.gender, p.age_group
+            FROM participants p
+            WHERE {' AND '.join(conditions)}
+            ORDER BY p.id = ? DESC, p.name
+            LIMIT ?
+        ''', params + [exact_id, limit])
     rows = cursor.fetchall()
-    conn.close()
-    
-    results = []
-    seen_runners = set()
+    metrics.count('rows', len(rows))
+    return [{'id': r[0], 'name': r[1], 'gender': r[2], 'age_group': r[3]} for r in rows]
 
-    for row in rows:
-        if row[0] is None:
-            continue
-        try:
-            data = json.loads(row[0])
-            for runner in data.get('runners', []):
-                runner_id = str(runner.get('id'))
-                runner_name = runner.get('name', '').lower()
-                
-                if runner_id and (query.lower() in runner_id or query.lower() in runner_name):
-                    if runner_id not in seen_runners:
-                        results.append(runner)
-                        seen_runners.add(runner_id)
-        except json.JSONDecodeError:
-            continue
-            
-    return results
\ No newline at end of file
+def _chronological_key(row):
+    return _date_columns(row['race_date'])[0] or '', row['location_slug']
+
+@metrics.timed('sql')
+def load_participant_history(db_path, participant_id):
+    """Every run and volunteer shift of one participant plus their participant_stats rows, or None.
+
+    Reads only the participant's own rows through the runs/volunteering indexes on participant id,
+    with race dates and numbers from race_numbers, so no race is decoded. Runs and shifts are
+    returned oldest first; stats hold one row per location and the 'all' rollup, total_score in
+    raw points.
+    """
+    conn = get_connection(db_path)
+    cursor = conn.cursor()
+    cursor.execute('SELECT id, name, gender, age_group, last_seen FROM participants WHERE id = ?', (participant_id,))
+    row = cursor.fetchone()
+    if not row:
+        return None
+    history = {'id': row[0], 'name': row[1], 'gender': row[2], 'age_group': row[3], 'last_seen': row[4]}
+
+    cursor.execute('''
+        SELECT n.race_date, n.location_slug, n.race_number, r.time_in_seconds, r.overall_rank, r.gender_rank,
+               r.score, r.gender, r.age_group
+        FROM runs r JOIN race_numbers n ON n.race_id = r.race_id
+        WHERE r.runner_id = ?
+    ''', (participant_id,))
+    history['runs'] = sorted(({
+        'race_date': r[0], 'location_slug': r[1], 'race_number': r[2], 'time_in_seconds': r[3],
+        'overall_rank': r[4], 'gender_rank': r[5], 'score': r[6], 'gender': r[7], 'age_group': r[8]
+    } for r in cursor), key=_chronological_key)
+
+    cursor.execute('''
+        SELECT n.race_date, n.location_slug, n.race_number
+        FROM volunteering v JOIN race_numbers n ON n.race_id = v.race_id
+        WHERE v.volunteer_id = ?
+    ''', (participant_id,))
+    history['volunteering'] = sorted(({'race_date': r[0], 'location_slug': r[1], 'race_number': r[2]} for r in cursor),
+                                     key=_chronological_key)
+
+    cursor.execute('''
+        SELECT s.location_slug, l.name, s.total_score, s.run_count, s.volunteer_count, s.total_time_seconds,
+               s.best_time_seconds, n.race_number, n.race_date, n.location_slug, s.gold_medals, s.silver_medals, s.bronze_medals
+        FROM participant_stats s
+        LEFT JOIN locations l ON l.slug = s.location_slug
+        LEFT JOIN race_numbers n ON n.race_id = s.best_time_race_id
+        WHERE s.participant_id = ?
+    ''', (participant_id,))
+    history['stats'] = [{
+        'location_slug': r[0], 'location_name': r[1], 'total_score': r[2], 'run_count': r[3], 'volunteer_count': r[4],
+        'total_time_seconds': r[5], 'best_time_seconds': r[6], 'best_time_race_number': r[7], 'best_time_date': r[8],
+        'best_time_location_slug': r[9], 'gold_medals': r[10], 'silver_medals': r[11], 'bronze_medals': r[12]
+    } for r in cursor]
+    metrics.count('rows', 1 + len(history['runs']) + len(history['volunteering']) + len(history['stats']))
+    return history
+
+_SCORE_ORDER = ('-(s.total_score / 10.0)', lambda row: -row['total_score'])
+
+# Leaderboard orders as ascending (SQL expression, key of a leaderboard row) pairs. Each
+# expression yields exactly the value its key computes from a row load_leaderboard returns,
+# so the key of the last row of a page can be compared in SQL to fetch the next one.
+# The participant id is always appended to break ties.
+LEADERBOARD_ORDERS = {
+    'score': [_SCORE_ORDER],
+    'runs': [('-s.run_count', lambda row: -row['run_count']), _SCORE_ORDER],
+    'volunteers': [('-s.volunteer_count', lambda row: -row['volunteer_count']), _SCORE_ORDER],
+    'best_time': [
+        ('s.best_time_seconds IS NULL', lambda row: int(row['best_time_seconds'] is None)),
+        ('IFNULL(s.best_time_seconds, 0)', lambda row: row['best_time_seconds'] or 0),
+    ],
+    'medals': [
+        ('-s.gold_medals', lambda row: -row['gold_medals']),
+        ('-s.silver_medals', lambda row: -row['silver_medals']),
+        ('-s.bronze_medals', lambda row: -row['bronze_medals']),
+        _SCORE_ORDER,
+    ],
+}
+
+def leaderboard_sort_key(row, order_by):
+    """Ascending sort key of a leaderboard row, as used for ordering and as a keyset cursor."""
+    return tuple(key(row) for _, key in LEADERBOARD_ORDERS[order_by]) + (row['id'],)
+
+@metrics.timed('sql')
+def load_leaderboard(db_path, location_slug, ag_filter=None, order_by='score', limit=None, offset=0, after=None, gender=None):
+    """Reads the precomputed totals of a location (or 'all'). Returns (participants, total_count).
+
+    ag_filter selects participants, not runs: those whose gender and age group (as of their
+    most recent run, see participants) match, with the totals of all their runs. This is the
+    all-locations view. Filtered views of one location count only the runs done in the age
+    group instead (aggregation.calculate_leaderboard), since they aggregate runs anyway.
+    `after` is the leaderboard_sort_key of the last row of the previous page; only rows that
+    sort after it are returned. total_count ignores it. Participants who only volunteered at
+    the location have no gender or age group there, and `gender` leaves them out.
+    """
+    conn = get_connection(db_path)
+    cursor = conn.cursor()
+    where = 's.location_slug = ?'
+    params = [location_slug if location_slug and location_slug != 'all' else ALL_LOCATIONS]
+    if ag_filter and ag_filter != 'all':
+        where += ' AND p.gender || p.age_group = ?'
+        params.append(ag_filter)
+    if gender:
+        where += ' AND p.gender = ? AND s.run_count > 0'
+        params.append(gender)
+    columns = [expression for expression, _ in LEADERBOARD_ORDERS[order_by]] + ['s.participant_id']
+    order = ', '.join(columns)
+
+    cursor.execute(f'SELECT COUNT(*) FROM participant_stats s JOIN participants p ON p.id = s.participant_id WHERE {where}', params)
+    total_count = cursor.fetchone()[0]
+    if after is not None:
+        where += f" AND ({order}) > ({', '.join('?' * len(columns))})"
+        params.extend(after)
+    cursor.execute(f'''
+        SELECT s.participant_id, p.name, CASE WHEN s.run_count > 0 THEN p.gender END,
+               CASE WHEN s.run_count > 0 THEN p.age_group END, s.total_score, s.run_count, s.volunteer_count,
+               s.total_time_seconds, s.best_time_seconds, rr.race_number, rr.race_date, rr.location_slug,
+               s.gold_medals, s.silver_medals, s.bronze_medals
+        FROM participant_stats s
+        JOIN participants p ON p.id = s.participant_id
+        LEFT JOIN race_results rr ON rr.id = s.best_time_race_id
+        WHERE {where}
+        ORDER BY {order}
+        LIMIT ? OFFSET ?
+    ''', params + [limit if limit is not None else -1, offset])
+    rows = cursor.fetchall()
+    metrics.count('rows', len(rows))
+    return [{
+        'id': r[0], 'name': r[1], 'gender': r[2], 'age_group': r[3], 'total_score': r[4] / 10,
+        'run_count': r[5], 'volunteer_count': r[6], 'total_time_seconds': r[7], 'best_time_seconds': r[8],
+        'best_time_race_number': r[9], 'best_time_date': r[10], 'best_time_location_slug': r[11],
+        'gold_medals': r[12], 'silver_medals': r[13], 'bronze_medals': r[14]
+    } for r in rows], total_count
+
+@metrics.timed('sql')
+def load_fastest_run(db_path, location_slug):
+    """Returns the fastest single run at a location, or None."""
+    conn = get_connection(db_path)
+    cursor = conn.cursor()
+    cursor.execute('''
+        SELECT r.runner_id, p.name, r.time_in_seconds, rr.race_number, rr.race_date
+        FROM runs r
+        JOIN race_results rr ON rr.id = r.race_id
+        LEFT JOIN participants p ON p.id = r.runner_id
+        WHERE rr.location_slug = ? AND r.time_in_seconds IS NOT NULL
+        ORDER BY r.time_in_seconds, r.race_id
+        LIMIT 1
+    ''', (location_slug,))
+    row = cursor.fetchone()
+    if not row:
+        return None
+    return {'name': row[1] if row[0] else UNKNOWN_RUNNER_NAME, 'time': row[2], 'race_number': row[3], 'date': row[4]}
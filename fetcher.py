@@ -0,0 +1,123 @@
+import os
+import random
+import threading
+import time
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import telemetry
+
+# Overridable so the scraper can be pointed at a local stub server
+BASE_URL = os.environ.get('VERST_BASE_URL', 'https://5verst.ru').rstrip('/')
+SITE_HOST = urlparse(BASE_URL).netloc
+USER_AGENT = 'Mozilla/5.0'
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+
+class RateLimiter:
+    """Spaces calls evenly so that at most `rate` of them start per second across all threads."""
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate and rate > 0 else 0.0
+        self.next_slot = 0.0
+        self.lock = threading.Lock()
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self.lock:
+            now = time.monotonic()
+            slot = max(now, self.next_slot)
+            self.next_slot = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+
+class Fetcher:
+    """Shared HTTP client for the scraper.
+
+    One keep-alive connection pool for all threads, a global limit on parallel requests and
+    on requests per second, and retries with exponential backoff on timeouts, connection
+    errors, 429 and 5xx. Every call emits a 'fetch' telemetry event.
+    """
+
+    def __init__(self, concurrency=10, rate=10.0, retries=3, backoff=1.0, timeout=15, max_retry_after=60.0):
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        # A server asking for a longer pause would park a worker, and the whole pipeline with it
+        self.max_retry_after = max_retry_after
+        self.session = requests.Session()
+        self.session.headers['User-Agent'] = USER_AGENT
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=concurrency)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.semaphore = threading.BoundedSemaphore(concurrency)
+        self.limiter = RateLimiter(rate)
+
+    def _retry_delay(self, attempt, response):
+        # 429 and 503 may say how long to wait; other failures back off exponentially
+        if response is not None and response.status_code in (429, 503):
+            retry_after = response.headers.get('Retry-After', '')
+            if retry_after.isdigit():
+                return min(float(retry_after), self.max_retry_after)
+        return self.backoff * (2 ** attempt) * (1 + random.random() * 0.1)
+
+    def get(self, url):
+        """Returns the body of `url`. Raises requests.RequestException once retries are exhausted."""
+        return self._request(url).text
+
+    def get_if_changed(self, url, etag=None, last_modified=None):
+        """Conditional GET with the validators of an earlier response.
+
+        Returns (body, etag, last_modified); body is None when the server answered 304 Not
+        Modified. Validators the server does not send are carried over.
+        """
+        headers = {}
+        if etag:
+            headers['If-None-Match'] = etag
+        if last_modified:
+            headers['If-Modified-Since'] = last_modified
+        response = self._request(url, headers)
+        body = None if response.status_code == 304 else response.text
+        return body, response.headers.get('ETag', etag), response.headers.get('Last-Modified', last_modified)
+
+    def _request(self, url, headers=None):
+        call_start = time.monotonic()
+        for attempt in range(self.retries + 1):
+            self.limiter.wait()
+            response, error = None, None
+            start = time.monotonic()
+            try:
+                with self.semaphore:
+                    response = self.session.get(url, headers=headers, timeout=self.timeout)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                error = e
+            elapsed = time.monotonic() - start
+
+            if response is not None:
+                if response.status_code not in RETRY_STATUSES:
+                    try:
+                        response.raise_for_status()
+                    except requests.HTTPError as e:
+                        self._emit(url, response, elapsed, call_start, attempt, e)
+                        raise
+                    self._emit(url, response, elapsed, call_start, attempt)
+                    return response
+                error = requests.HTTPError(f"{response.status_code} for url: {url}", response=response)
+
+            if attempt == self.retries:
+                self._emit(url, response, elapsed, call_start, attempt, error)
+                raise error
+            time.sleep(self._retry_delay(attempt, response))
+
+    def _emit(self, url, response, elapsed, call_start, attempt, error=None):
+        """The 'fetch' event of one get(): `seconds` is its last attempt, `total_seconds` includes retries and waits."""
+        telemetry.emit(
+            'fetch', url=url, status=response.status_code if response is not None else None,
+            bytes=len(response.content) if response is not None else 0,
+            seconds=round(elapsed, 4), total_seconds=round(time.monotonic() - call_start, 4),
+            retries=attempt, error=telemetry.error_cause(error) if error else None
+        )
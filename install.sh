@@ -24,8 +24,9 @@ echo_red() {
 echo_green "Начинаем установку анализатора 5 вёрст..."
 
 # Остановка существующего сервиса, чтобы освободить файлы
-echo "Останавливаем возможный запущенный сервис..."
+echo "Останавливаем возможные запущенные сервисы..."
 sudo systemctl stop verst_analyzer.service
+sudo systemctl stop verst_scheduler.service 2>/dev/null
 
 # Шаг 1: Создание виртуального окружения
 if [ ! -d "$PROJECT_DIR/venv" ]; then
@@ -84,6 +85,9 @@ User=$RUN_USER
 Group=$RUN_USER
 WorkingDirectory=$PROJECT_DIR
 Environment="PATH=$PROJECT_DIR/venv/bin"
+Environment="VERST_METRICS_DIR=$PROJECT_DIR/metrics"
+ExecStartPre=/bin/rm -rf $PROJECT_DIR/metrics
+ExecStartPre=/bin/mkdir -p $PROJECT_DIR/metrics
 ExecStart=$PROJECT_DIR/venv/bin/gunicorn --workers 3 --bind 0.0.0.0:8001 app:app
 
 [Install]
@@ -108,17 +112,45 @@ if [ $? -ne 0 ]; then
 fi
 echo_green "Сервис успешно запущен."
 
-# Шаг 5: Настройка cron
-echo_green "\nШаг 5: Настройка cron для автоматического обновления..."
-CRON_JOB="0 * * * * $PROJECT_DIR/venv/bin/python $PROJECT_DIR/main.py >> $PROJECT_DIR/scraper.log 2>&1"
-(crontab -l 2>/dev/null | grep -v -F "$PROJECT_DIR/main.py" ; echo "$CRON_JOB") | crontab -
+# Шаг 5: Планировщик обновлений
+echo_green "\nШаг 5: Настройка планировщика обновлений (scheduler.py)..."
+
+SCHEDULER_FILE_CONTENT=$(cat <<EOF
+[Unit]
+Description=Incremental 5verst results updater for verst_analyzer
+After=network.target
+
+[Service]
+User=$RUN_USER
+Group=$RUN_USER
+WorkingDirectory=$PROJECT_DIR
+Environment="PATH=$PROJECT_DIR/venv/bin"
+ExecStart=$PROJECT_DIR/venv/bin/python scheduler.py
+Restart=always
+RestartSec=60
+
+[Install]
+WantedBy=multi-user.target
+EOF
+)
+
+echo "$SCHEDULER_FILE_CONTENT" | sudo tee /etc/systemd/system/verst_scheduler.service > /dev/null
+
+# Планировщик заменяет ежечасный запуск main.py из cron, оставленный прежними установками
+(crontab -l 2>/dev/null | grep -v -F "$PROJECT_DIR/main.py") | crontab -
+
+sudo systemctl daemon-reload
+sudo systemctl enable verst_scheduler
+sudo systemctl start verst_scheduler
+
+sudo systemctl status verst_scheduler --no-pager
 if [ $? -ne 0 ]; then
-    echo_red "Не удалось настроить cron. Пожалуйста, добавьте строку вручную, выполнив 'crontab -e'."
-else
-    echo_green "Cron успешно настроен."
+    echo_red "Планировщик не запустился. Проверьте лог выше."
+    exit 1
 fi
+echo_green "Планировщик успешно запущен."
 
 echo_green "\nУстановка завершена!"
 echo "- Ваше приложение работает в фоновом режиме."
-echo "- Данные будут автоматически обновляться каждый час."
+echo "- Новые результаты забегов подгружает планировщик (journalctl -u verst_scheduler)."
 echo "- Вам осталось настроить веб-сервер (Nginx) для доступа к приложению, если это необходимо."
@@ -1,27 +1,53 @@
 import requests
 from bs4 import BeautifulSoup
-import re
 from datetime import date, timedelta, datetime
 import os
+import archive
 import db_manager
+import fetcher
+import results_parser
+import snapshots
+import telemetry
 import json
 import sys
 import concurrent.futures
+import multiprocessing
+import queue
+import sqlite3
+import threading
+import time
 
 DB_PATH = os.path.join(os.path.dirname(__file__), db_manager.DB_NAME)
+FLUSH_SIZE = 50
+FLUSH_INTERVAL = 5.0
+_FLUSH = object()
+CONCURRENCY = 10
+REQUESTS_PER_SECOND = 10.0
+REFETCH_WINDOW = timedelta(days=3)
+MAX_TASK_ATTEMPTS = 3
+TASK_RETRY_DELAY = 10.0
+DISCOVERY_WORKERS = 4
+
+http_client = fetcher.Fetcher(concurrency=CONCURRENCY, rate=REQUESTS_PER_SECOND)
+
+def get_option(name, default, cast=str):
+    """Reads a --name=value command line option."""
+    prefix = f'--{name}='
+    for arg in sys.argv[1:]:
+        if arg.startswith(prefix):
+            return cast(arg[len(prefix):])
+    return default
 
 def get_all_locations():
     """Scrapes the main events page to get a list of all locations."""
-    events_url = "https://5verst.ru/events/"
-    headers = {'User-Agent': 'Mozilla/5.0'}
+    events_url = f"{fetcher.BASE_URL}/events/"
     try:
-        response = requests.get(events_url, headers=headers)
-        response.raise_for_status()
+        page = http_client.get(events_url)
     except requests.RequestException as e:
         print(f"Fatal: Could not fetch locations page: {e}")
         return []
 
-    soup = BeautifulSoup(response.text, 'html.parser')
+    soup = BeautifulSoup(page, 'html.parser')
     locations = []
     seen_slugs = set()
 
@@ -34,9 +60,9 @@ def get_all_locations():
         url = link['href']
         name = link.text.strip()
 
-        if name and '5verst.ru' in url:
+        if name and fetcher.SITE_HOST in url:
             try:
-                path = url.split('5verst.ru/')[1]
+                path = url.split(f'{fetcher.SITE_HOST}/')[1]
                 slug = path.strip('/')
                 if slug and '/' not in slug and '#' not in slug and '?' not in slug:
                     if slug not in seen_slugs:
@@ -46,17 +72,20 @@ def get_all_locations():
                 continue
     return locations
 
+def history_url(location_slug):
+    return f"{fetcher.BASE_URL}/{location_slug}/results/all/"
+
 def get_race_list_for_location(location_slug):
-    """Scrapes the results history page for a single location."""
-    history_url = f"https://5verst.ru/{location_slug}/results/all/"
-    headers = {'User-Agent': 'Mozilla/5.0'}
+    """Scrapes the results history page for a single location; None if the page could not be fetched."""
     try:
-        response = requests.get(history_url, headers=headers)
-        response.raise_for_status()
+        page = http_client.get(history_url(location_slug))
     except requests.RequestException:
-        return []
+        return None
+    return parse_race_list(page)
 
-    soup = BeautifulSoup(response.text, 'html.parser')
+def parse_race_list(page):
+    """Races listed on a results history page, as {'date', 'number', 'url'}."""
+    soup = BeautifulSoup(page, 'html.parser')
     history_table = soup.find('table')
     if not history_table: return []
 
@@ -76,141 +105,301 @@ def get_race_list_for_location(location_slug):
                 continue
     return race_list
 
-def get_results_from_url(url):
-    """Downloads and parses a single race results page."""
-    headers = {'User-Agent': 'Mozilla/5.0'}
+def process_race(race, location_slug, results_queue, parse=results_parser.parse_results):
+    """Worker function to download and parse a single race; saving is left to the writer stage.
+
+    Puts (race_date, location_slug, race_number, results, error, seconds) on the queue;
+    results is None and error is set when the page could not be fetched.
+    """
+    telemetry.log('debug', f"  - Проверка: {race['date']} (№{race['number']})...")
+    start = time.monotonic()
     try:
-        response = requests.get(url, headers=headers, timeout=15)
-        response.raise_for_status()
-        return response.text
+        html_content = http_client.get(race['url'])
     except requests.RequestException as e:
-        print(f"  - Error fetching {url}: {e}")
-        return None
+        telemetry.log('info', f"  - Error fetching {race['url']}: {e}")
+        results_queue.put((race['date'], location_slug, race['number'], None, str(e), time.monotonic() - start))
+        return
+    parse_start = time.monotonic()
+    scraped_data = parse(html_content) if html_content else None
+    if not (scraped_data and (scraped_data.get('runners') or scraped_data.get('volunteers'))):
+        scraped_data = {'runners': [], 'volunteers': []}
+    telemetry.emit(
+        'parse', date=race['date'], number=race['number'], seconds=round(time.monotonic() - parse_start, 4),
+        bytes=len(html_content or ''), runners=len(scraped_data['runners']), volunteers=len(scraped_data['volunteers']),
+        results_queue=results_queue.qsize()
+    )
+    results_queue.put((race['date'], location_slug, race['number'], scraped_data, None, time.monotonic() - start))
 
-def parse_html_for_results(html_content):
-    """Parses the HTML content of a results page."""
-    soup = BeautifulSoup(html_content, 'html.parser')
-    all_tables = soup.find_all('table')
-    runners = []
-    if len(all_tables) > 0:
-        for row in all_tables[0].find_all('tr')[1:]:
-            cells = row.find_all('td')
-            if len(cells) > 3:
-                try:
-                    name_cell = cells[1].find('a')
-                    runner_id = int(name_cell['href'].split('/')[-1]) if name_cell else None
-                    name = name_cell.text.strip() if name_cell else "Неизвестный"
-                    
-                    age_grade_text = cells[2].text.strip()
-                    print(f"Parsing age grade text: '{age_grade_text}'")
-                    score_match = re.search(r'([\d\.]+)\%', age_grade_text)
-                    gender_match = re.search(r'^[МЖ]', age_grade_text)
-                    age_group_match = re.search(r'[МЖ](\d{1,2}-\d{1,2})', age_grade_text)
-
-                    time_text = cells[3].text.strip()
-                    if not re.match(r'^\d{2}:\d{2}:\d{2}$', time_text): continue
-                    time_parts = [int(x) for x in time_text.split(':')]
-
-                    age_group = age_group_match.group(1) if age_group_match else None
-                    print(f"Parsed age group: {age_group} for runner {name}")
-
-                    runners.append({
-                        'id': runner_id, 'name': name,
-                        'score': float(score_match.group(1)) if score_match else 0.0,
-                        'time_in_seconds': time_parts[0] * 3600 + time_parts[1] * 60 + time_parts[2],
-                        'gender': gender_match.group(0) if gender_match else "Н/Д",
-                        'age_group': age_group,
-                        'overall_rank': int(cells[0].text.strip())
-                    })
-                except (ValueError, IndexError, AttributeError): continue
-        
-        fem_runners = sorted([r for r in runners if r['gender'] == 'Ж'], key=lambda x: x['time_in_seconds'])
-        for i, r_data in enumerate(fem_runners): r_data['gender_rank'] = i + 1
-
-    volunteers = []
-    if len(all_tables) > 1:
-        for row in all_tables[1].find('tbody').find_all('tr'):
-            name_tag = row.find('td').find('a')
-            if name_tag:
-                try:
-                    v_id = int(name_tag['href'].split('/')[-1])
-                    if not any(v['id'] == v_id for v in volunteers): 
-                        volunteers.append({'id': v_id, 'name': name_tag.text.strip()})
-                except (ValueError, IndexError, AttributeError): continue
-    
-    return {'runners': runners, 'volunteers': volunteers}
-
-def process_race(race, location_slug):
-    """Worker function to process a single race."""
-    print(f"  - Проверка: {race['date']} (№{race['number']})...")
-    html_content = get_results_from_url(race['url'])
-    if html_content:
-        scraped_data = parse_html_for_results(html_content)
-        if scraped_data and (scraped_data.get('runners') or scraped_data.get('volunteers')):
-            db_manager.save_results(DB_PATH, race['date'], location_slug, race['number'], scraped_data)
-            print(f"    -> Сохранено: {race['date']} ({location_slug}) - {len(scraped_data['runners'])} бегунов, {len(scraped_data['volunteers'])} волонтеров.")
-        else:
-            db_manager.save_results(DB_PATH, race['date'], location_slug, race['number'], {'runners': [], 'volunteers': []})
+def flush_results(batch):
+    """Commits a batch of parsed races and their journal entries in one transaction.
 
-if __name__ == '__main__':
-    db_manager.init_db(DB_PATH)
-    
-    print("Этап 1: Получение списка всех локаций...")
-    locations = get_all_locations()
-    if not locations:
-        print("Не удалось получить список локаций. Выход.")
-        sys.exit(1)
-    
-    db_manager.save_locations(DB_PATH, locations)
-    print(f"Найдено и сохранено {len(locations)} локаций.")
+    Falls back to one race at a time on error; a race that still cannot be saved stays
+    pending in the journal and is picked up by the next retry round or --resume.
+    """
+    races = [item[:4] for item in batch if item[4] is None]
+    tasks = [(item[0], item[1], item[4], item[5]) for item in batch]
+    start = time.monotonic()
+    try:
+        db_manager.save_results_batch(DB_PATH, races, tasks)
+    except sqlite3.Error as e:
+        print(f"  - Ошибка пакетной записи ({len(batch)} забегов): {e}. Сохраняем по одному...")
+        telemetry.emit('save', races=len(races), seconds=round(time.monotonic() - start, 4), error=type(e).__name__)
+        for race_date, location_slug, race_number, results, error, seconds in batch:
+            start = time.monotonic()
+            try:
+                db_manager.save_results_batch(
+                    DB_PATH, [] if error else [(race_date, location_slug, race_number, results)],
+                    [(race_date, location_slug, error, seconds)]
+                )
+            except sqlite3.Error as e:
+                print(f"  - Ошибка записи {race_date} ({location_slug}): {e}")
+                telemetry.emit('save', location=location_slug, date=race_date, races=0, seconds=round(time.monotonic() - start, 4), error=type(e).__name__)
+            else:
+                telemetry.emit('save', location=location_slug, date=race_date, races=0 if error else 1, seconds=round(time.monotonic() - start, 4))
+        return
+    telemetry.emit(
+        'save', races=len(races), failed=len(batch) - len(races), seconds=round(time.monotonic() - start, 4),
+        runners=sum(len(results['runners']) for *_, results in races),
+        volunteers=sum(len(results['volunteers']) for *_, results in races)
+    )
+    for race_date, location_slug, race_number, results in races:
+        telemetry.log('debug', f"    -> Сохранено: {race_date} ({location_slug}) - {len(results['runners'])} бегунов, {len(results['volunteers'])} волонтеров.")
 
-    single_location_slug = None
-    is_full_scan = '--full' in sys.argv
+def write_results(results_queue, flush_size, flush_interval):
+    """Single writer stage: collects parsed races from the queue and commits them in batches.
 
-    for arg in sys.argv[1:]:
-        if arg.startswith('--') and arg != '--full':
-            single_location_slug = arg[2:]
-            break
+    A batch is flushed when it reaches flush_size races or flush_interval seconds after its
+    first race arrived. A None item flushes what is left and stops the writer.
+    """
+    batch = []
+    deadline = None
+    while True:
+        timeout = None if deadline is None else max(0.0, deadline - time.monotonic())
+        try:
+            item = results_queue.get(timeout=timeout)
+        except queue.Empty:
+            item = _FLUSH
+        if item is not None and item is not _FLUSH:
+            batch.append(item)
+            if deadline is None:
+                deadline = time.monotonic() + flush_interval
+            if len(batch) < flush_size:
+                continue
+        if batch:
+            with telemetry.context(results_queue=results_queue.qsize()):
+                flush_results(batch)
+            batch, deadline = [], None
+        if item is None:
+            return
 
-    if single_location_slug:
-        print(f"\nЗапуск в режиме одной локации: {single_location_slug}")
-        locations_to_process = [loc for loc in locations if loc['slug'] == single_location_slug]
-        if not locations_to_process:
-            print(f"Ошибка: Локация '{single_location_slug}' не найдена.")
-            sys.exit(1)
-    else:
-        print("\nЗапуск в режиме умного обновления для всех локаций...")
-        locations_to_process = locations
+def needs_download(race_date, stored):
+    """Smart-update rule: a race is fetched if it is missing or its stored copy may still change.
+
+    Results keep being corrected for REFETCH_WINDOW after the race, so a copy scraped inside
+    that window is fetched again. Races saved before scrape times were recorded fall back
+    to the race date.
+    """
+    if stored is None:
+        return True
+    race_day = datetime.strptime(race_date, '%d.%m.%Y')
+    if stored['scraped_at']:
+        return datetime.fromisoformat(stored['scraped_at']) < race_day + REFETCH_WINDOW
+    return race_day.date() >= date.today() - REFETCH_WINDOW
 
-    tasks_to_run = []
-    today = date.today()
-    update_threshold = today - timedelta(days=3)
+def races_to_download(location_slug, races, stored_races, force):
+    if force:
+        return races
+    return [race for race in races if needs_download(race['date'], stored_races.get((race['date'], location_slug)))]
 
-    for loc in locations_to_process:
-        print(f"--- Поиск забегов для локации: {loc['name']} ---")
+def discover_races(loc, race_queue, stored_races, force, stop_event):
+    """Producer: fetches one location's race history, journals the races that need downloading and queues them."""
+    telemetry.log('info', f"--- Поиск забегов для локации: {loc['name']} ---")
+    start = time.monotonic()
+    with telemetry.context(location=loc['slug']):
         races_for_loc = get_race_list_for_location(loc['slug'])
-        if not races_for_loc:
-            print("Забеги не найдены, пропускаем.")
+    if races_for_loc is None:
+        telemetry.log('info', f"Не удалось получить список забегов ({loc['name']}), повторим позже.")
+        return 0
+    races = races_to_download(loc['slug'], races_for_loc, stored_races, force)
+    db_manager.save_scrape_plan(DB_PATH, loc['slug'], races)
+    if not races_for_loc:
+        telemetry.log('info', f"Забеги не найдены ({loc['name']}), пропускаем.")
+    queued = 0
+    for race in races:
+        if stop_event.is_set():
+            break
+        race_queue.put((race, loc['slug']))
+        queued += 1
+    telemetry.emit(
+        'discover', location=loc['slug'], races=len(races_for_loc), queued=queued,
+        seconds=round(time.monotonic() - start, 4), race_queue=race_queue.qsize()
+    )
+    return queued
+
+def download_races(race_queue, results_queue, stop_event, parse):
+    """Consumer: downloads and parses queued races until it receives None."""
+    while True:
+        task = race_queue.get()
+        if task is None:
+            return
+        if stop_event.is_set():
             continue
+        race, location_slug = task
+        try:
+            with telemetry.context(location=location_slug, race_queue=race_queue.qsize()):
+                process_race(race, location_slug, results_queue, parse)
+        except Exception as e:
+            telemetry.log('info', f"  - Ошибка обработки {race['url']}: {e}")
+            telemetry.emit('parse', location=location_slug, date=race['date'], number=race['number'], error=type(e).__name__)
+            results_queue.put((race['date'], location_slug, race['number'], None, str(e), None))
 
-        for race in races_for_loc:
-            if single_location_slug or is_full_scan:
-                tasks_to_run.append((race, loc['slug']))
-                continue
+def run_pipeline(locations, tasks, force, concurrency, flush_size, flush_interval, parser='fast', parse_processes=0):
+    """Runs location discovery, race downloads and the database writer as overlapping stages.
 
-            race_date_obj = datetime.strptime(race['date'], '%d.%m.%Y').date()
-            if race_date_obj < update_threshold:
-                if not db_manager.load_results(DB_PATH, race['date'], loc['slug']):
-                    tasks_to_run.append((race, loc['slug']))
-            else:
-                tasks_to_run.append((race, loc['slug']))
+    `tasks` are (race, location_slug) pairs already planned by an earlier run; they are queued
+    before the race lists of `locations` are fetched.
+
+    Bounded queues between the stages give backpressure: discovery waits when downloads fall
+    behind and downloads wait when the writer does. On Ctrl+C the queued work is dropped,
+    but races that are already parsed are still written. With parse_processes > 0 pages
+    are parsed in a process pool so parsing is not serialized by the GIL with the download
+    threads. Returns the number of queued races.
+    """
+    stored_races = {} if force else db_manager.load_race_index(DB_PATH)
+    race_queue = queue.Queue(maxsize=concurrency * 4)
+    results_queue = queue.Queue(maxsize=flush_size * 2)
+    stop_event = threading.Event()
+    parse = results_parser.PARSERS[parser]
+    parse_pool = None
+    if parse_processes > 0:
+        # Spawned rather than forked: the pool starts while other threads may hold locks
+        parse_pool = concurrent.futures.ProcessPoolExecutor(max_workers=parse_processes, mp_context=multiprocessing.get_context('spawn'))
+        parse = lambda html, parse_page=parse: parse_pool.submit(parse_page, html).result()
+
+    writer = threading.Thread(target=write_results, args=(results_queue, flush_size, flush_interval))
+    writer.start()
+    downloaders = [threading.Thread(target=download_races, args=(race_queue, results_queue, stop_event, parse)) for _ in range(concurrency)]
+    for thread in downloaders:
+        thread.start()
+
+    discovery = concurrent.futures.ThreadPoolExecutor(max_workers=DISCOVERY_WORKERS)
+    queued = 0
+    try:
+        for task in tasks:
+            race_queue.put(task)
+            queued += 1
+        for count in discovery.map(lambda loc: discover_races(loc, race_queue, stored_races, force, stop_event), locations):
+            queued += count
+    except KeyboardInterrupt:
+        print("\nПрерывание: дожидаемся записи уже скачанных забегов...")
+        stop_event.set()
+        raise
+    finally:
+        discovery.shutdown(wait=True, cancel_futures=True)
+        for _ in downloaders:
+            race_queue.put(None)
+        for thread in downloaders:
+            thread.join()
+        if parse_pool:
+            parse_pool.shutdown()
+        results_queue.put(None)
+        writer.join()
+    return queued
+
+if __name__ == '__main__':
+    db_manager.init_db(DB_PATH)
+    log_level = get_option('log-level', 'quiet')
+    if log_level not in telemetry.LEVELS:
+        print(f"Ошибка: неизвестный уровень журнала '{log_level}', доступны: {', '.join(telemetry.LEVELS)}.")
+        sys.exit(1)
+    telemetry.configure(log_level, get_option('events', None))
+    concurrency = get_option('concurrency', CONCURRENCY, int)
+    http_client = fetcher.Fetcher(concurrency=concurrency, rate=get_option('rps', REQUESTS_PER_SECOND, float))
+    parser = get_option('parser', 'fast')
+    if parser not in results_parser.PARSERS:
+        print(f"Ошибка: неизвестный парсер '{parser}', доступны: {', '.join(results_parser.PARSERS)}.")
+        sys.exit(1)
+    
+    resume = '--resume' in sys.argv
+    if resume:
+        locations_to_process, tasks = db_manager.load_scrape_job(DB_PATH, MAX_TASK_ATTEMPTS)
+        if not (locations_to_process or tasks):
+            print("Незавершенного сбора нет.")
+            sys.exit(0)
+        force = any(loc['full_scan'] for loc in locations_to_process)
+        print(f"Продолжение прерванного сбора: {len(tasks)} забегов в очереди, {len(locations_to_process)} локаций без списка забегов.")
+    else:
+        print("Этап 1: Получение списка всех локаций...")
+        locations = get_all_locations()
+        if not locations:
+            print("Не удалось получить список локаций. Выход.")
+            sys.exit(1)
+
+        db_manager.save_locations(DB_PATH, locations)
+        print(f"Найдено и сохранено {len(locations)} локаций.")
+
+        single_location_slug = None
+        is_full_scan = '--full' in sys.argv
+
+        for arg in sys.argv[1:]:
+            if arg.startswith('--') and arg != '--full' and '=' not in arg:
+                single_location_slug = arg[2:]
+                break
 
-    if not tasks_to_run:
+        if single_location_slug:
+            print(f"\nЗапуск в режиме одной локации: {single_location_slug}")
+            locations_to_process = [loc for loc in locations if loc['slug'] == single_location_slug]
+            if not locations_to_process:
+                print(f"Ошибка: Локация '{single_location_slug}' не найдена.")
+                sys.exit(1)
+        else:
+            print("\nЗапуск в режиме умного обновления для всех локаций...")
+            locations_to_process = locations
+        force = bool(single_location_slug or is_full_scan)
+        db_manager.start_scrape_job(DB_PATH, locations_to_process, force)
+        tasks = []
+
+    pipeline_options = dict(
+        force=force,
+        concurrency=concurrency,
+        flush_size=get_option('flush-size', FLUSH_SIZE, int),
+        flush_interval=get_option('flush-interval', FLUSH_INTERVAL, float),
+        parser=parser,
+        parse_processes=get_option('parse-processes', 0, int),
+    )
+    print(f"\nЭтап 2: Поиск и скачивание забегов ({concurrency} потоков)...")
+    try:
+        queued = run_pipeline(locations_to_process, tasks, **pipeline_options)
+        # Failed pages and race lists get a few more rounds, each after a longer pause
+        for attempt in range(1, MAX_TASK_ATTEMPTS):
+            retry_locations, retry_tasks = db_manager.load_scrape_job(DB_PATH, MAX_TASK_ATTEMPTS)
+            if not (retry_locations or retry_tasks):
+                break
+            print(f"\nПовтор через {TASK_RETRY_DELAY * attempt:.0f} с: {len(retry_tasks)} забегов, {len(retry_locations)} локаций...")
+            time.sleep(TASK_RETRY_DELAY * attempt)
+            run_pipeline(retry_locations, retry_tasks, **pipeline_options)
+    except KeyboardInterrupt:
+        telemetry.report()
+        telemetry.close()
+        print("Сбор данных прерван. Продолжить: main.py --resume")
+        sys.exit(130)
+    if not queued:
         print("\nНет новых забегов для обновления.")
     else:
-        print(f"\nВсего задач на скачивание: {len(tasks_to_run)}. Запускаем {min(10, len(tasks_to_run))} потоков...")
-        with concurrent.futures.ThreadPoolExecutor(max_workers=10) as executor:
-            futures = [executor.submit(process_race, task[0], task[1]) for task in tasks_to_run]
-            concurrent.futures.wait(futures)
-            
+        print(f"\nОбработано забегов: {queued}.")
+    failed = db_manager.count_scrape_tasks(DB_PATH).get('failed', 0)
+    if failed:
+        print(f"Не удалось скачать забегов: {failed} (подробности в таблице scrape_tasks).")
+
+    print("\nЭтап 3: Подготовка готовых рейтингов...")
+    # The archive is built last and stamped with the generation: if it is current, nothing changed since
+    if archive.is_current(DB_PATH):
+        print("Данные не изменились, готовые рейтинги и архив для сайта актуальны.")
+    else:
+        print(f"Построено рейтингов: {snapshots.build_snapshots(DB_PATH)}.")
+        races, runs, shifts = archive.build(DB_PATH)
+        print(f"Архив для сайта обновлен: {races} забегов, {runs} результатов, {shifts} волонтерских смен.")
+
+    telemetry.report()
+    telemetry.close()
     print("\nСбор данных завершен.")
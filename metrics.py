@@ -0,0 +1,259 @@
+"""Opt-in request metrics of the web app, exported in the Prometheus text format.
+
+Enabled by setting VERST_METRICS_DIR to a writable directory. Every request gets exclusive
+per-stage timers (sql, aggregate, serialize, ...; whatever no stage claims is 'other'), its
+response size, the rows read and blobs decoded, and response cache hits. Each gunicorn worker
+keeps its own totals and a background thread writes them to <dir>/worker-<pid>-*.json once a
+second; render() sums the files of all workers, including ones that have exited, so counters never go
+backwards. The directory must be emptied when the service starts; verst_analyzer.service does
+it with ExecStartPre.
+
+Requests slower than VERST_SLOW_REQUEST_SECONDS are logged with their stage breakdown. A
+VERST_PROFILE_SAMPLE share of requests runs under cProfile, and the profile of a slow one is
+saved to <dir>/profiles/ for `python -m pstats`.
+"""
+import atexit
+import cProfile
+import contextlib
+import functools
+import glob
+import json
+import os
+import random
+import threading
+import time
+
+METRICS_DIR = os.environ.get('VERST_METRICS_DIR')
+ENABLED = bool(METRICS_DIR)
+SLOW_REQUEST_SECONDS = float(os.environ.get('VERST_SLOW_REQUEST_SECONDS', 1.0))
+PROFILE_SAMPLE = float(os.environ.get('VERST_PROFILE_SAMPLE', 0.0))
+MAX_PROFILES = 100
+FLUSH_INTERVAL = 1.0
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# (name, type, help) of every exported metric family
+FAMILIES = [
+    ('verst_http_requests_total', 'counter', 'Requests served, by endpoint and status.'),
+    ('verst_http_request_duration_seconds', 'histogram', 'Time from the start of a request to its response.'),
+    ('verst_http_response_bytes_total', 'counter', 'Response body bytes sent, as sent (i.e. compressed).'),
+    ('verst_stage_seconds_total', 'counter', 'Exclusive time spent in each stage of a request.'),
+    ('verst_rows_read_total', 'counter', 'Rows read from the database.'),
+    ('verst_blobs_decoded_total', 'counter', 'Stored payloads decoded, such as leaderboard snapshots.'),
+    ('verst_response_cache_hits_total', 'counter', 'Response cache lookups answered from the cache.'),
+    ('verst_response_cache_misses_total', 'counter', 'Response cache lookups that had to compute.'),
+    ('verst_slow_requests_total', 'counter', 'Requests slower than the slow request threshold.'),
+]
+# Per-request counters and the families they are added to
+COUNTERS = {
+    'rows': 'verst_rows_read_total',
+    'blobs': 'verst_blobs_decoded_total',
+    'cache_hits': 'verst_response_cache_hits_total',
+    'cache_misses': 'verst_response_cache_misses_total',
+}
+
+_local = threading.local()
+_lock = threading.Lock()
+_write_lock = threading.Lock()
+_samples = {}
+_dirty = False
+_worker_file = None
+_flusher_pid = None
+
+
+class _Request:
+    __slots__ = ('endpoint', 'start', 'stages', 'counts', 'nested', 'profiler')
+
+    def __init__(self, endpoint, profiler):
+        self.endpoint = endpoint
+        self.start = time.perf_counter()
+        self.stages = {}
+        self.counts = {}
+        # Time spent in the stages nested inside each open stage, innermost last
+        self.nested = []
+        self.profiler = profiler
+
+
+class _Stage:
+    __slots__ = ('request', 'name', 'start')
+
+    def __init__(self, request, name):
+        self.request = request
+        self.name = name
+
+    def __enter__(self):
+        self.request.nested.append(0.0)
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc):
+        elapsed = time.perf_counter() - self.start
+        request = self.request
+        nested = request.nested.pop()
+        request.stages[self.name] = request.stages.get(self.name, 0.0) + elapsed - nested
+        if request.nested:
+            request.nested[-1] += elapsed
+        return False
+
+
+_NO_STAGE = contextlib.nullcontext()
+
+def stage(name):
+    """Context manager adding its time, minus that of stages nested in it, to a stage of the current request."""
+    request = getattr(_local, 'request', None)
+    return _Stage(request, name) if request is not None else _NO_STAGE
+
+def timed(name):
+    """Decorator running a function as a stage; the function itself is returned when metrics are off."""
+    def decorate(fn):
+        if not ENABLED:
+            return fn
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with stage(name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorate
+
+def count(name, n=1):
+    """Adds n to a per-request counter (see COUNTERS); a no-op outside an instrumented request."""
+    request = getattr(_local, 'request', None)
+    if request is not None:
+        request.counts[name] = request.counts.get(name, 0) + n
+
+def start_request(endpoint):
+    _start_flusher()
+    profiler = None
+    if PROFILE_SAMPLE and random.random() < PROFILE_SAMPLE:
+        profiler = cProfile.Profile()
+        profiler.enable()
+    _local.request = _Request(endpoint, profiler)
+
+def finish_request(method, path, status, response_bytes):
+    """Records the current request; logs it, and saves its profile if it was sampled, when it was slow."""
+    request = getattr(_local, 'request', None)
+    if request is None:
+        return
+    _local.request = None
+    duration = time.perf_counter() - request.start
+    if request.profiler:
+        request.profiler.disable()
+    request.stages['other'] = max(0.0, duration - sum(request.stages.values()))
+    slow = duration >= SLOW_REQUEST_SECONDS
+
+    endpoint = (('endpoint', request.endpoint),)
+    with _lock:
+        _add('verst_http_requests_total', endpoint + (('status', str(status)),))
+        for le in DURATION_BUCKETS:
+            if duration <= le:
+                _add('verst_http_request_duration_seconds_bucket', endpoint + (('le', repr(le)),))
+        _add('verst_http_request_duration_seconds_bucket', endpoint + (('le', '+Inf'),))
+        _add('verst_http_request_duration_seconds_sum', endpoint, duration)
+        _add('verst_http_request_duration_seconds_count', endpoint)
+        if response_bytes:
+            _add('verst_http_response_bytes_total', endpoint, response_bytes)
+        for name, seconds in request.stages.items():
+            _add('verst_stage_seconds_total', endpoint + (('stage', name),), seconds)
+        for name, value in request.counts.items():
+            _add(COUNTERS[name], endpoint, value)
+        if slow:
+            _add('verst_slow_requests_total', endpoint)
+
+    if slow:
+        stages = ', '.join(f'{name} {seconds:.3f}' for name, seconds in sorted(request.stages.items(), key=lambda item: -item[1]))
+        counts = ', '.join(f'{name} {value}' for name, value in sorted(request.counts.items()))
+        print(f"Slow request {method} {path}: {duration:.3f} s, status {status}; stages: {stages}" + (f"; {counts}" if counts else ''))
+        if request.profiler:
+            _save_profile(request.profiler, request.endpoint)
+
+def _add(name, labels, value=1):
+    global _dirty
+    key = (name, labels)
+    _samples[key] = _samples.get(key, 0) + value
+    _dirty = True
+
+def _save_profile(profiler, endpoint):
+    directory = os.path.join(METRICS_DIR, 'profiles')
+    os.makedirs(directory, exist_ok=True)
+    if len(os.listdir(directory)) >= MAX_PROFILES:
+        return
+    name = ''.join(c if c.isalnum() else '_' for c in endpoint).strip('_') or 'root'
+    path = os.path.join(directory, f"{name}-{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}-{time.time_ns() % 10**9}.prof")
+    profiler.dump_stats(path)
+    print(f"Profile saved to {path}")
+
+def _worker_path():
+    """This process's metrics file; named by pid and start time, so a reused pid never overwrites a dead worker's totals."""
+    global _worker_file
+    if _worker_file is None or _worker_file[0] != os.getpid():
+        _worker_file = (os.getpid(), os.path.join(METRICS_DIR, f'worker-{os.getpid()}-{time.time_ns()}.json'))
+    return _worker_file[1]
+
+def _flush():
+    """Writes this worker's totals to its file if they changed since the last write."""
+    global _dirty
+    # One writer at a time, so an older snapshot of the totals never replaces a newer one
+    with _write_lock:
+        with _lock:
+            if not _dirty:
+                return
+            _dirty = False
+            samples = [[name, list(labels), value] for (name, labels), value in _samples.items()]
+        os.makedirs(METRICS_DIR, exist_ok=True)
+        path = _worker_path()
+        # Written aside and renamed, so render() in another worker never reads half a file
+        with open(f'{path}.tmp', 'w', encoding='utf-8') as f:
+            json.dump({'samples': samples}, f)
+        os.replace(f'{path}.tmp', path)
+
+def _flush_periodically():
+    while True:
+        time.sleep(FLUSH_INTERVAL)
+        _flush()
+
+def _start_flusher():
+    """Starts the flushing thread of this process; gunicorn forks workers, so each needs its own."""
+    global _flusher_pid
+    if _flusher_pid != os.getpid():
+        with _lock:
+            if _flusher_pid == os.getpid():
+                return
+            _flusher_pid = os.getpid()
+        threading.Thread(target=_flush_periodically, name='metrics-flush', daemon=True).start()
+
+def _escape(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def render():
+    """All workers' metrics summed, in the Prometheus text exposition format."""
+    _flush()
+    totals = {}
+    for path in glob.glob(os.path.join(METRICS_DIR, 'worker-*.json')):
+        try:
+            with open(path, encoding='utf-8') as f:
+                samples = json.load(f)['samples']
+        except (OSError, ValueError, KeyError):
+            continue
+        for name, labels, value in samples:
+            key = (name, tuple(tuple(label) for label in labels))
+            totals[key] = totals.get(key, 0) + value
+
+    lines = []
+    for family, kind, help_text in FAMILIES:
+        lines += [f'# HELP {family} {help_text}', f'# TYPE {family} {kind}']
+        names = [f'{family}_bucket', f'{family}_sum', f'{family}_count'] if kind == 'histogram' else [family]
+        for name in names:
+            for (sample, labels), value in sorted(totals.items(), key=_sort_key):
+                if sample == name:
+                    label_text = ','.join(f'{key}="{_escape(val)}"' for key, val in labels)
+                    lines.append(f'{name}{{{label_text}}} {value!r}')
+    return '\n'.join(lines) + '\n'
+
+def _sort_key(item):
+    """Orders samples by their labels, with histogram buckets by their numeric bound."""
+    (name, labels), _ = item
+    return name, tuple((key, float(value.replace('+Inf', 'inf')) if key == 'le' else value) for key, value in labels)
+
+
+if ENABLED:
+    # Whatever a worker counted since its last flush is written when it exits
+    atexit.register(_flush)
@@ -0,0 +1,278 @@
+import re
+from html.parser import HTMLParser
+
+from bs4 import BeautifulSoup
+
+UNKNOWN_RUNNER_NAME = "Неизвестный"
+
+SCORE_RE = re.compile(r'([\d\.]+)\%')
+GENDER_RE = re.compile(r'^[МЖ]')
+AGE_GROUP_RE = re.compile(r'[МЖ](\d{1,2}-\d{1,2})')
+TIME_RE = re.compile(r'^\d{2}:\d{2}:\d{2}$')
+
+# Mirrors how BeautifulSoup's html.parser tree builder shapes the document, so both parsers
+# see the same cells: void elements never stay open, text inside these tags is not part of
+# .text, and whitespace-only runs collapse to a single space or newline outside <pre>/<textarea>
+VOID_TAGS = {
+    'area', 'base', 'br', 'col', 'embed', 'hr', 'img', 'input', 'keygen', 'link', 'menuitem',
+    'meta', 'param', 'source', 'track', 'wbr', 'basefont', 'bgsound', 'command', 'frame',
+    'image', 'isindex', 'nextid', 'spacer'
+}
+NON_TEXT_TAGS = {'rt', 'rp', 'style', 'script', 'template'}
+PRESERVE_WHITESPACE_TAGS = {'pre', 'textarea'}
+ASCII_SPACES = ' \n\t\x0c\r'
+
+
+def _runner_from_cells(cells):
+    """Builds one runner from the texts and first links of a results row, or None to skip it."""
+    try:
+        name_cell = cells[1].link
+        runner_id = int(name_cell.attrs.get('href').split('/')[-1]) if name_cell else None
+        name = name_cell.text.strip() if name_cell else UNKNOWN_RUNNER_NAME
+
+        age_grade_text = cells[2].text.strip()
+        score_match = SCORE_RE.search(age_grade_text)
+        gender_match = GENDER_RE.search(age_grade_text)
+        age_group_match = AGE_GROUP_RE.search(age_grade_text)
+
+        time_text = cells[3].text.strip()
+        if not TIME_RE.match(time_text):
+            return None
+        time_parts = [int(x) for x in time_text.split(':')]
+
+        return {
+            'id': runner_id, 'name': name,
+            'score': float(score_match.group(1)) if score_match else 0.0,
+            'time_in_seconds': time_parts[0] * 3600 + time_parts[1] * 60 + time_parts[2],
+            'gender': gender_match.group(0) if gender_match else "Н/Д",
+            'age_group': age_group_match.group(1) if age_group_match else None,
+            'overall_rank': int(cells[0].text.strip())
+        }
+    except (ValueError, IndexError, AttributeError):
+        return None
+
+
+def _rank_women(runners):
+    fem_runners = sorted([r for r in runners if r['gender'] == 'Ж'], key=lambda x: x['time_in_seconds'])
+    for i, r_data in enumerate(fem_runners):
+        r_data['gender_rank'] = i + 1
+
+
+class _Node:
+    """The little a fast parse needs to know about an element: its text, first link, cells and rows."""
+    __slots__ = ('attrs', 'parts', 'link', 'cells', 'rows', 'body', 'open')
+
+    def __init__(self, attrs=None):
+        self.attrs = attrs
+        self.parts = []
+        self.link = None
+        self.cells = []
+        self.rows = []
+        self.body = None
+        self.open = True
+
+    @property
+    def text(self):
+        return ''.join(self.parts)
+
+
+class _ResultsTableParser(HTMLParser):
+    """Streams a results page and keeps only the rows of its first two tables."""
+
+    def __init__(self):
+        super().__init__()
+        self.stack = []
+        self.open_counts = {}
+        self.open_cells = []
+        self.open_links = []
+        self.open_rows = []
+        self.closed_void_tags = []
+        self.data = []
+        self.skip_text = 0
+        self.preserve_whitespace = 0
+        self.tables = []
+
+    def flush(self, cdata=False):
+        if not self.data:
+            return
+        text = ''.join(self.data)
+        self.data = []
+        if not self.preserve_whitespace and not text.strip(ASCII_SPACES):
+            text = '\n' if '\n' in text else ' '
+        if self.skip_text and not cdata:
+            return
+        for node in self.open_cells:
+            node.parts.append(text)
+        for node in self.open_links:
+            node.parts.append(text)
+
+    def handle_starttag(self, tag, attrs):
+        self.flush()
+        node = None
+        if tag == 'td':
+            node = _Node()
+            for row in self.open_rows:
+                row.cells.append(node)
+            self.open_cells.append(node)
+        elif tag == 'a':
+            node = _Node(attrs={key: value or '' for key, value in attrs})
+            for cell in self.open_cells:
+                if cell.link is None:
+                    cell.link = node
+            self.open_links.append(node)
+        elif tag == 'tr':
+            node = _Node()
+            if self.tables and self.tables[0].open:
+                self.tables[0].rows.append(node)
+            if len(self.tables) > 1 and self.tables[1].body is not None and self.tables[1].body.open:
+                self.tables[1].body.rows.append(node)
+            self.open_rows.append(node)
+        elif tag == 'table':
+            node = _Node()
+            if len(self.tables) < 2:
+                self.tables.append(node)
+        elif tag == 'tbody':
+            node = _Node()
+            if len(self.tables) > 1 and self.tables[1].body is None and self.tables[1].open:
+                self.tables[1].body = node
+
+        if tag in VOID_TAGS:
+            # BeautifulSoup ignores a later stray end tag for a void element it has already closed
+            self.closed_void_tags.append(tag)
+            return
+        self.stack.append((tag, node))
+        self.open_counts[tag] = self.open_counts.get(tag, 0) + 1
+        if tag in NON_TEXT_TAGS:
+            self.skip_text += 1
+        if tag in PRESERVE_WHITESPACE_TAGS:
+            self.preserve_whitespace += 1
+
+    def close_node(self, node):
+        node.open = False
+        for open_nodes in (self.open_cells, self.open_links, self.open_rows):
+            if open_nodes and open_nodes[-1] is node:
+                open_nodes.pop()
+
+    def handle_startendtag(self, tag, attrs):
+        if tag in VOID_TAGS:
+            self.handle_starttag(tag, attrs)
+            self.closed_void_tags.pop()
+        else:
+            self.handle_starttag(tag, attrs)
+            self.handle_endtag(tag)
+
+    def handle_endtag(self, tag):
+        if tag in self.closed_void_tags:
+            self.closed_void_tags.remove(tag)
+            return
+        self.flush()
+        # Like BeautifulSoup: close everything up to the latest open tag of this name, if any
+        if not self.open_counts.get(tag):
+            return
+        while self.stack:
+            name, node = self.stack.pop()
+            self.open_counts[name] -= 1
+            if node is not None:
+                self.close_node(node)
+            if name in NON_TEXT_TAGS:
+                self.skip_text -= 1
+            if name in PRESERVE_WHITESPACE_TAGS:
+                self.preserve_whitespace -= 1
+            if name == tag:
+                break
+
+    def handle_data(self, data):
+        self.data.append(data)
+
+    # Comments, declarations and processing instructions end a text run but are not text
+    def handle_comment(self, data):
+        self.flush()
+
+    def handle_decl(self, decl):
+        self.flush()
+
+    def handle_pi(self, data):
+        self.flush()
+
+    def unknown_decl(self, data):
+        self.flush()
+        # CDATA sections are ordinary text for BeautifulSoup
+        if data.upper().startswith('CDATA['):
+            self.data.append(data[len('CDATA['):])
+            self.flush(cdata=True)
+
+
+def parse_results(html_content):
+    """Parses a results page into {'runners', 'volunteers'}; same output as parse_results_bs4, several times faster."""
+    parser = _ResultsTableParser()
+    parser.feed(html_content)
+    parser.close()
+    parser.flush()
+
+    runners = []
+    if parser.tables:
+        for row in parser.tables[0].rows[1:]:
+            if len(row.cells) > 3:
+                runner = _runner_from_cells(row.cells)
+                if runner:
+                    runners.append(runner)
+        _rank_women(runners)
+
+    volunteers = []
+    seen = set()
+    if len(parser.tables) > 1 and parser.tables[1].body is not None:
+        for row in parser.tables[1].body.rows:
+            name_tag = row.cells[0].link if row.cells else None
+            if name_tag:
+                try:
+                    v_id = int(name_tag.attrs.get('href').split('/')[-1])
+                    if v_id not in seen:
+                        seen.add(v_id)
+                        volunteers.append({'id': v_id, 'name': name_tag.text.strip()})
+                except (ValueError, IndexError, AttributeError): continue
+
+    return {'runners': runners, 'volunteers': volunteers}
+
+
+class _Cell:
+    """Adapts a BeautifulSoup <td> to the interface _runner_from_cells expects."""
+    __slots__ = ('text', 'link')
+
+    def __init__(self, td):
+        self.text = td.text
+        self.link = td.find('a')
+
+
+def parse_results_bs4(html_content):
+    """Reference parser built on BeautifulSoup; slower, kept to check parse_results against."""
+    soup = BeautifulSoup(html_content, 'html.parser')
+    all_tables = soup.find_all('table')
+    runners = []
+    if len(all_tables) > 0:
+        for row in all_tables[0].find_all('tr')[1:]:
+            cells = row.find_all('td')
+            if len(cells) > 3:
+                runner = _runner_from_cells([_Cell(td) for td in cells])
+                if runner:
+                    runners.append(runner)
+        _rank_women(runners)
+
+    volunteers = []
+    seen = set()
+    volunteer_body = all_tables[1].find('tbody') if len(all_tables) > 1 else None
+    if volunteer_body is not None:
+        for row in volunteer_body.find_all('tr'):
+            first_cell = row.find('td')
+            name_tag = first_cell.find('a') if first_cell is not None else None
+            if name_tag:
+                try:
+                    v_id = int(name_tag.get('href').split('/')[-1])
+                    if v_id not in seen:
+                        seen.add(v_id)
+                        volunteers.append({'id': v_id, 'name': name_tag.text.strip()})
+                except (ValueError, IndexError, AttributeError): continue
+
+    return {'runners': runners, 'volunteers': volunteers}
+
+
+PARSERS = {'fast': parse_results, 'bs4': parse_results_bs4}
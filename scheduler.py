@@ -0,0 +1,221 @@
+"""Long-running incremental updater that only polls locations whose results are due.
+
+5 вёрст races are held on each location's usual weekdays (Saturday almost everywhere) and the
+results are published within hours. Instead of reading the race history of every location on
+every run, the scheduler learns each location's race weekdays from its latest stored races and,
+from RESULTS_FROM_HOUR on a race day, polls only the history pages of locations whose race of
+that day is not stored yet (the expected race number is the last stored one plus one). Polls
+are conditional requests (ETag / Last-Modified) and the interval between them doubles while the
+page stays the same. Once the race is stored the location rests until its next race day, apart
+from one re-check after main.REFETCH_WINDOW that picks up corrected results. A weekly sweep over
+all locations and a daily refresh of the locations list catch new locations and races held on
+unusual days. The polling state is kept in the location_schedule table, so restarts are cheap.
+
+    python scheduler.py [--once] [--concurrency=4] [--rps=2] [--log-level=quiet] [--events=FILE]
+"""
+import concurrent.futures
+import hashlib
+import json
+import sqlite3
+import sys
+import time
+from collections import Counter
+from datetime import date, datetime, timedelta
+
+import requests
+
+import archive
+import db_manager
+import fetcher
+import main
+import results_parser
+import snapshots
+import telemetry
+from main import get_option
+
+DB_PATH = main.DB_PATH
+TICK_SECONDS = 60
+# Local time; races start at 9:00 and the results take a while to appear
+RESULTS_FROM_HOUR = 10
+# Results that have not appeared this many days after a race day are no longer waited for
+GIVE_UP_DAYS = 2
+POLL_INTERVAL = 15 * 60
+MAX_POLL_INTERVAL = 2 * 3600
+# Race weekdays are learned from this many latest races; rarer weekdays (holiday races) are not polled
+CALENDAR_RACES = 12
+MIN_WEEKDAY_SHARE = 0.25
+DEFAULT_WEEKDAYS = {5}
+SWEEP_INTERVAL = 7 * 86400
+LOCATIONS_INTERVAL = 86400
+CONCURRENCY = 4
+REQUESTS_PER_SECOND = 2.0
+
+
+def race_weekdays(races):
+    """Weekdays a location races on, from its latest (race_date_iso, race_number) pairs; Saturday if it has none."""
+    if not races:
+        return DEFAULT_WEEKDAYS
+    counts = Counter(date.fromisoformat(race_date).weekday() for race_date, _ in races)
+    return {weekday for weekday, count in counts.items() if count >= len(races) * MIN_WEEKDAY_SHARE}
+
+def awaited_race_day(weekdays, last_race_date, now):
+    """The latest race day, at most GIVE_UP_DAYS ago, whose results are due but not stored yet; None if there is none."""
+    for days_back in range(GIVE_UP_DAYS + 1):
+        day = now.date() - timedelta(days=days_back)
+        if day.weekday() not in weekdays or (last_race_date and last_race_date >= day):
+            continue
+        if days_back or now.hour >= RESULTS_FROM_HOUR:
+            return day
+    return None
+
+def new_state(location_slug):
+    return {
+        'location_slug': location_slug, 'etag': None, 'last_modified': None, 'race_list_digest': None,
+        'awaiting': None, 'poll_interval': POLL_INTERVAL, 'next_poll': 0.0, 'recheck_at': None,
+    }
+
+def poll(state, forced, stored_races):
+    """Fetches a location's history page unless it is unchanged; returns the races to download, or None.
+
+    A forced poll (the correction re-check) skips the validators and the race list digest.
+    """
+    slug = state['location_slug']
+    with telemetry.context(location=slug):
+        body, etag, last_modified = main.http_client.get_if_changed(
+            main.history_url(slug), None if forced else state['etag'], None if forced else state['last_modified']
+        )
+    state.update(etag=etag, last_modified=last_modified)
+    if body is None:
+        return None
+    races = main.parse_race_list(body)
+    # Some servers answer 200 whatever the validators; an identical race list counts as unchanged
+    digest = hashlib.sha1(json.dumps(races, sort_keys=True).encode()).hexdigest()
+    if digest == state['race_list_digest'] and not forced:
+        return None
+    state['race_list_digest'] = digest
+    return main.races_to_download(slug, races, stored_races, force=False)
+
+def refresh_locations(clock):
+    locations = main.get_all_locations()
+    if locations:
+        db_manager.save_locations(DB_PATH, locations)
+        db_manager.set_meta(DB_PATH, 'scheduler_locations_at', int(clock))
+
+def publish():
+    """Rebuilds the snapshots and the archive if the data changed since the archive was built.
+
+    Not only downloads change it: a refreshed locations list bumps the generation as well.
+    """
+    if not archive.is_current(DB_PATH):
+        snapshots.build_snapshots(DB_PATH)
+        archive.build(DB_PATH)
+
+def run_once(now=None, concurrency=CONCURRENCY, parser='fast'):
+    """One scheduling round: polls the locations that are due and downloads their new races.
+
+    Returns (locations polled, races downloaded).
+    """
+    now = now or datetime.now()
+    clock = now.timestamp()
+    if clock - db_manager.get_meta(DB_PATH, 'scheduler_locations_at', 0) >= LOCATIONS_INTERVAL:
+        refresh_locations(clock)
+    sweep = clock - db_manager.get_meta(DB_PATH, 'scheduler_sweep_at', 0) >= SWEEP_INTERVAL
+    calendar = db_manager.load_race_calendar(DB_PATH, CALENDAR_RACES)
+    schedule = db_manager.load_location_schedule(DB_PATH)
+
+    due, updated = [], []
+    for location in db_manager.load_locations(DB_PATH):
+        slug = location['slug']
+        state = schedule.get(slug) or new_state(slug)
+        races = calendar.get(slug, [])
+        day = awaited_race_day(race_weekdays(races), date.fromisoformat(races[0][0]) if races else None, now)
+        if day and state['awaiting'] != day.isoformat():
+            # A new race day: polling starts over at the shortest interval
+            state.update(awaiting=day.isoformat(), poll_interval=POLL_INTERVAL, next_poll=0.0)
+            updated.append(state)
+        forced = bool(state['recheck_at'] and clock >= state['recheck_at'])
+        if forced or sweep or (day and clock >= state['next_poll']):
+            due.append((state, forced, day))
+    if not due:
+        db_manager.save_location_schedule(DB_PATH, updated)
+        publish()
+        return 0, 0
+
+    stored_races = db_manager.load_race_index(DB_PATH)
+    planned = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=main.DISCOVERY_WORKERS) as pool:
+        futures = {pool.submit(poll, state, forced, stored_races): (state, forced) for state, forced, _ in due}
+        for future in concurrent.futures.as_completed(futures):
+            state, forced = futures[future]
+            try:
+                races = future.result()
+            except requests.RequestException as e:
+                telemetry.log('info', f"Не удалось проверить {state['location_slug']}: {e}")
+                continue
+            telemetry.emit('poll', location=state['location_slug'], forced=forced, changed=races is not None,
+                           queued=len(races or []))
+            if races:
+                planned[state['location_slug']] = races
+
+    # Not journaled: scrape_tasks belongs to main.py's job and --resume. A race that fails here
+    # is simply polled again, as its location's race list digest is reset below
+    tasks = [(race, slug) for slug, races in planned.items() for race in races]
+    if tasks:
+        main.run_pipeline([], tasks, force=False, concurrency=concurrency, flush_size=main.FLUSH_SIZE,
+                          flush_interval=main.FLUSH_INTERVAL, parser=parser)
+
+    calendar = db_manager.load_race_calendar(DB_PATH, CALENDAR_RACES)
+    stored_races = db_manager.load_race_index(DB_PATH)
+    for state, forced, day in due:
+        slug = state['location_slug']
+        if forced:
+            state['recheck_at'] = None
+        if any((race['date'], slug) not in stored_races for race in planned.get(slug, [])):
+            # Races that failed are downloaded again at the next poll even if the page is unchanged
+            state['race_list_digest'] = None
+        races = calendar.get(slug, [])
+        last_race_date = date.fromisoformat(races[0][0]) if races else None
+        if day and last_race_date and last_race_date >= day:
+            # Captured: nothing to poll until the next race day, bar one re-check for corrections
+            recheck = datetime.combine(last_race_date + main.REFETCH_WINDOW, datetime.min.time()).replace(hour=RESULTS_FROM_HOUR)
+            state.update(poll_interval=POLL_INTERVAL, next_poll=0.0, recheck_at=recheck.timestamp())
+            telemetry.log('info', f"{slug}: забег №{races[0][1]} от {last_race_date:%d.%m.%Y} сохранен.")
+        elif day:
+            state.update(next_poll=clock + state['poll_interval'], poll_interval=min(state['poll_interval'] * 2, MAX_POLL_INTERVAL))
+    states = {state['location_slug']: state for state in updated + [state for state, _, _ in due]}
+    db_manager.save_location_schedule(DB_PATH, list(states.values()))
+    if sweep:
+        db_manager.set_meta(DB_PATH, 'scheduler_sweep_at', int(clock))
+
+    publish()
+    print(f"{now:%d.%m.%Y %H:%M}: проверено локаций {len(due)}, изменилось {len(planned)}, скачано забегов {len(tasks)}.")
+    return len(due), len(tasks)
+
+
+if __name__ == '__main__':
+    db_manager.init_db(DB_PATH)
+    log_level = get_option('log-level', 'quiet')
+    if log_level not in telemetry.LEVELS:
+        print(f"Ошибка: неизвестный уровень журнала '{log_level}', доступны: {', '.join(telemetry.LEVELS)}.")
+        sys.exit(1)
+    parser = get_option('parser', 'fast')
+    if parser not in results_parser.PARSERS:
+        print(f"Ошибка: неизвестный парсер '{parser}', доступны: {', '.join(results_parser.PARSERS)}.")
+        sys.exit(1)
+    telemetry.configure(log_level, get_option('events', None))
+    concurrency = get_option('concurrency', CONCURRENCY, int)
+    main.http_client = fetcher.Fetcher(concurrency=concurrency, rate=get_option('rps', REQUESTS_PER_SECOND, float))
+
+    try:
+        while True:
+            try:
+                run_once(concurrency=concurrency, parser=parser)
+            except (requests.RequestException, sqlite3.Error) as e:
+                print(f"Ошибка планировщика: {e}. Повторим через {TICK_SECONDS} с.")
+            if '--once' in sys.argv:
+                break
+            time.sleep(TICK_SECONDS)
+    except KeyboardInterrupt:
+        pass
+    telemetry.report()
+    telemetry.close()
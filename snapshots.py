@@ -0,0 +1,72 @@
+"""Materializes the filtered leaderboards the site shows most often.
+
+For every location: each year, each season of each year, each season over all years and
+the latest race, plus every age group that ran there over all time and in the current season. Saving a
+race deletes the snapshots it affects, so a run only rebuilds what is missing.
+
+    python snapshots.py [--full]
+"""
+import os
+import sys
+
+import aggregation
+import db_manager
+
+DB_PATH = os.path.join(os.path.dirname(__file__), db_manager.DB_NAME)
+
+
+def snapshot_views(db_path, location_slug, age_groups):
+    """(filters, age_group) of every view materialized for a location."""
+    years = db_manager.load_race_years(db_path, location_slug)
+    periods = [aggregation.race_filters(year, None, None, None, None) for year in years]
+    periods += [aggregation.race_filters(year, season, None, None, None) for year in years for season in aggregation.SEASONS]
+    periods += [aggregation.race_filters(None, season, None, None, None) for season in aggregation.SEASONS]
+    race_numbers = db_manager.load_race_numbers(db_path, location_slug)
+    if race_numbers:
+        periods.append(aggregation.race_filters(None, None, None, race_numbers[0]['number'], None))
+
+    views = [(filters, '') for filters in periods]
+    # Without a period or an age group the view is served from participant_stats instead
+    for filters in ({}, aggregation.race_filters(None, None, None, None, 'current_season')):
+        views += [(filters, age_group) for age_group in age_groups]
+    return views
+
+
+def build_snapshots(db_path, full=False):
+    """Builds the missing snapshots of every location; returns how many were stored."""
+    if full:
+        db_manager.clear_snapshots(db_path)
+    generation = db_manager.get_generation(db_path)
+    existing = db_manager.load_snapshot_keys(db_path)
+    built = 0
+
+    for location in db_manager.load_locations_with_races(db_path):
+        slug = location['slug']
+        missing = {}
+        # Only the age groups that ran here, as /api/age-groups offers them for this location
+        age_groups = db_manager.get_all_age_groups(db_path, slug)
+        for filters, age_group in snapshot_views(db_path, slug, age_groups):
+            period = db_manager.snapshot_period(filters)
+            if (slug, period, age_group) not in existing:
+                missing.setdefault(period, (filters, set()))[1].add(age_group)
+
+        snapshots = []
+        for period, (filters, period_age_groups) in missing.items():
+            # Races of a period are loaded once for all of its age groups
+            races = aggregation.load_period(db_path, slug, filters, reusable=True)
+            for age_group in sorted(period_age_groups):
+                leaderboard, fastest = aggregation.period_leaderboard(races, age_group or None)
+                snapshots.append((slug, period, age_group, {'leaderboard': leaderboard, 'fastest': fastest}))
+
+        if not db_manager.save_snapshots(db_path, snapshots, generation):
+            print("Данные изменились во время подготовки рейтингов, остальные будут построены при следующем запуске.")
+            break
+        built += len(snapshots)
+
+    return built
+
+
+if __name__ == '__main__':
+    db_manager.init_db(DB_PATH)
+    count = build_snapshots(DB_PATH, full='--full' in sys.argv)
+    print(f"Готовых рейтингов построено: {count}.")
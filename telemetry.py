@@ -0,0 +1,164 @@
+"""Structured telemetry of a scraper run.
+
+Every fetch, location discovery, page parse and database save is an event. With an events
+file (main.py --events=PATH) each one is appended to it as a JSON line; all of them also
+feed the report printed at the end of the run: pages per second, fetch and parse latency
+percentiles, the slowest locations (by time spent fetching and parsing their pages) and the
+failures grouped by cause.
+
+Console output has levels: quiet (the default) prints the stages of the run, errors that
+stop it and the report; info adds a line per location and per failed page; debug a line
+per race.
+"""
+import contextlib
+import json
+import threading
+import time
+
+LEVELS = ('quiet', 'info', 'debug')
+SLOWEST_LOCATIONS = 5
+
+_lock = threading.Lock()
+_local = threading.local()
+_level = 0
+_file = None
+
+
+class _Totals:
+    """What the report is built from; latencies are kept, events themselves are not."""
+
+    def __init__(self):
+        self.started = time.monotonic()
+        self.last_fetch = self.started
+        self.fetch_seconds = []
+        self.parse_seconds = []
+        self.pages = 0
+        self.race_pages = 0
+        self.bytes = 0
+        self.retries = 0
+        self.races_saved = 0
+        self.locations = {}
+        self.failures = {}
+
+    def add(self, record):
+        event = record['event']
+        location = record.get('location')
+        if event == 'fetch':
+            self.fetch_seconds.append(record['seconds'])
+            self.retries += record['retries']
+            self.bytes += record['bytes']
+            self.last_fetch = time.monotonic()
+            if not record['error']:
+                self.pages += 1
+        elif event == 'parse' and not record.get('error'):
+            self.parse_seconds.append(record['seconds'])
+            self.race_pages += 1
+        elif event == 'save' and not record.get('error'):
+            self.races_saved += record['races']
+        if location and event in ('fetch', 'parse'):
+            totals = self.locations.setdefault(location, [0, 0.0])
+            totals[0] += event == 'fetch'
+            totals[1] += record.get('seconds', 0.0)
+        if record.get('error'):
+            cause = f"{event}: {record['error']}"
+            self.failures[cause] = self.failures.get(cause, 0) + 1
+
+
+_totals = _Totals()
+
+
+def configure(level='quiet', events_path=None):
+    """Sets the console level and the events file, and starts the clock of the run."""
+    global _level, _file, _totals
+    if level not in LEVELS:
+        raise ValueError(f"Unknown log level '{level}', expected one of: {', '.join(LEVELS)}.")
+    _level = LEVELS.index(level)
+    if _file:
+        _file.close()
+    _file = open(events_path, 'a', encoding='utf-8') if events_path else None
+    _totals = _Totals()
+
+def log(level, message):
+    """Prints a console message if the configured level shows `level`."""
+    if LEVELS.index(level) <= _level:
+        print(message)
+
+@contextlib.contextmanager
+def context(**fields):
+    """Adds fields (e.g. the location) to every event emitted by this thread inside the block."""
+    previous = getattr(_local, 'fields', {})
+    _local.fields = {**previous, **fields}
+    try:
+        yield
+    finally:
+        _local.fields = previous
+
+def emit(event, **fields):
+    """Records an event and appends it to the events file, if there is one."""
+    record = {'ts': round(time.time(), 3), 'event': event, **getattr(_local, 'fields', {}), **fields}
+    with _lock:
+        _totals.add(record)
+        if _file:
+            _file.write(json.dumps(record, ensure_ascii=False) + '\n')
+            _file.flush()
+
+def error_cause(error):
+    """A short, groupable cause of an exception: the HTTP status if it has one, otherwise its type."""
+    response = getattr(error, 'response', None)
+    if response is not None:
+        return f"HTTP {response.status_code}"
+    return type(error).__name__
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+def summary():
+    """Totals of the run so far, as stored in the final 'report' event."""
+    with _lock:
+        totals = _totals
+        elapsed = time.monotonic() - totals.started
+        # Pages per second over the scraping itself, without the work after the last fetch
+        fetching = totals.last_fetch - totals.started
+        slowest = sorted(totals.locations.items(), key=lambda item: -item[1][1])[:SLOWEST_LOCATIONS]
+        return {
+            'seconds': round(elapsed, 3),
+            'pages': totals.pages,
+            'race_pages': totals.race_pages,
+            'pages_per_second': round(totals.pages / fetching, 2) if fetching else None,
+            'bytes': totals.bytes,
+            'retries': totals.retries,
+            'races_saved': totals.races_saved,
+            'fetch_seconds': {f'p{p}': percentile(totals.fetch_seconds, p / 100) for p in (50, 95, 99)},
+            'parse_seconds': {f'p{p}': percentile(totals.parse_seconds, p / 100) for p in (50, 95, 99)},
+            'slowest_locations': [{'location': slug, 'pages': pages, 'seconds': round(seconds, 3)} for slug, (pages, seconds) in slowest],
+            'failures': dict(sorted(totals.failures.items(), key=lambda item: -item[1])),
+        }
+
+def report():
+    """Prints the end-of-run report and records it as a 'report' event."""
+    stats = summary()
+    emit('report', **stats)
+
+    def latencies(values):
+        if values['p50'] is None:
+            return 'нет данных'
+        return ', '.join(f"{name} {seconds * 1000:.0f} мс" for name, seconds in values.items())
+
+    print(f"\nОтчет: {stats['pages']} страниц, из них {stats['race_pages']} страниц забегов ({stats['pages_per_second'] or 0:.1f} стр/с); "
+          f"{stats['bytes'] / 1e6:.1f} МБ, {stats['retries']} повторов, сохранено забегов: {stats['races_saved']}, весь запуск {stats['seconds']:.0f} с.")
+    print(f"  Скачивание: {latencies(stats['fetch_seconds'])}.")
+    print(f"  Разбор: {latencies(stats['parse_seconds'])}.")
+    if stats['slowest_locations']:
+        print("  Самые долгие локации: " + ', '.join(
+            f"{loc['location']} {loc['seconds']:.1f} с ({loc['pages']} стр.)" for loc in stats['slowest_locations']) + '.')
+    if stats['failures']:
+        print("  Ошибки: " + ', '.join(f"{cause} — {count}" for cause, count in stats['failures'].items()) + '.')
+
+def close():
+    global _file
+    if _file:
+        _file.close()
+        _file = None
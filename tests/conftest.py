@@ -0,0 +1,44 @@
+import os
+import random
+import sys
+
+import pytest
+
+# The modules live at the repository root, next to this directory
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import db_manager
+
+LOCATIONS = ('park-a', 'park-b')
+AGE_GROUPS = ('20-24', '35-39', '50-54', None)
+
+
+def random_results(rng, participants):
+    runners = []
+    for rank, runner_id in enumerate(rng.sample(participants, rng.randint(5, 25)), 1):
+        gender = rng.choice(['М', 'Ж', 'Ж', 'Н/Д'])
+        runners.append({
+            'id': runner_id, 'name': f'Участник {runner_id}', 'gender': gender, 'age_group': rng.choice(AGE_GROUPS),
+            # Coarse times and scores, so that ties and float sums are exercised
+            'score': round(rng.uniform(0, 100), 2), 'time_in_seconds': rng.randrange(1000, 1400, 20),
+            'overall_rank': rank, 'gender_rank': rng.randint(1, 4) if gender == 'Ж' else None,
+        })
+    runners.append({'id': None, 'name': db_manager.UNKNOWN_RUNNER_NAME, 'gender': 'Н/Д', 'age_group': None,
+                    'score': 0.0, 'time_in_seconds': rng.randrange(900, 1400, 20), 'overall_rank': len(runners) + 1})
+    volunteers = [{'id': volunteer_id, 'name': f'Участник {volunteer_id}'} for volunteer_id in rng.sample(participants, 4)]
+    return {'runners': runners, 'volunteers': volunteers}
+
+
+@pytest.fixture(scope='module')
+def races_db(tmp_path_factory):
+    """A database of two years of random races at LOCATIONS, built once per test module."""
+    path = str(tmp_path_factory.mktemp('races') / 'races.db')
+    db_manager.init_db(path)
+    rng = random.Random(3)
+    participants = list(range(1000, 1060))
+    for slug in LOCATIONS:
+        for number, day in enumerate(range(0, 2 * 365, 21), 1):
+            race_date = f'{(1 + day % 28):02d}.{(1 + day // 28 % 12):02d}.{2023 + day // 365}'
+            db_manager.save_results(path, race_date, slug, number, random_results(rng, participants))
+    yield path
+    db_manager.close_connection(path)
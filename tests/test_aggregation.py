@@ -0,0 +1,54 @@
+"""The NumPy backend and the archive must give exactly the leaderboards of the Python aggregation over SQLite."""
+import pytest
+
+np = pytest.importorskip('numpy')
+
+import aggregation
+import archive
+import db_manager
+from conftest import LOCATIONS
+
+# (year, season, month, race_number, filter_mode) as /api/data passes them
+PERIODS = [
+    (None, None, None, None, None), (2024, None, None, None, None), (None, 'лето', None, None, None),
+    (2024, 'зима', None, None, None), (2023, 'осень', None, None, None), (None, None, 3, None, None),
+    (None, None, None, 5, None),
+]
+AG_FILTERS = [None, 'all', 'М35-39', 'Ж20-24', 'Н/ДNone']
+
+
+@pytest.fixture(scope='module')
+def db_path(races_db):
+    archive.build(races_db)
+    return races_db
+
+
+def python_leaderboard(races, ag_filter):
+    return aggregation.calculate_leaderboard(races, ag_filter)
+
+
+def numpy_leaderboard(columns, ag_filter):
+    leaderboard, fastest = aggregation.columns_leaderboard(columns, ag_filter)
+    for stats in leaderboard:
+        aggregation.set_best_time_race_url(stats)
+    return leaderboard, fastest
+
+
+@pytest.mark.parametrize('location_slug', LOCATIONS + (db_manager.ALL_LOCATIONS,))
+@pytest.mark.parametrize('period', PERIODS, ids=str)
+def test_backends_and_sources_agree(db_path, location_slug, period):
+    filters = aggregation.race_filters(*period)
+    mapped = archive.Archive(archive.archive_path(db_path))
+    assert mapped.generation == db_manager.get_generation(db_path)
+    for ag_filter in AG_FILTERS:
+        expected = python_leaderboard(db_manager.iter_race_rows(db_path, location_slug=location_slug, **filters), ag_filter)
+        assert python_leaderboard(mapped.iter_race_rows(location_slug, **filters), ag_filter) == expected
+        assert numpy_leaderboard(aggregation.load_columns(db_path, location_slug, filters), ag_filter) == expected
+        assert numpy_leaderboard(aggregation.archive_columns(mapped, location_slug, filters), ag_filter) == expected
+
+
+def test_periods_are_not_empty(db_path):
+    # Guards the test above against comparing empty leaderboards
+    for period in PERIODS:
+        races = db_manager.iter_race_rows(db_path, location_slug='park-a', **aggregation.race_filters(*period))
+        assert python_leaderboard(races, None)[0]
@@ -0,0 +1,104 @@
+"""/api/data through the Flask test client: response cache, keyset pagination, ETag/304, gzip and NDJSON."""
+import gzip
+import json
+import sqlite3
+
+import pytest
+
+import app
+import db_manager
+
+# (location, extra query) of the views paged below: precomputed totals and in-memory filtered leaderboards
+VIEWS = [('park-a', ''), ('all', ''), ('park-b', '&year=2024'), ('park-a', '&ag=Ж35-39'), ('all', '&ag=М20-24')]
+
+
+@pytest.fixture
+def client(races_db, tmp_path, monkeypatch):
+    # A copy per test, since some tests write to it
+    path = str(tmp_path / 'app.db')
+    with sqlite3.connect(path) as copy:
+        db_manager.get_connection(races_db).backup(copy)
+    monkeypatch.setattr(app, 'DB_PATH', path)
+    monkeypatch.setattr(app, 'response_cache', app.ResponseCache(max_entries=64))
+    yield app.app.test_client()
+    db_manager.close_connection(path)
+
+
+def get_json(client, url, **headers):
+    response = client.get(url, headers=headers)
+    assert response.status_code == 200, response.get_data(as_text=True)
+    return response
+
+
+def test_generation_bump_changes_etag_and_evicts_cache(client):
+    first = get_json(client, '/api/data?location=park-a')
+    assert get_json(client, '/api/data?location=park-a').headers['ETag'] == first.headers['ETag']
+    assert app.response_cache.entries
+
+    db_manager.save_results(app.DB_PATH, '30.12.2024', 'park-a', 99, {
+        'runners': [{'id': 5000, 'name': 'Новый Участник', 'gender': 'М', 'age_group': '35-39', 'score': 99.0,
+                     'time_in_seconds': 900, 'overall_rank': 1}],
+        'volunteers': []})
+    second = get_json(client, '/api/data?location=park-a')
+    assert second.headers['ETag'] != first.headers['ETag']
+    assert app.response_cache.generation == db_manager.get_generation(app.DB_PATH)
+    assert 5000 in [row['id'] for row in second.get_json()['leaderboard']]
+
+
+@pytest.mark.parametrize('sort', list(db_manager.LEADERBOARD_ORDERS))
+@pytest.mark.parametrize('location_slug, query', VIEWS)
+def test_cursor_walks_whole_leaderboard(client, location_slug, query, sort):
+    full = get_json(client, f'/api/data?location={location_slug}{query}').get_json()['leaderboard']
+    rows, cursor, pages = [], None, 0
+    while True:
+        url = f'/api/data?location={location_slug}{query}&sort={sort}&limit=7' + (f'&cursor={cursor}' if cursor else '')
+        page = get_json(client, url).get_json()
+        assert page['total'] == len(full)
+        rows += page['leaderboard']
+        cursor, pages = page['next_cursor'], pages + 1
+        if not cursor:
+            break
+    assert pages == max(1, -(-len(full) // 7))
+    ids = [row['id'] for row in rows]
+    assert len(ids) == len(set(ids)) == len(full)
+    assert set(ids) == {row['id'] for row in full}
+    keys = [db_manager.leaderboard_sort_key(row, sort) for row in rows]
+    assert keys == sorted(keys)
+
+
+def test_cursor_of_another_sort_is_rejected(client):
+    page = get_json(client, '/api/data?location=park-a&sort=runs&limit=5').get_json()
+    assert client.get(f"/api/data?location=park-a&sort=score&limit=5&cursor={page['next_cursor']}").status_code == 400
+    assert client.get('/api/data?location=park-a&limit=0').status_code == 400
+
+
+def test_if_none_match_returns_304(client):
+    etag = get_json(client, '/api/data?location=park-b').headers['ETag']
+    response = client.get('/api/data?location=park-b', headers={'If-None-Match': etag})
+    assert response.status_code == 304
+    assert response.get_data() == b''
+    assert response.headers['ETag'] == etag
+
+
+def test_gzip_is_negotiated(client):
+    plain = get_json(client, '/api/data?location=park-a', **{'Accept-Encoding': 'identity'})
+    compressed = get_json(client, '/api/data?location=park-a', **{'Accept-Encoding': 'gzip'})
+    assert 'Content-Encoding' not in plain.headers
+    assert compressed.headers['Content-Encoding'] == 'gzip'
+    assert 'Accept-Encoding' in compressed.headers['Vary']
+    assert compressed.headers['ETag'] != plain.headers['ETag']
+    assert json.loads(gzip.decompress(compressed.get_data())) == plain.get_json()
+
+
+@pytest.mark.parametrize('encoding', ['identity', 'gzip'])
+def test_ndjson_streams_head_then_rows(client, encoding):
+    expected = get_json(client, '/api/data?location=all').get_json()
+    response = get_json(client, '/api/data?location=all&format=ndjson', **{'Accept-Encoding': encoding})
+    assert response.mimetype == 'application/x-ndjson'
+    body = response.get_data()
+    if encoding == 'gzip':
+        assert response.headers['Content-Encoding'] == 'gzip'
+        body = gzip.decompress(body)
+    head, *rows = [json.loads(line) for line in body.decode().splitlines()]
+    assert rows == expected.pop('leaderboard')
+    assert head == expected
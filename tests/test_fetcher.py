@@ -0,0 +1,138 @@
+"""Fetcher against a local stub HTTP server: retries, backoff, Retry-After, timeouts, the rate limit and conditional GETs."""
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+import requests
+
+import fetcher
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """Answers each path from a script of (status, headers, delay) steps; the last step repeats."""
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.requests.append((self.path, time.monotonic()))
+            steps = server.scripts.get(self.path, [(200, {}, 0.0)])
+            count = sum(1 for path, _ in server.requests if path == self.path)
+            status, headers, delay = steps[min(count, len(steps)) - 1]
+        if delay:
+            time.sleep(delay)
+        body = f'{self.path} {status}'.encode() if status != 304 else b''
+        try:
+            self.send_response(status)
+            for name, value in headers.items():
+                self.send_header(name, value)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def stub():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubHandler)
+    server.daemon_threads = True
+    server.lock = threading.Lock()
+    server.requests = []
+    server.scripts = {}
+    server.url = f'http://127.0.0.1:{server.server_address[1]}'
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def request_times(server, path):
+    return [at for requested, at in server.requests if requested == path]
+
+
+@pytest.mark.parametrize('status', [500, 503, 429])
+def test_retryable_status_is_retried_with_backoff(stub, status):
+    stub.scripts['/flaky'] = [(status, {}, 0.0), (status, {}, 0.0), (200, {}, 0.0)]
+    client = fetcher.Fetcher(rate=0, retries=3, backoff=0.1)
+    assert client.get(stub.url + '/flaky') == '/flaky 200'
+    times = request_times(stub, '/flaky')
+    assert len(times) == 3
+    # Exponential: at least backoff, then twice that
+    assert times[1] - times[0] >= 0.1
+    assert times[2] - times[1] >= 0.2
+
+
+@pytest.mark.parametrize('status', [429, 503])
+def test_retry_after_is_respected(stub, status):
+    stub.scripts['/busy'] = [(status, {'Retry-After': '1'}, 0.0), (200, {}, 0.0)]
+    client = fetcher.Fetcher(rate=0, retries=2, backoff=0.01)
+    assert client.get(stub.url + '/busy') == '/busy 200'
+    first, second = request_times(stub, '/busy')
+    assert second - first >= 1.0
+
+
+def test_retry_after_is_capped(stub):
+    stub.scripts['/away'] = [(503, {'Retry-After': '86400'}, 0.0), (200, {}, 0.0)]
+    client = fetcher.Fetcher(rate=0, retries=2, backoff=0.01, max_retry_after=0.3)
+    start = time.monotonic()
+    assert client.get(stub.url + '/away') == '/away 200'
+    assert time.monotonic() - start < 5
+    first, second = request_times(stub, '/away')
+    assert second - first >= 0.3
+
+
+def test_retries_are_exhausted(stub):
+    stub.scripts['/down'] = [(503, {}, 0.0)]
+    client = fetcher.Fetcher(rate=0, retries=2, backoff=0.01)
+    with pytest.raises(requests.HTTPError) as raised:
+        client.get(stub.url + '/down')
+    assert raised.value.response.status_code == 503
+    assert len(request_times(stub, '/down')) == 3
+
+
+def test_timeout_is_retried(stub):
+    stub.scripts['/slow'] = [(200, {}, 1.0), (200, {}, 0.0)]
+    client = fetcher.Fetcher(rate=0, retries=2, backoff=0.01, timeout=0.2)
+    assert client.get(stub.url + '/slow') == '/slow 200'
+    assert len(request_times(stub, '/slow')) == 2
+
+
+def test_client_error_is_raised_without_retrying(stub):
+    stub.scripts['/missing'] = [(404, {}, 0.0)]
+    client = fetcher.Fetcher(rate=0, retries=3, backoff=0.01)
+    with pytest.raises(requests.HTTPError) as raised:
+        client.get(stub.url + '/missing')
+    assert raised.value.response.status_code == 404
+    assert len(request_times(stub, '/missing')) == 1
+
+
+def test_rate_limit_is_respected(stub):
+    client = fetcher.Fetcher(concurrency=4, rate=20, retries=0)
+    urls = [f'{stub.url}/page{i}' for i in range(10)]
+    threads = [threading.Thread(target=client.get, args=(url,)) for url in urls]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    times = sorted(at for _, at in stub.requests)
+    assert len(times) == 10
+    # 20 per second: ten requests span at least nine intervals of 50 ms
+    assert times[-1] - times[0] >= 9 * 0.05 * 0.9
+
+
+
+
+
+def test_conditional_get(stub):
+    stub.scripts['/history'] = [(200, {'ETag': '"v1"', 'Last-Modified': 'Sat, 14 Jun 2025 09:00:00 GMT'}, 0.0),
+                                (304, {}, 0.0)]
+    client = fetcher.Fetcher(rate=0)
+    body, etag, last_modified = client.get_if_changed(stub.url + '/history')
+    assert (body, etag) == ('/history 200', '"v1"')
+    # The server sends no validators with the 304; the earlier ones are kept
+    assert client.get_if_changed(stub.url + '/history', etag, last_modified) == (None, '"v1"', last_modified)
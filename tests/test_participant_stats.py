@@ -0,0 +1,91 @@
+"""participant_stats kept up at write time must equal a full recompute, re-scrapes included."""
+import random
+
+import pytest
+
+import db_manager
+
+
+def runner(runner_id, rank, gender, score, time_in_seconds, gender_rank=None):
+    return {'id': runner_id, 'name': f'Участник {runner_id}', 'gender': gender, 'age_group': '35-39',
+            'score': score, 'time_in_seconds': time_in_seconds, 'overall_rank': rank, 'gender_rank': gender_rank}
+
+
+def random_results(rng, participants):
+    ids = rng.sample(participants, rng.randint(3, len(participants) - 2))
+    runners = [runner(runner_id, rank, rng.choice('МЖ'), round(rng.uniform(0, 100), 2), rng.randint(1100, 2400))
+               for rank, runner_id in enumerate(ids, 1)]
+    # One runner without a profile, and volunteers, some of whom also ran
+    runners.append(runner(None, len(runners) + 1, 'Н/Д', None, None))
+    volunteers = [{'id': volunteer_id, 'name': f'Участник {volunteer_id}'} for volunteer_id in rng.sample(participants, 3)]
+    return {'runners': runners, 'volunteers': volunteers}
+
+
+def stats_rows(cursor):
+    cursor.execute('SELECT * FROM participant_stats ORDER BY participant_id, location_slug')
+    return cursor.fetchall()
+
+
+def recomputed_rows(db_path):
+    conn = db_manager.get_connection(db_path)
+    cursor = conn.cursor()
+    cursor.execute('SAVEPOINT recompute')
+    try:
+        db_manager._rebuild_participant_stats(cursor)
+        return stats_rows(cursor)
+    finally:
+        cursor.execute('ROLLBACK TO recompute')
+        cursor.execute('RELEASE recompute')
+
+
+@pytest.fixture
+def db_path(tmp_path):
+    path = str(tmp_path / 'stats.db')
+    db_manager.init_db(path)
+    yield path
+    db_manager.close_connection(path)
+
+
+def assert_matches_recompute(db_path):
+    stored = stats_rows(db_manager.get_connection(db_path).cursor())
+    assert stored
+    assert stored == recomputed_rows(db_path)
+
+
+def test_incremental_stats_match_recompute(db_path):
+    rng = random.Random(7)
+    participants = list(range(1000, 1012))
+    races = [(f'{day:02d}.06.2024', slug, number)
+             for number, day in enumerate((1, 8, 15, 22), 1) for slug in ('park-a', 'park-b')]
+    for race_date, slug, number in races:
+        db_manager.save_results(db_path, race_date, slug, number, random_results(rng, participants))
+    assert_matches_recompute(db_path)
+
+    # Re-scraped races with changed results: scores, runners dropped and added, best times lost
+    for race_date, slug, number in rng.sample(races, 4) * 2:
+        db_manager.save_results(db_path, race_date, slug, number, random_results(rng, participants))
+        assert_matches_recompute(db_path)
+
+
+def test_rescrape_removes_participant_from_location(db_path):
+    first = {'runners': [runner(1, 1, 'М', 50.5, 1200), runner(2, 2, 'Ж', 49.25, 1300, 1)],
+             'volunteers': [{'id': 3, 'name': 'Участник 3'}]}
+    db_manager.save_results(db_path, '01.06.2024', 'park-a', 1, first)
+    db_manager.save_results(db_path, '08.06.2024', 'park-b', 1, first)
+    # Runner 2 and the volunteer are gone from the corrected park-a results
+    db_manager.save_results(db_path, '01.06.2024', 'park-a', 1, {'runners': [runner(1, 1, 'М', 50.1, 1250)], 'volunteers': []})
+    assert_matches_recompute(db_path)
+    cursor = db_manager.get_connection(db_path).cursor()
+    cursor.execute("SELECT participant_id, location_slug FROM participant_stats WHERE participant_id IN (2, 3) ORDER BY 1, 2")
+    assert cursor.fetchall() == [(2, 'all'), (2, 'park-b'), (3, 'all'), (3, 'park-b')]
+
+
+def test_volunteers_have_no_gender_at_location(db_path):
+    # Participant 2 runs at park-a but only volunteers at park-b
+    db_manager.save_results(db_path, '01.06.2024', 'park-a', 1, {'runners': [runner(2, 1, 'М', 50.0, 1200)], 'volunteers': []})
+    db_manager.save_results(db_path, '08.06.2024', 'park-b', 1, {
+        'runners': [runner(1, 1, 'Ж', 20.0, 1500, 1)], 'volunteers': [{'id': 2, 'name': 'Участник 2'}]})
+    leaderboard, _ = db_manager.load_leaderboard(db_path, 'park-b')
+    assert [(row['id'], row['gender'], row['age_group']) for row in leaderboard] == [(2, None, None), (1, 'Ж', '35-39')]
+    assert db_manager.load_leaderboard(db_path, 'park-b', gender='М') == ([], 0)
+    assert [row['gender'] for row in db_manager.load_leaderboard(db_path, 'park-a')[0]] == ['М']
@@ -0,0 +1,41 @@
+"""Golden-file check that both results parsers read saved pages exactly as recorded.
+
+Each tests/pages/<name>.html has the expected parse in <name>.json. After a deliberate
+change to the output, regenerate the JSON from parse_results_bs4 and review the diff.
+"""
+import glob
+import json
+import os
+
+import pytest
+
+import results_parser
+
+PAGES_DIR = os.path.join(os.path.dirname(__file__), 'pages')
+PAGES = sorted(glob.glob(os.path.join(PAGES_DIR, '*.html')))
+
+
+def load_page(path):
+    with open(path, encoding='utf-8') as f:
+        html = f.read()
+    with open(os.path.splitext(path)[0] + '.json', encoding='utf-8') as f:
+        return html, json.load(f)
+
+
+@pytest.mark.parametrize('path', PAGES, ids=[os.path.basename(path) for path in PAGES])
+def test_parsers_match_golden_output(path):
+    html, expected = load_page(path)
+    assert results_parser.parse_results(html) == results_parser.parse_results_bs4(html) == expected
+
+
+def test_edge_rows():
+    _, expected = load_page(os.path.join(PAGES_DIR, 'race.html'))
+    runners = {runner['overall_rank']: runner for runner in expected['runners']}
+    # A row without a valid time is skipped; ranks are taken from the page, not renumbered
+    assert sorted(runners) == [1, 2, 3, 4, 5, 7]
+    assert runners[3]['id'] is None and runners[3]['name'] == results_parser.UNKNOWN_RUNNER_NAME
+    assert runners[4]['age_group'] is None and runners[4]['gender'] == 'М'
+    assert runners[7]['score'] == 0.0
+    assert [runner['gender_rank'] for runner in expected['runners'] if runner['gender'] == 'Ж'] == [1, 2, 3]
+    # Volunteers are deduplicated and rows without a profile link are dropped
+    assert [volunteer['id'] for volunteer in expected['volunteers']] == [790000999, 790000077]
@@ -0,0 +1,43 @@
+"""Stored leaderboard snapshots must not outlive the data they were built from."""
+import aggregation
+import db_manager
+import snapshots
+
+
+def race(runner_id, name, score=50.0):
+    return {'runners': [{'id': runner_id, 'name': name, 'gender': 'М', 'age_group': '35-39', 'score': score,
+                         'time_in_seconds': 1200, 'overall_rank': 1}],
+            'volunteers': []}
+
+
+def snapshot_locations(db_path):
+    return {slug for slug, _, _ in db_manager.load_snapshot_keys(db_path)}
+
+
+def test_rename_elsewhere_invalidates_snapshots(tmp_path):
+    db_path = str(tmp_path / 'snapshots.db')
+    db_manager.init_db(db_path)
+    db_manager.save_locations(db_path, [{'slug': slug, 'name': slug, 'url': ''} for slug in ('park-a', 'park-b', 'park-c')])
+    db_manager.save_results(db_path, '01.06.2024', 'park-a', 1, race(1, 'Иван Старый'))
+    db_manager.save_results(db_path, '08.06.2024', 'park-b', 1, race(1, 'Иван Старый'))
+    db_manager.save_results(db_path, '08.06.2024', 'park-c', 1, race(2, 'Петр Петров'))
+    snapshots.build_snapshots(db_path)
+    assert snapshot_locations(db_path) == {'park-a', 'park-b', 'park-c'}
+
+    # A new race at park-b with an unchanged name only drops the park-b views it affects
+    db_manager.save_results(db_path, '15.06.2024', 'park-b', 2, race(1, 'Иван Старый', 40.0))
+    assert snapshot_locations(db_path) == {'park-a', 'park-b', 'park-c'}
+
+    # The participant's name changes in a race at park-b: park-a snapshots still hold the old one
+    db_manager.save_results(db_path, '22.06.2024', 'park-b', 3, race(1, 'Иван Новый'))
+    assert 'park-a' not in snapshot_locations(db_path)
+    assert 'park-c' in snapshot_locations(db_path)
+    snapshots.build_snapshots(db_path)
+    period = db_manager.snapshot_period(aggregation.race_filters(2024, None, None, None, None))
+    leaderboard = db_manager.load_snapshot(db_path, 'park-a', period, '')['leaderboard']
+    assert [row['name'] for row in leaderboard] == ['Иван Новый']
+
+    # Re-saving an older race with the old name does not rename anyone
+    db_manager.save_results(db_path, '01.06.2024', 'park-a', 1, race(1, 'Иван Старый'))
+    assert 'park-b' in snapshot_locations(db_path)
+    db_manager.close_connection(db_path)